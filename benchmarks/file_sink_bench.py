@@ -0,0 +1,74 @@
+# -*- coding:utf-8 -*-
+"""
+对比每个item打开一次文件写入与JsonLinesFile流式写入的吞吐量及文件大小
+python -m benchmarks.file_sink_bench -n 20000
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+from structor.pipelines import JsonLinesFile
+from structor.utils import ItemEncoder
+
+
+def make_items(count):
+    return [{"crawlid": "douban", "spiderid": "douban",
+             "url": "https://movie.douban.com/subject/%s/" % i,
+             "title": "The Shawshank Redemption %s" % i,
+             "score": "9.7", "tags": ["drama", "crime", "classic"],
+             "summary": "Two imprisoned men bond over a number of years. " * 5}
+            for i in range(count)]
+
+
+def bench_open_per_item(directory, items):
+    path = os.path.join(directory, "tests.json")
+    start = time.time()
+    for item in items:
+        open(path, "w").write(json.dumps(item, cls=ItemEncoder))
+    return time.time() - start, os.path.getsize(path)
+
+
+def bench_stream(directory, items, compress, sync_every):
+    f = JsonLinesFile(os.path.join(directory, "part-%s" % compress), compress)
+    start = time.time()
+    for i, item in enumerate(items, 1):
+        f.write(json.dumps(item, cls=ItemEncoder).encode() + b"\n")
+        if i % sync_every == 0:
+            f.sync()
+    f.close()
+    return time.time() - start, os.path.getsize(f.path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="File sink benchmark. ")
+    parser.add_argument("-n", "--number", type=int, default=20000,
+                        help="Items to write. ")
+    parser.add_argument("--sync-every", type=int, default=1000,
+                        help="Fsync once every n items, "
+                             "simulate FILE_SINK_FSYNC_INTERVAL. ")
+    args = parser.parse_args()
+    items = make_items(args.number)
+    directory = tempfile.mkdtemp()
+    try:
+        print("%-16s %14s %14s" % ("sink", "items/s", "bytes"))
+        cost, size = bench_open_per_item(directory, items)
+        print("%-16s %14.0f %14s" % ("open per item", len(items) / cost,
+                                     "%s (last item)" % size))
+        for compress in ("", "gzip", "zstd"):
+            try:
+                cost, size = bench_stream(
+                    directory, items, compress, args.sync_every)
+            except ImportError:
+                print("zstandard is not installed, skip zstd. ")
+                continue
+            print("%-16s %14.0f %14d" % (
+                "jsonl" + (compress and "+" + compress), len(items) / cost, size))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
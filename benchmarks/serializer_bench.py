@@ -0,0 +1,58 @@
+# -*- coding:utf-8 -*-
+"""
+对比各个队列序列化方案每个元素的字节数及编解码吞吐量
+python -m benchmarks.serializer_bench -n 20000
+"""
+import time
+import argparse
+
+from structor.custom_request import Request
+from structor.serializers import PickleSerializer, CompactSerializer, loads
+
+
+def make_requests(count):
+    return [Request(
+        "https://movie.douban.com/subject/%s/comments?start=%s" % (i, i * 20),
+        callback="parse_next", errback="errback",
+        headers={"Referer": "https://movie.douban.com/subject/%s/" % i},
+        meta={"crawlid": "douban", "spiderid": "douban", "priority": 80,
+              "seed": "https://movie.douban.com/", "proxy": None,
+              "request_count_per_item": 3})
+        for i in range(count)]
+
+
+def bench(name, serializer, requests):
+    start = time.time()
+    entries = [serializer.dumps(req) for req in requests]
+    encode_time = time.time() - start
+    start = time.time()
+    for entry in entries:
+        loads(entry)
+    decode_time = time.time() - start
+    print("%-16s %10.1f %14.0f %14.0f" % (
+        name, sum(map(len, entries)) / len(entries),
+        len(requests) / encode_time, len(requests) / decode_time))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Queue serializer benchmark. ")
+    parser.add_argument("-n", "--number", type=int, default=20000,
+                        help="Requests to serialize. ")
+    args = parser.parse_args()
+    requests = make_requests(args.number)
+    print("%-16s %10s %14s %14s" % (
+        "serializer", "bytes/entry", "encode/s", "decode/s"))
+    bench("pickle", PickleSerializer(), requests)
+    try:
+        bench("compact", CompactSerializer(), requests)
+    except ImportError:
+        print("msgpack is not installed, skip compact. ")
+        return
+    try:
+        bench("compact+zstd", CompactSerializer("zstd"), requests)
+    except ImportError:
+        print("zstandard is not installed, skip compact+zstd. ")
+
+
+if __name__ == "__main__":
+    main()
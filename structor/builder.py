@@ -11,7 +11,8 @@ from os.path import join, exists, abspath, dirname, isdir, basename
 
 from .utils import ArgparseHelper
 from .spider_feeder import SpiderFeeder
-from .check_status import start as check
+from .check_status import start as check, watch
+from .purge_task import start as purge
 
 
 class Command(object):
@@ -30,12 +31,25 @@ class Command(object):
         sf = SpiderFeeder(self.args.crawlid, self.args.spiderid,
                           self.args.url, self.args.urls_file,
                           self.args.priority, self.args.redis_port,
-                          self.args.redis_host, self.args.custom)
+                          self.args.redis_host, self.args.custom,
+                          self.args.serializer, self.args.compress,
+                          self.args.batch_size, self.args.processes,
+                          self.args.resume, self.args.retries)
         sf.start()
 
     def check(self):
+        if self.args.watch:
+            return watch(self.args.crawlids, host=self.args.redis_host,
+                         port=self.args.redis_port, custom=self.args.custom,
+                         interval=self.args.watch, as_json=self.args.json)
         for crawlid in self.args.crawlids:
             check(crawlid=crawlid, host=self.args.redis_host,
+                  port=self.args.redis_port, custom=self.args.custom,
+                  as_json=self.args.json)
+
+    def purge(self):
+        for crawlid in self.args.crawlids:
+            purge(crawlid=crawlid, host=self.args.redis_host,
                   port=self.args.redis_port, custom=self.args.custom)
 
     def create(self):
@@ -193,22 +207,53 @@ class Command(object):
         check = sub_parsers.add_parser(
             "check", parents=[base_parser], help="Check spider status. ")
         check.add_argument("crawlids", nargs="+", help="Crawlids to check. ")
+        check.add_argument(
+            "--watch", type=float, nargs="?", const=5,
+            help="Refresh progress of all crawlids every n seconds, default 5. ")
+        check.add_argument(
+            "--json", action="store_true", help="Output progress as json. ")
+
+        purge = sub_parsers.add_parser(
+            "purge", parents=[base_parser],
+            help="Delete all the redis keys of crawl tasks. ")
+        purge.add_argument("crawlids", nargs="+", help="Crawlids to purge. ")
 
         feed = sub_parsers.add_parser(
             "feed", parents=[base_parser], help="Feed tasks. ")
         feed.add_argument(
             '-u', '--url', help="Product list url. ")
         feed.add_argument(
-            '-uf', '--urls-file', help="File within product url per line. ")
+            '-uf', '--urls-file',
+            help="File within product url per line, .gz file or - for stdin. ")
         feed.add_argument(
             '-c', '--crawlid', required=True, help="Id for a crawl task. ")
         feed.add_argument(
             '-s', '--spiderid', required=True, help="Spider to crawl. ")
         feed.add_argument(
             '-p', '--priority', type=int, default=100, help="Priority. ")
+        feed.add_argument(
+            '--serializer', default="structor.serializers.PickleSerializer",
+            help="Serializer of queue entries. ")
+        feed.add_argument(
+            '--compress', choices=["zstd"],
+            help="Compress queue entries, only for CompactSerializer. ")
+        feed.add_argument(
+            '--batch-size', type=int, default=1000,
+            help="Urls to feed in one round trip. ")
+        feed.add_argument(
+            '--processes', type=int, default=1,
+            help="Split a plain urls file by byte ranges to feed in processes. ")
+        feed.add_argument(
+            '--resume', action="store_true",
+            help="Resume an interrupted feed of --urls-file from the last "
+                 "checkpoint instead of cleaning the task. ")
+        feed.add_argument(
+            '--retries', type=int, default=3,
+            help="Times to retry a failed batch before giving up. ")
 
         if len(sys.argv) < 2 or \
-                len(sys.argv) == 2 and sys.argv[1] not in ["feed", "check"]:
+                len(sys.argv) == 2 and \
+                sys.argv[1] not in ["feed", "check", "purge"]:
             parser.print_help()
             exit(1)
         return parser.parse_args()
@@ -1,12 +1,24 @@
 # -*- coding:utf-8 -*-
+"""
+查看任务状态
+watch模式下每隔一段时间在一个pipeline中读取所有crawlid的统计信息，
+根据最近几次采样的增量计算抓取速度及预计剩余时间。
+"""
+import sys
+import json
+import time
 import fnmatch
 import argparse
 
+from collections import deque
+
+from .utils import decode
+
 
 def format(d, f=False):
     for k, v in d.items():
-        k = k.decode() if isinstance(k, bytes) else k
-        v = v.decode() if isinstance(v, bytes) else v
+        k = decode(k)
+        v = decode(v)
         if f:
             print("reason --> %s" % v.ljust(30))
             print("url    --> %s" % k.ljust(30))
@@ -14,24 +26,158 @@ def format(d, f=False):
             print("%s -->  %s" % (k.ljust(30), v))
 
 
-def start(crawlid, host, port, custom):
+def connect(host, port, custom):
     if custom:
         from custom_redis.client import Redis
     else:
         from redis import Redis
-    redis_conn = Redis(host, port)
-    key = "crawlid:%s" % crawlid
-    data = redis_conn.hgetall(key)
-    failed_keys = [x for x in data.keys() if fnmatch.fnmatch(
-        x.decode() if isinstance(x, bytes) else x, "failed_download_*")]
+    return Redis(host, port)
+
+
+def fetch(redis_conn, crawlids, custom=False):
+    """
+    在一个pipeline中读取多个crawlid的统计信息，custom_redis不支持pipeline，只能依次读取
+    :param redis_conn:
+    :param crawlids:
+    :param custom:
+    :return: 与crawlids一一对应的dict
+    """
+    keys = ["crawlid:%s" % crawlid for crawlid in crawlids]
+    if custom:
+        results = [redis_conn.hgetall(key) for key in keys]
+    else:
+        pipe = redis_conn.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        results = pipe.execute()
+    return [{decode(k): decode(v) for k, v in (data or {}).items()}
+            for data in results]
+
+
+def iter_failed(redis_conn, key, custom=False, count=1000):
+    """
+    使用HSCAN增量地读取失败记录，custom_redis不支持HSCAN，使用HGETALL
+    :param redis_conn:
+    :param key:
+    :param custom:
+    :param count: 每次HSCAN读取的数量
+    :return: (url, reason)
+    """
+    if custom:
+        yield from redis_conn.hgetall(key).items()
+        return
+    cursor = 0
+    while True:
+        cursor, data = redis_conn.hscan(key, cursor, count=count)
+        yield from data.items()
+        cursor = int(cursor)
+        if not cursor:
+            break
+
+
+class Progress(object):
+    """
+    保存每个crawlid最近window次采样的抓取数，计算抓取速度、失败率及剩余时间
+    """
+    def __init__(self, window=12):
+        self.window = window
+        self.samples = dict()
+
+    def update(self, crawlid, data, now=None):
+        now = now or time.time()
+        total = int(data.get("total_pages", 0))
+        crawled = int(data.get("crawled_pages", 0))
+        failed = sum(int(v) for k, v in data.items()
+                     if fnmatch.fnmatch(k, "failed_download_*"))
+        samples = self.samples.setdefault(crawlid, deque(maxlen=self.window))
+        samples.append((now, crawled))
+        speed = eta = None
+        if len(samples) > 1 and now > samples[0][0]:
+            speed = (crawled - samples[0][1]) / (now - samples[0][0])
+        remaining = max(total - crawled, 0)
+        if speed and speed > 0:
+            eta = remaining / speed
+        return {
+            "crawlid": crawlid,
+            "spiderid": data.get("spiderid"),
+            "total_pages": total,
+            "crawled_pages": crawled,
+            "failed": failed,
+            "failure_rate": failed / max(crawled + failed, 1),
+            "remaining": remaining,
+            "pages_per_sec": speed,
+            "eta": eta,
+            "update_time": data.get("update_time"),
+        }
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return "-"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+
+def show_table(rows):
+    line = "%-20s %10s %10s %8s %8s %10s %10s %10s  %s"
+    print(line % ("crawlid", "total", "crawled", "failed", "fail%",
+                  "remaining", "pages/s", "eta", "update_time"))
+    for row in rows:
+        print(line % (
+            row["crawlid"], row["total_pages"], row["crawled_pages"],
+            row["failed"], "%.2f" % (row["failure_rate"] * 100),
+            row["remaining"],
+            "-" if row["pages_per_sec"] is None else
+            "%.2f" % row["pages_per_sec"],
+            format_eta(row["eta"]), row["update_time"] or "-"))
+
+
+def watch(crawlids, host, port, custom, interval=5, as_json=False):
+    """
+    每隔interval秒刷新一次所有crawlid的进度，json模式下每次输出一行json
+    :param crawlids:
+    :param host:
+    :param port:
+    :param custom:
+    :param interval:
+    :param as_json:
+    :return:
+    """
+    redis_conn = connect(host, port, custom)
+    progress = Progress()
+    try:
+        while True:
+            now = time.time()
+            rows = [progress.update(crawlid, data, now) for crawlid, data in
+                    zip(crawlids, fetch(redis_conn, crawlids, custom))]
+            if as_json:
+                print(json.dumps({"time": now, "crawlids": rows}))
+            else:
+                if sys.stdout.isatty():
+                    sys.stdout.write("\033[2J\033[H")
+                print(time.strftime("%Y-%m-%d %H:%M:%S"))
+                show_table(rows)
+            sys.stdout.flush()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def start(crawlid, host, port, custom, as_json=False):
+    redis_conn = connect(host, port, custom)
+    data = fetch(redis_conn, [crawlid], custom)[0]
+    if as_json:
+        print(json.dumps(Progress().update(crawlid, data)))
+        return
     format(data)
+    failed_keys = [x for x in data.keys() if fnmatch.fnmatch(x, "failed_download_*")]
     for fk in failed_keys:
-        fk = fk.decode() if isinstance(fk, bytes) else fk
         print_if = input("show the %s? y/n default n:" % fk.replace("_", " "))
         if print_if == "y":
             key_ = "%s:%s" % (fk, crawlid)
-            p = redis_conn.hgetall(key_)
-            format(p, True)
+            for url, reason in iter_failed(redis_conn, key_, custom):
+                format({url: reason}, True)
 
 
 def main():
@@ -40,11 +186,18 @@ def main():
     parser.add_argument("-p", "--port",type=int, default=6379, help="redis port")
     parser.add_argument(
         "--custom", action="store_true", help="Use custom redis or not")
+    parser.add_argument(
+        "--watch", type=float, nargs="?", const=5,
+        help="Refresh progress every n seconds, default 5. ")
+    parser.add_argument("--json", action="store_true", help="Output json. ")
     parser.add_argument("crawlids", nargs="+", help="Crawlids to check. ")
     args = parser.parse_args()
+    if args.watch:
+        return watch(args.crawlids, host=args.host, port=args.port,
+                     custom=args.custom, interval=args.watch, as_json=args.json)
     for crawlid in args.crawlids:
-        start(
-            crawlid=crawlid, host=args.host, port=args.port, custom=args.custom)
+        start(crawlid=crawlid, host=args.host, port=args.port,
+              custom=args.custom, as_json=args.json)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,185 @@
+# -*- coding:utf-8 -*-
+"""
+按域名熔断及重试预算
+熔断状态保存在redis中由所有爬虫进程共享，失败率由每个进程根据自己的滑动窗口计算。
+"""
+import time
+import random
+
+from collections import Counter, deque, defaultdict
+
+
+class SlidingWindow(object):
+    """
+    按秒分桶的滑动窗口计数
+    """
+    def __init__(self, size):
+        self.size = size
+        self.buckets = deque()
+
+    def expire(self, second):
+        while self.buckets and self.buckets[0][0] <= second - self.size:
+            self.buckets.popleft()
+
+    def add(self, field, num=1, now=None):
+        second = int(now or time.time())
+        if not self.buckets or self.buckets[-1][0] != second:
+            self.buckets.append((second, Counter()))
+        self.buckets[-1][1][field] += num
+        self.expire(second)
+
+    def sum(self, field, now=None):
+        self.expire(int(now or time.time()))
+        return sum(counter[field] for _, counter in self.buckets)
+
+    def clear(self):
+        self.buckets.clear()
+
+
+class RetryBudget(object):
+    """
+    窗口内的重试数不超过成功数的ratio倍加上min_retries，
+    目标站点大面积失败时重试不会成倍地放大请求量
+    """
+    def __init__(self, ratio, min_retries=10, window=60):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = SlidingWindow(window)
+
+    def deposit(self, now=None):
+        self.window.add("success", now=now)
+
+    def withdraw(self, now=None):
+        """
+        申请一次重试
+        :param now:
+        :return: 预算耗尽时返回False
+        """
+        if self.window.sum("retry", now) >= \
+                self.min_retries + self.ratio * self.window.sum("success", now):
+            return False
+        self.window.add("retry", now=now)
+        return True
+
+
+class CircuitBreaker(object):
+    """
+    熔断器，每个域名在redis中有三个key：
+    <prefix>:<domain>:open     存在时为熔断状态，过期时间即熔断时间
+    <prefix>:<domain>:tripped  熔断到恢复之前一直存在，open过期而tripped存在时为半开状态
+    <prefix>:<domain>:probes   半开状态下已放行的探测请求数
+    半开状态下只放行probes个探测请求，探测成功则恢复，失败则再次熔断。
+    """
+    def __init__(self, redis_conn, prefix, window=60, threshold=0.5,
+                 min_requests=20, open_time=60, probes=3, probe_timeout=30,
+                 cache_time=1):
+        self.redis_conn = redis_conn
+        self.prefix = prefix
+        self.threshold = threshold
+        self.min_requests = min_requests
+        self.open_time = open_time
+        self.probes = probes
+        self.probe_timeout = probe_timeout
+        self.cache_time = cache_time
+        self.windows = defaultdict(lambda: SlidingWindow(window))
+        # domain: (缓存过期时间, 熔断结束时间, 是否未恢复)
+        self.states = dict()
+
+    @classmethod
+    def from_settings(cls, redis_conn, prefix, settings):
+        return cls(redis_conn, prefix,
+                   window=settings.getint("CIRCUIT_BREAKER_WINDOW", 60),
+                   threshold=settings.getfloat("CIRCUIT_BREAKER_THRESHOLD", 0.5),
+                   min_requests=settings.getint(
+                       "CIRCUIT_BREAKER_MIN_REQUESTS", 20),
+                   open_time=settings.getint("CIRCUIT_BREAKER_OPEN_TIME", 60),
+                   probes=settings.getint("CIRCUIT_BREAKER_PROBES", 3),
+                   probe_timeout=settings.getint("DOWNLOAD_TIMEOUT", 30))
+
+    def key(self, domain, kind):
+        return "%s:%s:%s" % (self.prefix, domain, kind)
+
+    def state(self, domain, now):
+        """
+        从redis中读取熔断状态，缓存cache_time秒
+        :param domain:
+        :param now:
+        :return: (熔断结束时间, 是否未恢复)
+        """
+        cached = self.states.get(domain)
+        if cached and cached[0] > now:
+            return cached[1:]
+        pipe = self.redis_conn.pipeline(transaction=False)
+        pipe.pttl(self.key(domain, "open"))
+        pipe.exists(self.key(domain, "tripped"))
+        pttl, tripped = pipe.execute()
+        open_until = now + pttl / 1000 if pttl and pttl > 0 else 0
+        self.states[domain] = (now + self.cache_time, open_until, bool(tripped))
+        return open_until, bool(tripped)
+
+    def wait_time(self, domain, now=None):
+        """
+        调度器在发出请求前调用
+        :param domain:
+        :param now:
+        :return: 需要等待的秒数，为0时可以发出
+        """
+        now = now or time.time()
+        open_until, tripped = self.state(domain, now)
+        if open_until > now:
+            return open_until - now + random.uniform(0, 1)
+        if not tripped:
+            return 0
+        key = self.key(domain, "probes")
+        count = self.redis_conn.incr(key)
+        if count == 1:
+            # 探测请求丢失时，超时后放行新的探测请求
+            self.redis_conn.pexpire(key, int(self.probe_timeout * 1000))
+        if count <= self.probes:
+            return 0
+        return min(self.probe_timeout, 5) + random.uniform(0, 1)
+
+    def record(self, domain, success, now=None):
+        """
+        记录请求结果
+        :param domain:
+        :param success:
+        :param now:
+        :return: 状态发生变化时返回"tripped"或"closed"
+        """
+        now = now or time.time()
+        open_until, tripped = self.state(domain, now)
+        if open_until > now:
+            # 熔断前发出的请求
+            return
+        if tripped:
+            if success:
+                self.close(domain)
+                return "closed"
+            self.trip(domain, now)
+            return "tripped"
+        window = self.windows[domain]
+        window.add("success" if success else "failure", now=now)
+        failures = window.sum("failure", now)
+        total = failures + window.sum("success", now)
+        if total >= self.min_requests and failures >= self.threshold * total:
+            self.trip(domain, now)
+            return "tripped"
+
+    def trip(self, domain, now):
+        open_ms = int(self.open_time * 1000)
+        pipe = self.redis_conn.pipeline()
+        pipe.psetex(self.key(domain, "open"), open_ms, 1)
+        # 一直没有探测结果时，tripped过期后自动恢复
+        pipe.psetex(self.key(domain, "tripped"),
+                    open_ms + int(self.probe_timeout * 1000) * 10, 1)
+        pipe.delete(self.key(domain, "probes"))
+        pipe.execute()
+        self.windows[domain].clear()
+        self.states[domain] = (now + self.cache_time, now + self.open_time, True)
+
+    def close(self, domain):
+        self.redis_conn.delete(*[self.key(domain, kind) for kind in (
+            "open", "tripped", "probes")])
+        self.windows[domain].clear()
+        self.states.pop(domain, None)
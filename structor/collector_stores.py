@@ -0,0 +1,114 @@
+# -*- coding:utf-8 -*-
+"""
+ItemCollector状态的外部存储
+默认ItemCollector保存在request.meta中，随每个子请求被序列化进队列，
+请求树越深，队列中的元素越大。使用外部存储时meta中只保存item_collector_id，
+ItemCollector在parse_next中根据id加载，item生成后删除。
+"""
+import pickle
+
+
+class LocalCollectorStore(object):
+    """
+    保存在进程内存中，只适用于单进程抓取
+    """
+    # 是否可以在多个进程间共享
+    shared = False
+
+    def __init__(self):
+        self.collectors = dict()
+
+    @classmethod
+    def from_settings(cls, redis_conn, settings):
+        return cls()
+
+    def save(self, collector_id, item_collector):
+        self.collectors[collector_id] = item_collector
+
+    def load(self, collector_id):
+        try:
+            return self.collectors[collector_id]
+        except KeyError:
+            raise KeyError("Item collector %s not found. " % collector_id)
+
+    def delete(self, collector_id):
+        self.collectors.pop(collector_id, None)
+
+    def update(self, collector_id, func):
+        """
+        加载ItemCollector，调用func对其进行修改后保存，返回func的返回值
+        func可能被重复调用，只能合并状态，不能调用spider的方法
+        :param collector_id:
+        :param func:
+        :return:
+        """
+        item_collector = self.load(collector_id)
+        result = func(item_collector)
+        self.save(collector_id, item_collector)
+        return result
+
+
+class RedisCollectorStore(LocalCollectorStore):
+    """
+    保存在redis中，多个进程共享，超时未完成的ItemCollector会被自动清除
+    """
+    key_template = "item_collector:%s"
+    shared = True
+
+    def __init__(self, redis_conn, timeout=60 * 60 * 24, custom=False):
+        super(RedisCollectorStore, self).__init__()
+        self.redis_conn = redis_conn
+        self.timeout = timeout
+        self.custom = custom
+
+    @classmethod
+    def from_settings(cls, redis_conn, settings):
+        return cls(redis_conn,
+                   settings.getint("ITEM_COLLECTOR_TIMEOUT", 60 * 60 * 24),
+                   settings.getbool("CUSTOM_REDIS"))
+
+    def save(self, collector_id, item_collector):
+        key = self.key_template % collector_id
+        if self.custom:
+            self.redis_conn.set(key, pickle.dumps(item_collector))
+            self.redis_conn.expire(key, self.timeout)
+        else:
+            self.redis_conn.set(
+                key, pickle.dumps(item_collector), ex=self.timeout)
+
+    def load(self, collector_id):
+        data = self.redis_conn.get(self.key_template % collector_id)
+        if not data:
+            raise KeyError("Item collector %s not found. " % collector_id)
+        return pickle.loads(data)
+
+    def delete(self, collector_id):
+        self.redis_conn.delete(self.key_template % collector_id)
+
+    def update(self, collector_id, func):
+        """
+        多个进程可能同时修改同一个ItemCollector(并行收集时)，
+        使用WATCH实现乐观锁，被其它进程修改后重新加载并再次调用func，
+        所以func中只合并状态(ParallelItemCollector.merge)
+        custom_redis不支持WATCH，只能保证单进程下的正确性
+        """
+        if self.custom:
+            return super(RedisCollectorStore, self).update(collector_id, func)
+        from redis import WatchError
+        key = self.key_template % collector_id
+        with self.redis_conn.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    data = pipe.get(key)
+                    if not data:
+                        raise KeyError(
+                            "Item collector %s not found. " % collector_id)
+                    item_collector = pickle.loads(data)
+                    result = func(item_collector)
+                    pipe.multi()
+                    pipe.set(key, pickle.dumps(item_collector), ex=self.timeout)
+                    pipe.execute()
+                    return result
+                except WatchError:
+                    continue
@@ -0,0 +1,130 @@
+# -*- coding:utf-8 -*-
+"""
+响应解压
+每种编码对应一个生成器，分段输出解压后的数据，每段不超过chunk_size，
+调用者在累计大小超过上限时立即停止，压缩炸弹不会占用大量内存。
+br需要brotli(或brotlicffi)，zstd需要zstandard，没有安装时不会出现在Accept-Encoding中。
+"""
+import zlib
+
+from io import BytesIO
+
+CHUNK_SIZE = 64 * 1024
+
+
+class MaxSizeExceeded(Exception):
+    pass
+
+
+def import_brotli():
+    try:
+        import brotli
+    except ImportError:
+        import brotlicffi as brotli
+    return brotli
+
+
+def zlib_chunks(body, wbits, chunk_size=CHUNK_SIZE, members=False):
+    data = body
+    while data:
+        decompressor = zlib.decompressobj(wbits)
+        while True:
+            chunk = decompressor.decompress(data, chunk_size)
+            data = decompressor.unconsumed_tail
+            if chunk:
+                yield chunk
+            # 输入已经用完且没有待输出的数据，数据不完整时输出已解压的部分
+            if decompressor.eof or not data and len(chunk) < chunk_size:
+                break
+        # gzip可以由多个member拼接而成(之后可能有填充的\0)，deflate流之后的数据忽略
+        if members and decompressor.eof:
+            data = decompressor.unused_data.lstrip(b"\0")
+        else:
+            data = b""
+
+
+def gzip_chunks(body, chunk_size=CHUNK_SIZE):
+    return zlib_chunks(body, 16 + zlib.MAX_WBITS, chunk_size, True)
+
+
+def deflate_chunks(body, chunk_size=CHUNK_SIZE):
+    # 有些服务器返回不带zlib头的raw deflate，根据头部的校验判断
+    if len(body) > 1 and body[0] & 0x0f == 8 and \
+            (body[0] << 8 | body[1]) % 31 == 0:
+        wbits = zlib.MAX_WBITS
+    else:
+        wbits = -zlib.MAX_WBITS
+    return zlib_chunks(body, wbits, chunk_size)
+
+
+def brotli_chunks(body, chunk_size=CHUNK_SIZE):
+    decompressor = import_brotli().Decompressor()
+    if not hasattr(decompressor, "can_accept_more_data"):
+        # 旧版本不能限制每次输出的大小，只能分段输入
+        for i in range(0, len(body), 1024):
+            yield decompressor.process(body[i:i + 1024])
+        return
+    yield decompressor.process(body, output_buffer_limit=chunk_size)
+    while True:
+        chunk = decompressor.process(b"", output_buffer_limit=chunk_size)
+        if not chunk and decompressor.can_accept_more_data():
+            break
+        yield chunk
+
+
+def zstd_chunks(body, chunk_size=CHUNK_SIZE):
+    import zstandard
+    reader = zstandard.ZstdDecompressor().stream_reader(
+        BytesIO(body), read_across_frames=True)
+    while True:
+        chunk = reader.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+DECODERS = {
+    b"gzip": gzip_chunks,
+    b"x-gzip": gzip_chunks,
+    b"deflate": deflate_chunks,
+    b"br": brotli_chunks,
+    b"zstd": zstd_chunks,
+}
+
+
+def accepted_encodings():
+    """
+    返回可以解压的编码，br和zstd只在安装了相应的库时支持
+    :return:
+    """
+    encodings = [b"gzip", b"deflate"]
+    try:
+        import_brotli()
+        encodings.append(b"br")
+    except ImportError:
+        pass
+    try:
+        import zstandard
+        encodings.append(b"zstd")
+    except ImportError:
+        pass
+    return encodings
+
+
+def decompress(body, encoding, max_size=0, chunk_size=CHUNK_SIZE):
+    """
+    解压body
+    :param body:
+    :param encoding: DECODERS中的编码
+    :param max_size: 解压后的大小上限，为0时不限制
+    :param chunk_size:
+    :return:
+    """
+    size, chunks = 0, []
+    for chunk in DECODERS[encoding](body, chunk_size):
+        size += len(chunk)
+        if max_size and size > max_size:
+            raise MaxSizeExceeded(
+                "Decompressed size exceeds %s bytes. " % max_size)
+        chunks.append(chunk)
+    return b"".join(chunks)
@@ -0,0 +1,80 @@
+# -*- coding:utf-8 -*-
+"""
+自适应并发
+AIMDLimiter根据请求结果调整并发数：请求正常时加性增加(每limit个成功的请求增加1)，
+出现过载信号(429/503等重试状态码、超时等异常、延迟超过基准延迟的tolerance倍)时乘性减少，
+同一批在途请求的过载信号在一个平滑延迟内只减少一次。
+"""
+import time
+
+from collections import deque
+
+from twisted.internet import defer
+
+
+class AIMDLimiter(object):
+
+    def __init__(self, min_limit=1, max_limit=16, initial=None, backoff=0.7,
+                 tolerance=2.0, alpha=0.2):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial or min_limit, min_limit), max_limit))
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.alpha = alpha
+        # 延迟的指数加权平均值
+        self.smoothed = None
+        # 无负载时的延迟估计，取平滑延迟的最小值，并缓慢向当前值靠拢，
+        # 以适应站点整体变慢的情况
+        self.baseline = None
+        self.last_decrease = 0
+
+    @property
+    def concurrency(self):
+        return int(self.limit)
+
+    def on_success(self, latency, now=None):
+        if self.smoothed is None:
+            self.smoothed = latency
+        else:
+            self.smoothed += (latency - self.smoothed) * self.alpha
+        if self.baseline is None or self.smoothed < self.baseline:
+            self.baseline = self.smoothed
+        else:
+            self.baseline += (self.smoothed - self.baseline) * 0.01
+        if self.smoothed > self.baseline * self.tolerance:
+            return self.on_overload(now)
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def on_overload(self, now=None):
+        now = now or time.time()
+        if now - self.last_decrease < max(self.smoothed or 0, 1):
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+
+
+class ConcurrencyGate(object):
+    """
+    最多允许limiter.concurrency个请求同时进行，
+    acquire返回的Deferred在获得许可后触发，不会阻塞reactor
+    """
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.in_flight = 0
+        self.waiting = deque()
+
+    def acquire(self):
+        d = defer.Deferred()
+        self.waiting.append(d)
+        self.wake()
+        return d
+
+    def release(self):
+        self.in_flight -= 1
+        self.wake()
+
+    def wake(self):
+        while self.waiting and self.in_flight < self.limiter.concurrency:
+            self.in_flight += 1
+            self.waiting.popleft().callback(None)
@@ -1,5 +1,7 @@
 # -*- coding:utf-8 -*-
-import copy
+import time
+import json
+
 from http import cookiejar
 
 from scrapy.http.cookies import WrappedRequest, WrappedResponse
@@ -8,14 +10,9 @@ from scrapy.http.cookies import WrappedRequest, WrappedResponse
 class CookieJar(cookiejar.LWPCookieJar):
 
     def clear_except(self, *names):
-        for domain, domain_cookie in copy.deepcopy(self._cookies).items():
-            for path, path_cookie in domain_cookie.items():
-                for name, value in path_cookie.items():
-                    if name in names:
-                        continue
-                    else:
-                        del self._cookies[domain][path][name]
-                                        
+        for cookie in [c for c in self if c.name not in names]:
+            self.clear(cookie.domain, cookie.path, cookie.name)
+
     def make_cookies(self, response, request):
         if not isinstance(request, WrappedRequest):
             request = WrappedRequest(request)
@@ -32,4 +29,107 @@ class CookieJar(cookiejar.LWPCookieJar):
         return super(CookieJar, self).extract_cookies(wrsp, wreq)
     
     def add_cookie_header(self, request):
-        super(CookieJar, self).add_cookie_header(WrappedRequest(request))
\ No newline at end of file
+        super(CookieJar, self).add_cookie_header(WrappedRequest(request))
+
+
+class RedisCookieJar(CookieJar):
+    """
+    保存在redis hash中由所有爬虫进程共享的CookieJar，field为"domain;path;name"，
+    一个进程登录后得到的cookie其它进程也可以使用。
+    读取使用本地缓存，超过cache_time秒后重新从redis加载；修改先记录在本地，
+    由flush批量写回redis，尚未写回的修改在重新加载时保留。
+    多个进程修改同一个cookie时以最后写回的为准。
+    """
+    ATTRS = ("version", "name", "value", "port", "port_specified", "domain",
+             "domain_specified", "domain_initial_dot", "path", "path_specified",
+             "secure", "expires", "discard", "comment", "comment_url", "rfc2109")
+
+    def __init__(self, redis_conn, key, cache_time=5, expire=86400):
+        super(RedisCookieJar, self).__init__()
+        self.redis_conn = redis_conn
+        self.key = key
+        self.cache_time = cache_time
+        self.expire = expire
+        self.loaded = 0
+        # field: cookie，删除的cookie为None
+        self.changes = dict()
+
+    @staticmethod
+    def field(domain, path, name):
+        return "%s;%s;%s" % (domain, path, name)
+
+    @classmethod
+    def dumps(cls, cookie):
+        data = {attr: getattr(cookie, attr) for attr in cls.ATTRS}
+        data["rest"] = cookie._rest
+        return json.dumps(data)
+
+    @staticmethod
+    def loads(value):
+        if isinstance(value, bytes):
+            value = value.decode()
+        return cookiejar.Cookie(**json.loads(value))
+
+    def set_cookie(self, cookie):
+        super(RedisCookieJar, self).set_cookie(cookie)
+        self.changes[self.field(cookie.domain, cookie.path, cookie.name)] = cookie
+
+    def clear(self, domain=None, path=None, name=None):
+        if name is not None:
+            removed = [(domain, path, name)]
+        else:
+            removed = [(c.domain, c.path, c.name) for c in self
+                       if domain in (None, c.domain) and path in (None, c.path)]
+        super(RedisCookieJar, self).clear(domain, path, name)
+        for args in removed:
+            self.changes[self.field(*args)] = None
+
+    def refresh(self, now=None):
+        """
+        距离上次加载超过cache_time秒时从redis重新加载
+        :param now:
+        :return:
+        """
+        now = now or time.time()
+        if now - self.loaded < self.cache_time:
+            return
+        self.loaded = now
+        cookies = dict()
+        for field, value in self.redis_conn.hgetall(self.key).items():
+            try:
+                cookies[field.decode() if isinstance(field, bytes) else field] = \
+                    self.loads(value)
+            except (ValueError, TypeError):
+                continue
+        cookies.update(self.changes)
+        with self._cookies_lock:
+            self._cookies = dict()
+            for cookie in cookies.values():
+                if cookie is not None:
+                    super(RedisCookieJar, self).set_cookie(cookie)
+
+    def flush(self):
+        """
+        将本地的修改写回redis
+        :return: 写回的cookie数
+        """
+        if not self.changes:
+            return 0
+        changes, self.changes = self.changes, dict()
+        updated = {field: self.dumps(cookie)
+                   for field, cookie in changes.items() if cookie is not None}
+        deleted = [field for field, cookie in changes.items() if cookie is None]
+        try:
+            pipe = self.redis_conn.pipeline(transaction=False)
+            if updated:
+                pipe.hmset(self.key, updated)
+            if deleted:
+                pipe.hdel(self.key, *deleted)
+            pipe.expire(self.key, self.expire)
+            pipe.execute()
+        except Exception:
+            # 写回失败时保留修改，下次重试
+            changes.update(self.changes)
+            self.changes = changes
+            raise
+        return len(changes)
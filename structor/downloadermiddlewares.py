@@ -1,24 +1,35 @@
 import time
-import random
 import base64
+import random
 import traceback
 
-from scrapy.exceptions import IgnoreRequest
-from scrapy.http import HtmlResponse, Response
+from collections import deque, OrderedDict
+
+from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import HtmlResponse, Response, TextResponse
+from scrapy.responsetypes import responsetypes
 from scrapy.utils.response import response_status_message
+from scrapy.utils.httpobj import urlparse_cached
 from scrapy.core.downloader.handlers.http11 import TunnelError
 from scrapy.downloadermiddlewares.redirect import RedirectMiddleware
 
 from twisted.web.client import ResponseFailed
-from twisted.internet import defer
+from twisted.internet import defer, reactor, task
 from twisted.internet.error import TimeoutError, DNSLookupError, \
     ConnectionRefusedError, ConnectionDone, ConnectError, \
     ConnectionLost, TCPTimedOutError
 
-from toolkit import parse_cookie
+from toolkit import parse_cookie, cache_prop
 
 from .utils import Logger
-from .custom_cookie_jar import CookieJar
+from .proxy_pool import ProxyPool
+from .custom_cookie_jar import CookieJar, RedisCookieJar
+from .compression import DECODERS, MaxSizeExceeded, accepted_encodings, \
+    decompress
+from .rate_limiters import TokenBucket, RedisTokenBucket
+from .circuit_breaker import CircuitBreaker, RetryBudget
+from .concurrency_limiters import AIMDLimiter, ConcurrencyGate
 
 
 class DownloaderBaseMiddleware(object):
@@ -34,32 +45,263 @@ class DownloaderBaseMiddleware(object):
 
 
 class SpeedLimitedMiddleware(DownloaderBaseMiddleware):
-
+    """
+    使用令牌桶限速，需要等待时返回一个延迟触发的Deferred，不会阻塞reactor。
+    SPEED为整体速度，SPEED_PER_DOMAIN及SPEED_PER_PROXY为每个域名及每个代理的速度，
+    单位均为n/min，为0时不限制。SPEED_SHARED开启后整体速度由所有爬虫进程共享。
+    按代理限速时需要放在ProxyMiddleware后面。
+    """
     def __init__(self, settings):
         super().__init__(settings)
-        self.request_interval = 60 / self.settings.getint("SPEED", 60)
-        self.last_acs_time = time.time()
+        self.speed = self.settings.getint("SPEED", 60)
+        self.domain_speed = self.settings.getint("SPEED_PER_DOMAIN", 0)
+        self.proxy_speed = self.settings.getint("SPEED_PER_PROXY", 0)
+        self.burst = self.settings.getint("SPEED_BURST", 1)
+        self.shared = self.settings.getbool("SPEED_SHARED")
+        if self.shared and self.settings.getbool("CUSTOM_REDIS"):
+            self.logger.warning("SPEED_SHARED is not supported by custom redis. ")
+            self.shared = False
+        self.buckets = dict()
+
+    def get_bucket(self, key, speed, spider):
+        bucket = self.buckets.get(key)
+        if not bucket:
+            if self.shared and key == "global":
+                bucket = RedisTokenBucket(
+                    spider.redis_conn, "%s:speed" % spider.name,
+                    speed / 60, self.burst)
+            else:
+                bucket = TokenBucket(speed / 60, self.burst)
+            self.buckets[key] = bucket
+        return bucket
 
     def process_request(self, request, spider):
-        if time.time() - self.request_interval < self.last_acs_time:
-            time.sleep(self.last_acs_time - time.time() + self.request_interval)
+        delay = 0
+        if self.speed:
+            delay = self.get_bucket("global", self.speed, spider).reserve()
+        if self.domain_speed:
+            delay = max(delay, self.get_bucket(
+                "domain:%s" % urlparse_cached(request).netloc,
+                self.domain_speed, spider).reserve())
+        if self.proxy_speed and request.meta.get("proxy"):
+            delay = max(delay, self.get_bucket(
+                "proxy:%s" % request.meta["proxy"],
+                self.proxy_speed, spider).reserve())
+
+        if delay > 0:
+            self.crawler.stats.inc_value("speed_limited/delayed_count")
+            self.crawler.stats.inc_value("speed_limited/delay_time", delay)
+            return task.deferLater(reactor, delay, lambda: None)
+
+
+class CircuitBreakerMiddleware(DownloaderBaseMiddleware):
+    """
+    将每个请求的结果反馈给按域名的熔断器，失败率超过阈值时熔断，
+    熔断期间调度器不会发出该域名的请求。
+    需要看到重试之前的响应，所以要放在CustomRetryMiddleware后面(如520)
+    """
+    def __init__(self, settings):
+        super(CircuitBreakerMiddleware, self).__init__(settings)
+        self.failed_codes = set(
+            int(x) for x in settings.getlist('RETRY_HTTP_CODES'))
 
-        self.last_acs_time = time.time()
+    @cache_prop
+    def breaker(self):
+        return CircuitBreaker.from_settings(
+            self.crawler.spider.redis_conn,
+            "%s:circuit_breaker" % self.crawler.spider.name, self.settings)
 
+    def record(self, request, success):
+        domain = urlparse_cached(request).netloc
+        changed = self.breaker.record(domain, success)
+        if changed:
+            self.crawler.stats.inc_value("circuit_breaker/%s_count" % changed)
+            self.logger.warning("Circuit breaker of %s %s. ", domain, changed)
 
-class ProxyMiddleware(DownloaderBaseMiddleware):
+    def process_response(self, request, response, spider):
+        self.record(request, response.status not in self.failed_codes)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        self.record(request, False)
+
+
+class AdaptiveConcurrencyMiddleware(DownloaderBaseMiddleware):
+    """
+    按下载slot(域名)及按代理自适应地调整并发数，调整范围为
+    [ADAPTIVE_CONCURRENCY_MIN, ADAPTIVE_CONCURRENCY_MAX]。
+    域名的并发数直接修改scrapy下载器slot的concurrency，代理的并发数通过在process_request中
+    等待许可实现。需要看到代理及未经重试、重定向处理的响应，所以要放在最后(如610)。
+    注意：scrapy在调用下载中间件之前就把请求计入了CONCURRENT_REQUESTS，
+    在代理上等待许可的请求同样占用全局并发数，等待的请求占满CONCURRENT_REQUESTS时，
+    引擎不再从调度器取出请求，其它域名及代理的请求也会被饿死。
+    所以CONCURRENT_REQUESTS需要大于所有代理的并发数之和(代理数*ADAPTIVE_CONCURRENCY_MAX)，
+    等待中的请求数记录在adaptive_concurrency/max_waiting中。
+    """
+    OVERLOAD_CODES = {429, 503}
+    history_size = 100
+
+    def __init__(self, settings):
+        super(AdaptiveConcurrencyMiddleware, self).__init__(settings)
+        self.failed_codes = self.OVERLOAD_CODES | set(
+            int(x) for x in settings.getlist('RETRY_HTTP_CODES'))
+        self.min_limit = settings.getint("ADAPTIVE_CONCURRENCY_MIN", 1)
+        self.max_limit = settings.getint("ADAPTIVE_CONCURRENCY_MAX", 16)
+        self.backoff = settings.getfloat("ADAPTIVE_CONCURRENCY_BACKOFF", 0.7)
+        self.tolerance = settings.getfloat("ADAPTIVE_CONCURRENCY_TOLERANCE", 2)
+        self.limiters = dict()
+        self.gates = dict()
+        self.history = deque(maxlen=self.history_size)
+
+    def get_limiter(self, key):
+        limiter = self.limiters.get(key)
+        if not limiter:
+            # 与scrapy创建slot时使用的并发数相同
+            initial = self.settings.getint("CONCURRENT_REQUESTS_PER_IP") or \
+                self.settings.getint("CONCURRENT_REQUESTS_PER_DOMAIN", 1)
+            limiter = self.limiters[key] = AIMDLimiter(
+                self.min_limit, self.max_limit, initial,
+                self.backoff, self.tolerance)
+        return limiter
+
+    def get_gate(self, proxy):
+        gate = self.gates.get(proxy)
+        if not gate:
+            gate = self.gates[proxy] = ConcurrencyGate(
+                self.get_limiter("proxy:%s" % proxy))
+        return gate
+
+    def process_request(self, request, spider):
+        proxy = request.meta.get("proxy")
+        if proxy:
+            # 之前的请求被复制(如重定向)后没有归还的许可
+            self.release(request)
+            request.meta["adaptive_concurrency_proxy"] = proxy
+            d = self.get_gate(proxy).acquire()
+            self.crawler.stats.max_value(
+                "adaptive_concurrency/max_waiting",
+                sum(len(gate.waiting) for gate in self.gates.values()))
+            return d
+
+    def release(self, request):
+        proxy = request.meta.pop("adaptive_concurrency_proxy", None)
+        if proxy:
+            self.get_gate(proxy).release()
+        return proxy
+
+    def feedback(self, request, success):
+        """
+        根据请求结果调整该请求所属slot及代理的并发数
+        :param request:
+        :param success:
+        :return:
+        """
+        latency = request.meta.get("download_latency", 0)
+        proxy = self.release(request)
+        # 没有进入下载器的请求(如在之前的中间件中出错)没有slot
+        slot_key = request.meta.get("download_slot")
+        keys = list()
+        if slot_key is not None:
+            keys.append("slot:%s" % slot_key)
+        if proxy:
+            keys.append("proxy:%s" % proxy)
+        for key in keys:
+            limiter = self.get_limiter(key)
+            old = limiter.concurrency
+            if success:
+                limiter.on_success(latency)
+            else:
+                limiter.on_overload()
+            if limiter.concurrency != old:
+                self.changed(key, old, limiter.concurrency)
+        slot = self.crawler.engine.downloader.slots.get(slot_key)
+        if slot:
+            slot.concurrency = self.get_limiter(
+                "slot:%s" % slot_key).concurrency
+        if proxy:
+            self.get_gate(proxy).wake()
+
+    def changed(self, key, old, new):
+        stats = self.crawler.stats
+        stats.set_value("adaptive_concurrency/%s" % key, new)
+        stats.max_value("adaptive_concurrency/max/%s" % key, new)
+        stats.inc_value("adaptive_concurrency/%s_count" % (
+            "increase" if new > old else "decrease"))
+        self.history.append("%s %s %s->%s" % (
+            time.strftime("%H:%M:%S"), key, old, new))
+        stats.set_value("adaptive_concurrency/history", list(self.history))
+        self.logger.debug("Concurrency of %s changed from %s to %s. ",
+                          key, old, new)
+
+    def process_response(self, request, response, spider):
+        self.feedback(request, response.status not in self.failed_codes)
+        return response
 
+    def process_exception(self, request, exception, spider):
+        self.feedback(request, not isinstance(
+            exception, CustomRetryMiddleware.EXCEPTIONS_TO_RETRY))
+
+
+class ProxyMiddleware(DownloaderBaseMiddleware):
+    """
+    从进程内的代理池中选择代理，并将每个请求的结果及延迟反馈给代理池。
+    代理是按爬虫粘滞的，很少重新选择，所以每PROXY_REFRESH_INTERVAL秒
+    定时发布评分并重新加载代理池，而不是在选择代理时检查
+    """
     def __init__(self, settings):
         super(ProxyMiddleware, self).__init__(settings)
-        self.proxy_sets = self.settings.get("PROXY_SETS", "proxy_set").split(",")
+        self.proxy_sets = [
+            s for s in self.settings.get("PROXY_SETS", "proxy_set").split(",") if s]
+        self.failed_codes = set(
+            int(x) for x in settings.getlist('RETRY_HTTP_CODES'))
+        self.refresh_task = None
 
-    def choice(self):
+    @classmethod
+    def from_crawler(cls, crawler):
+        obj = super(ProxyMiddleware, cls).from_crawler(crawler)
+        crawler.signals.connect(obj.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(obj.spider_closed, signal=signals.spider_closed)
+        return obj
+
+    @cache_prop
+    def pool(self):
+        return ProxyPool.from_settings(self.crawler.spider.redis_conn, self.settings)
+
+    def spider_opened(self):
+        if not self.proxy_sets:
+            return
+        self.refresh_task = task.LoopingCall(self.refresh)
+        self.refresh_task.start(self.pool.refresh_interval, now=True)
+
+    def spider_closed(self):
+        if self.refresh_task and self.refresh_task.running:
+            self.refresh_task.stop()
+            try:
+                self.pool.publish()
+            except Exception:
+                self.logger.error("Publish proxy scores error: %s", traceback.format_exc())
+
+    def refresh(self):
+        # 出错时不能抛出，否则LoopingCall会停止
         try:
-            proxy = self.crawler.spider.redis_conn.srandmember(
-                random.choice(self.proxy_sets))
+            self.pool.refresh()
         except Exception:
-            proxy = None
-        return proxy and proxy.decode()
+            self.logger.error("Refresh proxy pool error: %s", traceback.format_exc())
+
+    def choice(self):
+        return self.pool.choice()
+
+    def report(self, request, spider, success):
+        proxy = request.meta.get("proxy")
+        if not proxy or not self.proxy_sets:
+            return
+        proxy = proxy.replace("http://", "", 1)
+        if self.pool.report(
+                proxy, success, request.meta.get("download_latency")):
+            self.logger.debug("Quarantine proxy %s. ", proxy)
+            self.crawler.stats.inc_value("proxy/quarantined_count")
+            if spider.proxy == proxy:
+                spider.change_proxy = True
 
     def process_request(self, request, spider):
         if self.settings.get("CHANGE_PROXY", False) or spider.change_proxy:
@@ -78,6 +320,13 @@ class ProxyMiddleware(DownloaderBaseMiddleware):
                 request.headers['Proxy-Authorization'] =\
                     b'Basic ' + encoded_user_pass
 
+    def process_response(self, request, response, spider):
+        self.report(request, spider, response.status not in self.failed_codes)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        self.report(request, spider, False)
+
 
 class CustomUserAgentMiddleware(DownloaderBaseMiddleware):
     def __init__(self, settings, user_agent='Scrapy'):
@@ -135,7 +384,8 @@ class CustomRedirectMiddleware(DownloaderBaseMiddleware, RedirectMiddleware):
                     request.url, redirects, reason)
             spider.crawler.stats.set_failed_download(
                 request.meta['crawlid'], request.url, reason)
-            if "item_collector" in request.meta:
+            if "item_collector" in request.meta or \
+                    "item_collector_id" in request.meta:
                 return HtmlResponse(
                     request.url, body=b"<html></html>",
                     status=999, request=request)
@@ -145,15 +395,41 @@ class CustomRedirectMiddleware(DownloaderBaseMiddleware, RedirectMiddleware):
 
 
 class CustomCookiesMiddleware(DownloaderBaseMiddleware):
-
+    """
+    每个meta["cookiejar"]使用独立的CookieJar，开启COOKIES_PER_DOMAIN后没有指定cookiejar的请求
+    按注册域名(使用tldextract的公共后缀列表)划分，最多保留COOKIES_MAX_JARS个，
+    超出时淘汰最久未使用的。COOKIES只解析一次，作为默认值添加到每个请求中(dont_update_cookies除外)，
+    CookieJar中有同名cookie时以CookieJar中的为准。
+    开启COOKIES_SHARED后CookieJar保存在redis中，由所有爬虫进程共享，
+    本地缓存COOKIES_SHARED_CACHE_TIME秒，修改每隔COOKIES_SHARED_FLUSH_INTERVAL秒批量写回。
+    """
     def __init__(self, settings):
         super(CustomCookiesMiddleware, self).__init__(settings)
-        self.jar = CookieJar()
+        self.max_jars = settings.getint("COOKIES_MAX_JARS", 1000)
+        self.jars = OrderedDict()
+        self.static_cookies = list(
+            parse_cookie(settings.get("COOKIES", "")).items())
+        self.extract = None
+        if settings.getbool("COOKIES_PER_DOMAIN"):
+            try:
+                import tldextract
+                # 只使用tldextract自带的公共后缀列表，不访问网络
+                self.extract = tldextract.TLDExtract(suffix_list_urls=())
+            except ImportError:
+                self.logger.warning(
+                    "COOKIES_PER_DOMAIN requires tldextract, all hosts share one cookie jar. ")
+        self.shared = settings.getbool("COOKIES_SHARED")
+        if self.shared and settings.getbool("CUSTOM_REDIS"):
+            self.logger.warning("COOKIES_SHARED is not supported by custom redis. ")
+            self.shared = False
+        self.flush_task = None
 
     @classmethod
     def from_crawler(cls, crawler):
         cls.crawler = crawler
-        return cls(crawler.settings)
+        obj = cls(crawler.settings)
+        crawler.signals.connect(obj.spider_closed, signal=signals.spider_closed)
+        return obj
 
     @staticmethod
     def _format_cookie(cookie):
@@ -178,30 +454,165 @@ class CustomCookiesMiddleware(DownloaderBaseMiddleware):
         response = Response(request.url, headers=headers)
         return jar.make_cookies(response, request)
 
+    def jar_key(self, request):
+        """
+        没有指定cookiejar时所有请求共用一个CookieJar，
+        开启COOKIES_PER_DOMAIN时按注册域名划分，子域名之间可以共享cookie
+        :param request:
+        :return:
+        """
+        if "cookiejar" in request.meta:
+            return request.meta["cookiejar"]
+        if not self.extract:
+            return "default"
+        host = urlparse_cached(request).hostname or ""
+        # IP地址等没有注册域名时按主机划分
+        return self.extract(host).registered_domain or host
+
+    def create_jar(self, key):
+        if not self.shared:
+            return CookieJar()
+        if not self.flush_task:
+            self.flush_task = task.LoopingCall(self.flush)
+            self.flush_task.start(self.settings.getfloat(
+                "COOKIES_SHARED_FLUSH_INTERVAL", 1), now=False)
+        spider = self.crawler.spider
+        return RedisCookieJar(
+            spider.redis_conn, "%s:cookies:%s" % (spider.name, key),
+            self.settings.getfloat("COOKIES_SHARED_CACHE_TIME", 5),
+            self.settings.getint("COOKIES_SHARED_EXPIRE", 86400))
+
+    def get_jar(self, request):
+        key = self.jar_key(request)
+        jar = self.jars.get(key)
+        if jar is not None:
+            self.jars.move_to_end(key)
+            if self.shared:
+                jar.refresh()
+            return jar
+        jar = self.jars[key] = self.create_jar(key)
+        if len(self.jars) > self.max_jars:
+            self.flush_jar(self.jars.popitem(last=False)[1])
+        if self.shared:
+            jar.refresh()
+        return jar
+
+    def add_static_cookies(self, request):
+        if not self.static_cookies or request.meta.get("dont_update_cookies"):
+            return
+        header = request.headers.get("Cookie", b"").decode()
+        names = set(c.split("=", 1)[0].strip() for c in header.split(";"))
+        cookies = ["%s=%s" % (k, v) for k, v in self.static_cookies
+                   if k not in names]
+        if cookies:
+            request.headers["Cookie"] = "; ".join(
+                ([header] if header else []) + cookies)
+
+    def flush_jar(self, jar):
+        if not self.shared:
+            return
+        try:
+            count = jar.flush()
+            if count:
+                self.crawler.stats.inc_value("cookies/shared_flushed", count)
+        except Exception as e:
+            self.logger.error("Flush cookies to %s failed: %s", jar.key, e)
+
+    def flush(self):
+        for jar in list(self.jars.values()):
+            self.flush_jar(jar)
+
+    def spider_closed(self):
+        if self.flush_task and self.flush_task.running:
+            self.flush_task.stop()
+        self.flush()
+
     def process_request(self, request, spider):
-        cookies = self.settings.get("COOKIES", "")
-        if not request.meta.get("dont_update_cookies"):
-            request.cookies.update(parse_cookie(cookies))
-        # 从request.cookies中获取cookies
-        cookies = self._get_request_cookies(self.jar, request)
-
-        # 将cookie放到jar中
-        for cookie in cookies:
-            self.jar.set_cookie_if_ok(cookie, request)
+        jar = self.get_jar(request)
+        # 从request.cookies中获取cookies并放到jar中
+        if request.cookies:
+            for cookie in self._get_request_cookies(jar, request):
+                jar.set_cookie_if_ok(cookie, request)
         # 将reuqest.headers中的cookie删除
         request.headers.pop('Cookie', None)
         # 将jar中的cookie重新应用到request中
-        self.jar.add_cookie_header(request)
+        jar.add_cookie_header(request)
+        self.add_static_cookies(request)
         cl = request.headers.getlist('Cookie')
         if cl:
             self.logger.debug("Sending cookie %s to %s", cl, request)
 
     def process_response(self, request, response, spider):
-        self.jar.extract_cookies(response, request)
+        self.get_jar(request).extract_cookies(response, request)
+        return response
+
+
+class HttpCompressionMiddleware(DownloaderBaseMiddleware):
+    """
+    替代scrapy的HttpCompressionMiddleware，安装了brotli、zstandard时同时支持br和zstd。
+    分段解压，解压后超过DECOMPRESSION_MAX_SIZE时丢弃响应。
+    按域名统计解压前后的字节数：compression/<domain>/compressed_bytes及decompressed_bytes
+    """
+    def __init__(self, settings):
+        if not settings.getbool("COMPRESSION_ENABLED"):
+            raise NotConfigured
+        super(HttpCompressionMiddleware, self).__init__(settings)
+        self.max_size = settings.getint("DECOMPRESSION_MAX_SIZE", 0)
+        self.accept_encoding = b", ".join(accepted_encodings())
+
+    def process_request(self, request, spider):
+        request.headers.setdefault("Accept-Encoding", self.accept_encoding)
+
+    def process_response(self, request, response, spider):
+        if request.method == "HEAD" or not response.body:
+            return response
+        encodings = [e.strip().lower()
+                     for value in response.headers.getlist("Content-Encoding")
+                     for e in value.split(b",") if e.strip()]
+        body = response.body
+        # 多个编码按相反的顺序解压，遇到不支持的编码时停止
+        while encodings and encodings[-1] in DECODERS:
+            try:
+                body = decompress(body, encodings[-1], self.max_size)
+            except MaxSizeExceeded as e:
+                self.crawler.stats.inc_value("compression/max_size_count")
+                self.logger.warning("Ignore %s: %s", request.url, e)
+                raise IgnoreRequest(str(e))
+            except Exception as e:
+                self.crawler.stats.inc_value("compression/failed_count")
+                self.logger.error("Failed to decompress %s(%s): %s",
+                                  request.url, encodings[-1], e)
+                raise IgnoreRequest(str(e))
+            self.crawler.stats.inc_value(
+                "compression/%s_count" % encodings.pop().decode())
+        if body is response.body:
+            return response
+
+        stats = self.crawler.stats
+        domain = urlparse_cached(request).netloc
+        for key, size in (("compressed_bytes", len(response.body)),
+                          ("decompressed_bytes", len(body))):
+            stats.inc_value("compression/%s" % key, size)
+            stats.inc_value("compression/%s/%s" % (domain, key), size)
+        respcls = responsetypes.from_args(
+            headers=response.headers, url=response.url, body=body)
+        kwargs = dict(cls=respcls, body=body)
+        if issubclass(respcls, TextResponse):
+            kwargs["encoding"] = None
+        response = response.replace(**kwargs)
+        if encodings:
+            response.headers["Content-Encoding"] = b", ".join(encodings)
+        else:
+            del response.headers["Content-Encoding"]
         return response
 
 
 class CustomRetryMiddleware(DownloaderBaseMiddleware):
+    """
+    开启RETRY_BACKOFF_BASE后重试的请求带上meta["retry_delay"]，
+    由调度器放入延迟队列，到期后才会回到请求队列中，延迟按重试次数指数增长并加入随机抖动。
+    开启RETRY_BUDGET_RATIO后每个域名的重试数不超过成功数的一定比例，超出时放弃重试。
+    """
     EXCEPTIONS_TO_RETRY = (defer.TimeoutError, TimeoutError, DNSLookupError,
                            ConnectionRefusedError, ConnectionDone, ConnectError,
                            ConnectionLost, TCPTimedOutError, ResponseFailed,
@@ -213,11 +624,52 @@ class CustomRetryMiddleware(DownloaderBaseMiddleware):
             int(x) for x in settings.getlist('RETRY_HTTP_CODES'))
         self.priority_adjust = settings.getint('RETRY_PRIORITY_ADJUST')
         super(CustomRetryMiddleware, self).__init__(settings)
+        self.backoff_base = settings.getfloat("RETRY_BACKOFF_BASE", 0)
+        self.backoff_max = settings.getfloat("RETRY_BACKOFF_MAX", 300)
+        if self.backoff_base and settings.getbool("CUSTOM_REDIS"):
+            self.logger.info(
+                "RETRY_BACKOFF_BASE is not supported by custom redis. ")
+            self.backoff_base = 0
+        self.budget_ratio = settings.getfloat("RETRY_BUDGET_RATIO", 0)
+        self.budgets = dict()
+
+    def get_budget(self, request):
+        domain = urlparse_cached(request).netloc
+        budget = self.budgets.get(domain)
+        if not budget:
+            budget = self.budgets[domain] = RetryBudget(
+                self.budget_ratio, self.settings.getint("RETRY_BUDGET_MIN", 10),
+                self.settings.getint("RETRY_BUDGET_WINDOW", 60))
+        return budget
+
+    def get_delay(self, retries):
+        """
+        第retries次重试的延迟，在指数退避时间的[1/2, 1]之间随机选取，
+        避免同时失败的请求同时重试
+        :param retries:
+        :return:
+        """
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (retries - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    @staticmethod
+    def bucket(retries):
+        """
+        重试次数直方图的区间：1, 2, 3-4, 5-8, 9-16...
+        :param retries:
+        :return:
+        """
+        if retries <= 2:
+            return str(retries)
+        upper = 1 << (retries - 1).bit_length()
+        return "%s-%s" % (upper // 2 + 1, upper)
 
     def process_response(self, request, response, spider):
         if response.status in self.retry_http_codes:
             reason = response_status_message(response.status)
             return self._retry(request, reason, spider) or response
+        if self.budget_ratio:
+            self.get_budget(request).deposit()
         return response
 
     def process_exception(self, request, exception, spider):
@@ -232,24 +684,39 @@ class CustomRetryMiddleware(DownloaderBaseMiddleware):
     def _retry(self, request, reason, spider):
         spider.change_proxy = True
         retries = request.meta.get('retry_times', 0) + 1
+        exhausted = retries <= self.max_retry_times and self.budget_ratio \
+            and not self.get_budget(request).withdraw()
+        if exhausted:
+            self.crawler.stats.inc_value("retry/budget_exhausted")
+            reason = "Retry budget exhausted, %s" % reason
 
-        if retries <= self.max_retry_times:
+        if retries <= self.max_retry_times and not exhausted:
             retryreq = request.copy()
             retryreq.meta['retry_times'] = retries
+            retryreq.dont_filter = True
             retryreq.meta['priority'] = \
                 retryreq.meta['priority'] + self.settings.get(
                     "REDIRECT_PRIORITY_ADJUST")
+            stats = self.crawler.stats
+            stats.inc_value("retry/count")
+            stats.inc_value("retry/histogram/%s" % self.bucket(retries))
+            if self.backoff_base:
+                retryreq.meta["retry_delay"] = self.get_delay(retries)
+                stats.inc_value("retry/delay_time", retryreq.meta["retry_delay"])
             self.logger.debug("Reason: %s of %s times for %s to retry. ",
                     reason, retries, request.url)
             return retryreq
         else:
+            if not exhausted:
+                self.crawler.stats.inc_value("retry/max_reached")
             if request.callback == spider.parse:
                 spider.crawler.stats.inc_total_pages(request.meta['crawlid'])
             self.logger.error("Gave up retrying %s (failed %d times): %s",
                     request.url, retries, reason)
             spider.crawler.stats.set_failed_download(
                 request.meta['crawlid'], request.url, reason)
-            if "item_collector" in request.meta:
+            if "item_collector" in request.meta or \
+                    "item_collector_id" in request.meta:
                 return HtmlResponse(
                     request.url, body=b"<html></html>",
                     status=999, request=request)
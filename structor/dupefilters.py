@@ -0,0 +1,218 @@
+# -*- coding:utf-8 -*-
+"""
+基于redis的去重过滤器
+SetFilter使用集合精确去重，BloomFilter使用可扩展布隆过滤器，内存占用与
+容量及误判率相关而与url数量无关，一次lua脚本调用即可原子地完成检查和添加。
+"""
+import hashlib
+
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.misc import load_object
+
+
+def filter_keys(crawlid):
+    """
+    返回一个crawlid下所有去重过滤器可能使用的key，用于清理
+    :param crawlid:
+    :return:
+    """
+    keys = list()
+    for kind in ("model", "requests"):
+        key = "crawlid:%s:%s" % (crawlid, kind)
+        keys.extend((key, "%s:bloom" % key, "%s:bloom:count" % key))
+    return keys
+
+
+def load_dupefilter(redis_conn, settings, logger):
+    """
+    创建DUPLICATE_FILTER_CLASS指定的去重过滤器，当前redis不支持时使用SetFilter
+    :param redis_conn:
+    :param settings:
+    :param logger:
+    :return:
+    """
+    try:
+        return load_object(settings.get(
+            "DUPLICATE_FILTER_CLASS", "structor.dupefilters.SetFilter")
+        ).from_settings(redis_conn, settings)
+    except NotConfigured as e:
+        logger.warning("%s Fall back to SetFilter. " % e)
+        return SetFilter.from_settings(redis_conn, settings)
+
+
+class SetFilter(object):
+    """
+    使用集合精确去重，SADD的返回值即可表明元素是否已经存在，
+    所以一批元素的检查和添加可以在一次pipeline中完成
+    """
+    def __init__(self, redis_conn, timeout=60 * 60, custom=False):
+        self.redis_conn = redis_conn
+        self.timeout = timeout
+        self.custom = custom
+
+    @classmethod
+    def from_settings(cls, redis_conn, settings):
+        return cls(redis_conn, settings.getint("DUPLICATE_TIMEOUT", 60 * 60),
+                   settings.getbool("CUSTOM_REDIS"))
+
+    def exists_or_add(self, key, value):
+        """
+        value已存在时返回True，否则将其添加到key中并返回False
+        :param key:
+        :param value:
+        :return:
+        """
+        if self.custom:
+            if self.redis_conn.sismember(key, value):
+                return True
+            else:
+                self.redis_conn.sadd(key, value)
+                self.redis_conn.expire(key, self.timeout)
+                return False
+        return self.exists_or_add_many(key, [value])[0]
+
+    def exists_or_add_many(self, key, values):
+        """
+        批量检查并添加，返回与values一一对应的是否已存在的列表
+        :param key:
+        :param values:
+        :return:
+        """
+        if not values:
+            return []
+        if self.custom:
+            return [self.exists_or_add(key, value) for value in values]
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for value in values:
+            pipe.sadd(key, value)
+        pipe.expire(key, self.timeout)
+        return [not added for added in pipe.execute()[:-1]]
+
+
+class BloomFilter(SetFilter):
+    """
+    可扩展布隆过滤器，所有层共用一个bitmap，每层依次占用一段连续的位。
+    第i层(从0开始)容量为capacity * 2^i，误判率为error_rate * 0.8 * 0.5^(i+1)，
+    各层之和为error_rate的80%，为层数较少及每层位数较少时的偏差预留余量，
+    所以整体误判率不会超过error_rate。当最后一层存满后自动增加新的一层。
+    每层的k个位置使用增强双重哈希计算，m与h2有公因子时普通双重哈希的位置会循环重复。
+    各层已添加的元素数量保存在key:bloom:count中。
+    目前在custom_redis中不支持
+    """
+    # KEYS: bitmap key, count key
+    # ARGV: capacity, error_rate, timeout, 之后是每个元素的h1, h2
+    # 返回与元素一一对应的是否已存在(1/0)的列表
+    CHECK_AND_SET_SCRIPT = """
+local bits_key, count_key = KEYS[1], KEYS[2]
+local capacity, error_rate = tonumber(ARGV[1]), tonumber(ARGV[2])
+local timeout = tonumber(ARGV[3])
+local ln2 = math.log(2)
+
+local function shape(layer)
+    local n = capacity * 2 ^ layer
+    local p = error_rate * 0.8 * 0.5 ^ (layer + 1)
+    local m = math.ceil(-n * math.log(p) / (ln2 * ln2))
+    return n, m, math.ceil(m / n * ln2)
+end
+
+-- 增强双重哈希: x += y, y += i
+local function positions(h1, h2, m, k)
+    local result = {}
+    local x, y = h1 % m, h2 % m
+    for i = 1, k do
+        result[i] = x
+        x = (x + y) % m
+        y = (y + i) % m
+    end
+    return result
+end
+
+local function check_and_set(h1, h2)
+    local layers = redis.call('HLEN', count_key)
+    if layers == 0 then
+        layers = 1
+    end
+    local base = 0
+    local last_base = 0
+    for layer = 0, layers - 1 do
+        local _, m, k = shape(layer)
+        local found = true
+        for _, position in ipairs(positions(h1, h2, m, k)) do
+            if redis.call('GETBIT', bits_key, base + position) == 0 then
+                found = false
+                break
+            end
+        end
+        if found then
+            return 1
+        end
+        last_base = base
+        base = base + m
+    end
+
+    local layer = layers - 1
+    local n, m, k = shape(layer)
+    if (tonumber(redis.call('HGET', count_key, layer)) or 0) >= n then
+        layer = layers
+        last_base = base
+        n, m, k = shape(layer)
+    end
+    for _, position in ipairs(positions(h1, h2, m, k)) do
+        redis.call('SETBIT', bits_key, last_base + position, 1)
+    end
+    redis.call('HINCRBY', count_key, layer, 1)
+    return 0
+end
+
+local result = {}
+for i = 4, #ARGV, 2 do
+    result[#result + 1] = check_and_set(tonumber(ARGV[i]), tonumber(ARGV[i + 1]))
+end
+if timeout > 0 then
+    redis.call('EXPIRE', bits_key, timeout)
+    redis.call('EXPIRE', count_key, timeout)
+end
+return result
+"""
+
+    def __init__(self, redis_conn, timeout=60 * 60,
+                 capacity=1000000, error_rate=0.001):
+        super(BloomFilter, self).__init__(redis_conn, timeout)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.script = self.redis_conn.register_script(
+            self.CHECK_AND_SET_SCRIPT)
+
+    @classmethod
+    def from_settings(cls, redis_conn, settings):
+        if settings.getbool("CUSTOM_REDIS"):
+            raise NotConfigured("BloomFilter is not supported by custom redis. ")
+        return cls(redis_conn,
+                   settings.getint("DUPLICATE_TIMEOUT", 60 * 60),
+                   settings.getint("BLOOM_CAPACITY", 1000000),
+                   settings.getfloat("BLOOM_ERROR_RATE", 0.001))
+
+    @staticmethod
+    def hashes(value):
+        """
+        生成两个32位的哈希值，各层的k个位置由h1, h2以增强双重哈希计算得出
+        :param value:
+        :return:
+        """
+        if not isinstance(value, bytes):
+            value = str(value).encode("utf-8")
+        digest = hashlib.md5(value).digest()
+        return int.from_bytes(digest[:4], "big"), \
+            int.from_bytes(digest[4:8], "big")
+
+    def exists_or_add(self, key, value):
+        return self.exists_or_add_many(key, [value])[0]
+
+    def exists_or_add_many(self, key, values):
+        if not values:
+            return []
+        args = [self.capacity, self.error_rate, self.timeout]
+        for value in values:
+            args.extend(self.hashes(value))
+        return [bool(found) for found in self.script(
+            keys=["%s:bloom" % key, "%s:bloom:count" % key], args=args)]
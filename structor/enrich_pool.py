@@ -0,0 +1,124 @@
+# -*- coding:utf-8 -*-
+"""
+将parse_item/parse_next放到进程池中执行
+xpath计算、html处理及load_item等cpu密集的操作都在enrich函数中，默认全部运行在reactor线程中，
+一个进程最多只能使用一个核，并且会阻塞下载。开启ENRICH_PROCESSES后，
+response(及其携带的ItemCollector)被发送到子进程中执行回调，生成的请求及item再返回给reactor。
+子进程中有独立的crawler及spider，统计信息(不使用缓冲)及外部存储直接写入redis，
+所以需要使用共享的ItemCollector外部存储(RedisCollectorStore)。
+"""
+import time
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+
+from scrapy.crawler import Crawler
+from scrapy.settings import Settings
+from twisted.internet import defer, reactor, threads
+from twisted.python.failure import Failure
+
+from .custom_request import Request
+
+_spider = None
+
+
+def init_worker(spidercls, settings):
+    """
+    子进程初始化，创建子进程中使用的spider
+    :param spidercls:
+    :param settings:
+    :return:
+    """
+    global _spider
+    settings = Settings(settings)
+    # 子进程中直接执行回调
+    settings.set("ENRICH_PROCESSES", 0, priority="cmdline")
+    # 子进程中的crawler不会调用open_spider，缓冲的统计信息不会定时写入
+    settings.set("STATS_BUFFERED", False, priority="cmdline")
+    crawler = Crawler(spidercls, settings)
+    crawler.spider = crawler._create_spider()
+    if settings.getbool("CUSTOM_REDIS"):
+        from custom_redis.client import Redis
+    else:
+        from redis import Redis
+    crawler.spider.set_redis(
+        Redis(settings.get("REDIS_HOST"), settings.getint("REDIS_PORT")))
+    _spider = crawler.spider
+
+
+def run_callback(callback, response):
+    """
+    在子进程中执行回调，返回其生成的请求及item和所用的cpu时间
+    :param callback:
+    :param response:
+    :return:
+    """
+    start = time.process_time()
+    results = list(getattr(_spider, callback)(response) or [])
+    return results, time.process_time() - start
+
+
+class EnrichPool(object):
+
+    def __init__(self, crawler, processes):
+        self.crawler = crawler
+        self.processes = processes
+        self.executor = None
+        self.futures = set()
+
+    def run(self, callback, response):
+        """
+        将response发送到子进程中执行callback，返回Deferred，
+        scrapy会等待其完成后处理生成的请求及item
+        :param callback: 回调的名称
+        :param response:
+        :return:
+        """
+        if not self.executor:
+            self.executor = ProcessPoolExecutor(
+                self.processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker,
+                initargs=(self.crawler.spidercls,
+                          self.crawler.settings.copy_to_dict()))
+        # 绑定方法无法在进程间传递，只传递名称，scrapy的Request不接受字符串回调
+        request = response.request.replace(
+            cls=Request,
+            callback=callback,
+            errback=getattr(response.request.errback, "__name__",
+                            response.request.errback))
+        future = self.executor.submit(
+            run_callback, callback, response.replace(request=request))
+        self.futures.add(future)
+        d = defer.Deferred()
+        future.add_done_callback(
+            lambda f: reactor.callFromThread(self.fire, d, callback, f))
+        return d
+
+    def fire(self, d, callback, future):
+        self.futures.discard(future)
+        if future.cancelled():
+            d.errback(Failure(defer.CancelledError()))
+            return
+        exception = future.exception()
+        if exception:
+            d.errback(Failure(exception))
+            return
+        results, cpu_time = future.result()
+        stats = self.crawler.stats
+        stats.inc_value("enrich_pool/%s/count" % callback)
+        stats.inc_value("enrich_pool/%s/cpu_time" % callback, cpu_time)
+        stats.max_value("enrich_pool/%s/max_cpu_time" % callback, cpu_time)
+        d.callback(results)
+
+    def close(self):
+        """
+        取消尚未开始的回调，在线程中等待子进程退出，不阻塞reactor
+        :return: Deferred
+        """
+        if not self.executor:
+            return
+        for future in list(self.futures):
+            future.cancel()
+        executor, self.executor = self.executor, None
+        return threads.deferToThread(executor.shutdown)
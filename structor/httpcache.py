@@ -0,0 +1,170 @@
+# -*- coding:utf-8 -*-
+"""
+本地http缓存
+开发时反复调试enrich_*不需要重新下载，HTTPCACHE_REPLAY_ONLY开启后只使用缓存的响应。
+每个爬虫一个sqlite文件，responses表以请求指纹为key，
+响应体压缩后按内容的sha1保存在bodies表中，相同的响应体只保存一份。
+读取使用mmap，访问时间批量写入，压缩后的总大小超过HTTPCACHE_MAX_SIZE时淘汰最久未访问的响应。
+"""
+import os
+import time
+import zlib
+import sqlite3
+import hashlib
+
+from scrapy.http import Headers
+from scrapy.exceptions import IgnoreRequest
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+from scrapy.utils.request import request_fingerprint
+from w3lib.http import headers_raw_to_dict, headers_dict_to_raw
+
+from .utils import Logger
+
+
+class SqliteCacheStorage(object):
+    """
+    HTTPCACHE_STORAGE = 'structor.httpcache.SqliteCacheStorage'
+    HTTPCACHE_EXPIRATION_SECS: 缓存的过期时间，为0时不过期
+    HTTPCACHE_MAX_SIZE: 压缩后的响应体总大小(bytes)，为0时不限制
+    HTTPCACHE_REPLAY_ONLY: 只使用缓存，忽略过期时间，不在缓存中的请求直接丢弃，
+    不经过缓存的请求(dont_cache或HTTPCACHE_IGNORE_SCHEMES)除外
+    """
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    fingerprint TEXT PRIMARY KEY, url TEXT, status INTEGER, headers BLOB,
+    digest TEXT, stored REAL, accessed REAL);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed);
+CREATE INDEX IF NOT EXISTS responses_digest ON responses(digest);
+CREATE TABLE IF NOT EXISTS bodies (
+    digest TEXT PRIMARY KEY, size INTEGER, data BLOB);
+"""
+
+    def __init__(self, settings):
+        self.cachedir = data_path(settings['HTTPCACHE_DIR'], createdir=True)
+        self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+        self.max_size = settings.getint('HTTPCACHE_MAX_SIZE', 0)
+        self.replay_only = settings.getbool('HTTPCACHE_REPLAY_ONLY')
+        self.commit_interval = 1
+        self.db = None
+        self.size = 0
+        self.pending = 0
+        self.last_commit = 0
+        # fingerprint: 访问时间，提交时批量写入
+        self.accessed = dict()
+
+    def open_spider(self, spider):
+        self.logger = Logger.from_crawler(spider.crawler)
+        path = os.path.join(self.cachedir, "%s.db" % spider.name)
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA mmap_size=%d" % (256 * 1024 * 1024))
+        self.db.executescript(self.SCHEMA)
+        self.size = self.total_size()
+        self.logger.debug("Using sqlite cache storage in %s(%s bytes). ",
+                          path, self.size)
+        self.evict()
+
+    def close_spider(self, spider):
+        self.commit()
+        self.evict()
+        self.db.close()
+
+    def total_size(self):
+        return self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM bodies").fetchone()[0]
+
+    def commit(self):
+        self.db.executemany(
+            "UPDATE responses SET accessed = ? WHERE fingerprint = ?",
+            [(t, fp) for fp, t in self.accessed.items()])
+        self.accessed.clear()
+        self.db.commit()
+        self.pending = 0
+        self.last_commit = time.time()
+
+    def maybe_commit(self, now):
+        if self.pending >= 100 or now - self.last_commit > self.commit_interval:
+            self.commit()
+            if self.max_size and self.size > self.max_size:
+                self.evict()
+
+    def evict(self, now=None):
+        """
+        删除过期的响应，总大小超过max_size时删除最久未访问的响应直到低于max_size的90%
+        :param now:
+        :return: 删除的响应数
+        """
+        now = now or time.time()
+        deleted = 0
+        if self.expiration_secs and not self.replay_only:
+            deleted += self.db.execute(
+                "DELETE FROM responses WHERE stored < ?",
+                (now - self.expiration_secs,)).rowcount
+            self.delete_orphans()
+        self.size = self.total_size()
+        while self.max_size and self.size > self.max_size * 0.9:
+            rows = self.db.execute(
+                "SELECT r.fingerprint, b.size FROM responses r "
+                "JOIN bodies b ON r.digest = b.digest "
+                "ORDER BY r.accessed LIMIT 1000").fetchall()
+            if not rows:
+                break
+            # 响应体可能被多个响应共用，按释放的大小估算，不足时继续下一轮
+            excess, fingerprints = self.size - self.max_size * 0.9, []
+            for fingerprint, size in rows:
+                fingerprints.append((fingerprint,))
+                excess -= size
+                if excess <= 0:
+                    break
+            self.db.executemany(
+                "DELETE FROM responses WHERE fingerprint = ?", fingerprints)
+            deleted += len(fingerprints)
+            self.delete_orphans()
+            self.size = self.total_size()
+        self.db.commit()
+        if deleted:
+            self.logger.debug("%s cached responses evicted. ", deleted)
+        return deleted
+
+    def delete_orphans(self):
+        self.db.execute("DELETE FROM bodies WHERE digest NOT IN "
+                        "(SELECT digest FROM responses)")
+
+    def retrieve_response(self, spider, request):
+        fingerprint = request_fingerprint(request)
+        row = self.db.execute(
+            "SELECT r.url, r.status, r.headers, r.stored, b.data "
+            "FROM responses r JOIN bodies b ON r.digest = b.digest "
+            "WHERE r.fingerprint = ?", (fingerprint,)).fetchone()
+        now = time.time()
+        if row is None or not self.replay_only and \
+                0 < self.expiration_secs < now - row[3]:
+            if self.replay_only:
+                raise IgnoreRequest("Not in cache: %s" % request)
+            return
+        url, status, headers, _, data = row
+        self.accessed[fingerprint] = now
+        self.maybe_commit(now)
+        headers = Headers(headers_raw_to_dict(headers))
+        body = zlib.decompress(data)
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, headers=headers, status=status, body=body)
+
+    def store_response(self, spider, request, response):
+        now = time.time()
+        digest = hashlib.sha1(response.body).hexdigest()
+        if not self.db.execute("SELECT 1 FROM bodies WHERE digest = ?",
+                               (digest,)).fetchone():
+            data = zlib.compress(response.body)
+            self.db.execute("INSERT OR IGNORE INTO bodies VALUES (?, ?, ?)",
+                            (digest, len(data), sqlite3.Binary(data)))
+            self.size += len(data)
+        self.db.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (request_fingerprint(request), response.url, response.status,
+             sqlite3.Binary(headers_dict_to_raw(response.headers)),
+             digest, now, now))
+        self.pending += 1
+        self.maybe_commit(now)
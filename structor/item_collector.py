@@ -20,6 +20,9 @@ class Node(object):
         self.parent = parent
         self.children = list()
         self.enriched = False
+        # 并行模式下使用，节点在ItemCollector中的id及未完成的子节点数
+        self.node_id = None
+        self.pending = 0
         # 与父节点共用item_loader的节点不会在完成时生成item。
         if self.parent and self.parent.item_loader == item_loader:
             self.do_not_load = True
@@ -55,21 +58,29 @@ class Node(object):
         :return:
         """
         if self.req_meta:
-            meta = response.request.meta.copy()
-            self.req_meta.pop("callback", None)
-            self.req_meta.pop("errback", None)
-            custom_meta = self.req_meta.pop("meta", {})
-            meta["priority"] += 1
-            meta.update(custom_meta)
-            kw = copy.deepcopy(self.req_meta)
-            self.req_meta.clear()
-            return Request(
-                meta=meta, callback="parse_next", errback="errback", **kw), self
+            return self.make_request(response), self
         else:
             if self.children:
                 return self.children.pop().dispatch(response)
         return None if self.do_not_load else self.item_loader.load_item(), self
 
+    def make_request(self, response):
+        """
+        使用req_meta组建请求，使用后清空req_meta
+        :param response:
+        :return:
+        """
+        meta = response.request.meta.copy()
+        self.req_meta.pop("callback", None)
+        self.req_meta.pop("errback", None)
+        custom_meta = self.req_meta.pop("meta", {})
+        meta["priority"] += 1
+        meta.update(custom_meta)
+        kw = copy.deepcopy(self.req_meta)
+        self.req_meta.clear()
+        return Request(
+            meta=meta, callback="parse_next", errback="errback", **kw)
+
     def __str__(self):
         return "<Node prop_name: {}, item_loader: {}, enricher: {} >" .format(
             self.prop_name, self.item_loader, self.enricher)
@@ -116,6 +127,154 @@ class ItemCollector(object):
         return req_or_item
 
 
+def merge_values(item_loader, before, after):
+    """
+    将after相对于before新增的值追加到item_loader中，被替换的字段直接覆盖
+    :param item_loader:
+    :param before: enrich之前item_loader的值
+    :param after: enrich之后的item_loader
+    :return:
+    """
+    for field, values in after._values.items():
+        old = before.get(field, [])
+        if values[:len(old)] == old:
+            item_loader._values[field].extend(values[len(old):])
+        else:
+            item_loader._values[field] = list(values)
+
+
+class ParallelItemCollector(ItemCollector):
+    """
+    并行的ItemCollector:
+    一个节点被enrich后，同时发出其全部子节点的请求，每个请求的meta中
+    记录其对应节点的id。子节点的响应到达后可以以任意顺序被收集，
+    子节点(及其子树)完成时将生成的item赋值给父节点的item_loader，
+    当一个节点的子节点全部完成时该节点完成，根节点完成时返回item。
+    由于各个子请求需要共享同一个ItemCollector，所以必须配合外部存储使用。
+    收集分为enrich和merge两步，enrich调用spider的方法，只执行一次，
+    merge只合并状态，外部存储并发修改冲突时可以在最新的副本上重复执行。
+    """
+
+    def __init__(self, root):
+        super(ParallelItemCollector, self).__init__(root)
+        self.nodes = dict()
+        self.next_id = 0
+        self.request_count = 1
+        # 已发出还未收集的请求数，为0时ItemCollector可以被删除
+        self.outstanding = 0
+        # 某个分支失败后不再收集，只等待其余分支返回
+        self.failed = False
+        self.register(root)
+
+    def register(self, node):
+        node.node_id = self.next_id
+        self.nodes[node.node_id] = node
+        self.next_id += 1
+
+    def collect(self, response, spider):
+        """
+        收集当前响应对应的节点，返回新产生的请求列表，或只包含item的列表
+        :param response:
+        :param spider:
+        :return:
+        """
+        return self.merge(self.enrich(response, spider))
+
+    def enrich(self, response, spider):
+        """
+        调用当前响应对应节点的enrich方法，只修改该节点的item_loader，
+        返回的结果可以合并到其它副本中
+        :param response:
+        :param spider:
+        :return: (节点id, enrich之前item_loader的值, item_loader, 子节点, 子节点的请求)
+        """
+        if self.failed:
+            return None
+        node_id = response.request.meta.get("item_collector_node")
+        node = self.nodes[self.root.node_id if node_id is None else node_id]
+        before = {k: list(v) for k, v in node.item_loader._values.items()}
+        children = getattr(spider, node.enricher)(node.item_loader, response)
+        nodes, requests = list(), list()
+        for child in children or []:
+            child = Node(*child, parent=node, spider=spider)
+            nodes.append(child)
+            requests.append(
+                child.make_request(response) if child.req_meta else None)
+        return node.node_id, before, node.item_loader, nodes, requests
+
+    def merge(self, enrichment):
+        """
+        将enrich的结果合并到当前ItemCollector中，不调用spider的方法，不修改enrichment，
+        返回新产生的请求列表，或只包含item的列表
+        :param enrichment:
+        :return:
+        """
+        if self.failed:
+            self.outstanding -= 1
+            return []
+        node_id, before, item_loader, children, requests = enrichment
+        node = self.nodes[node_id]
+        if node.parent:
+            self.outstanding -= 1
+        if node.item_loader is not item_loader:
+            merge_values(node.item_loader, before, item_loader)
+        node.enriched = True
+        new_requests = list()
+        finished = list()
+        for child, request in zip(children, requests):
+            shared = child.item_loader is item_loader
+            child = copy.copy(child)
+            child.parent, child.children = node, list()
+            if shared:
+                child.item_loader = node.item_loader
+            node.children.append(child)
+            self.register(child)
+            if request:
+                request.meta["item_collector_node"] = child.node_id
+                new_requests.append(request)
+            else:
+                # 没有请求的子节点直接完成
+                finished.append(child)
+        node.pending = len(node.children)
+        self.request_count += len(new_requests)
+        self.outstanding += len(new_requests)
+        if not node.children:
+            return self.finish(node)
+        # 最后一个子节点完成时会依次完成其父节点
+        for child in finished:
+            new_requests.extend(self.finish(child))
+        return new_requests
+
+    def fail(self):
+        """
+        一个分支失败，item不再生成，返回还未返回的分支数
+        :return:
+        """
+        self.failed = True
+        self.outstanding -= 1
+        self.nodes.clear()
+        return self.outstanding
+
+    def finish(self, node):
+        """
+        节点及其子树全部完成，根节点完成时返回[item]
+        :param node:
+        :return:
+        """
+        item = None if node.do_not_load else node.item_loader.load_item()
+        del self.nodes[node.node_id]
+        parent = node.parent
+        if not parent:
+            return [item]
+        if item is not None:
+            parent.item_loader.add_value(node.prop_name, item)
+        parent.children.remove(node)
+        parent.pending -= 1
+        if not parent.pending:
+            return self.finish(parent)
+        return []
+
+
 class RequestTree(object):
     """
     请求树的遍历方案2，由于框架使用了redis做请求持久化，
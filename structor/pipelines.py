@@ -1,11 +1,17 @@
 # -*- coding:utf-8 -*-
+import os
 import json
+import time
+import threading
 from urllib.parse import unquote
 
 from scrapy.signals import spider_closed
 from toolkit import re_search
+from twisted.internet import defer, reactor, task, threads
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
 
-from .utils import ItemEncoder, Logger
+from .utils import ItemEncoder, Logger, item_to_dict
 
 
 class BasePipeline(object):
@@ -24,37 +30,249 @@ class BasePipeline(object):
         pass
 
 
+class JsonLinesFile(object):
+    """
+    以JSON Lines格式追加写入的文件，可选gzip/zstd压缩。
+    size为已写入磁盘的字节数(压缩后)，用于按大小切分文件
+    """
+    extensions = {"": "", "gzip": ".gz", "zstd": ".zst"}
+
+    def __init__(self, path, compress=""):
+        if compress not in self.extensions:
+            raise ValueError("Unsupported compress: %s. " % compress)
+        self.path = path + self.extensions[compress]
+        self.raw = open(self.path, "ab", buffering=1024 * 1024)
+        if compress == "gzip":
+            import gzip
+            self.writer = gzip.GzipFile(fileobj=self.raw, mode="ab")
+        elif compress == "zstd":
+            import zstandard
+            self.writer = zstandard.ZstdCompressor().stream_writer(self.raw)
+        else:
+            self.writer = self.raw
+        self.items = 0
+        self.dirty = False
+
+    @property
+    def size(self):
+        return self.raw.tell()
+
+    def write(self, line):
+        self.writer.write(line)
+        self.items += 1
+        self.dirty = True
+
+    def sync(self):
+        """
+        将缓冲中的数据(及压缩器中的数据)写入磁盘
+        :return:
+        """
+        if self.writer is not self.raw:
+            self.writer.flush()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.dirty = False
+
+    def close(self):
+        self.writer.close()
+        if not self.raw.closed:
+            self.raw.close()
+
+
 class FilePipeline(BasePipeline):
+    """
+    将item以JSON Lines格式追加写入FILE_SINK_DIR下的文件中，文件按FILE_SINK_PARTITION分区，
+    超过FILE_SINK_MAX_BYTES字节或FILE_SINK_MAX_ITEMS个item后切换到新文件，
+    每FILE_SINK_FSYNC_INTERVAL毫秒fsync一次
+    """
+    def __init__(self, settings):
+        super(FilePipeline, self).__init__(settings)
+        self.directory = settings.get("FILE_SINK_DIR", "items")
+        self.partition = settings.get(
+            "FILE_SINK_PARTITION", "%(spiderid)s/%(crawlid)s")
+        self.compress = settings.get("FILE_SINK_COMPRESS", "")
+        self.max_bytes = settings.getint("FILE_SINK_MAX_BYTES", 0)
+        self.max_items = settings.getint("FILE_SINK_MAX_ITEMS", 0)
+        self.fsync_interval = settings.getint(
+            "FILE_SINK_FSYNC_INTERVAL", 1000) / 1000
+        self.files = dict()
+        self.sync_task = None
+
+    def open_spider(self, spider):
+        self.sync_task = task.LoopingCall(self.sync)
+        self.sync_task.start(self.fsync_interval, now=False)
+
+    def get_file(self, partition):
+        """
+        返回分区当前写入的文件，达到切分条件时关闭并新建一个
+        :param partition:
+        :return:
+        """
+        f = self.files.get(partition)
+        if f and (self.max_items and f.items >= self.max_items or
+                  self.max_bytes and f.size >= self.max_bytes):
+            f.close()
+            f = None
+        if not f:
+            directory = os.path.join(self.directory, partition)
+            os.makedirs(directory, exist_ok=True)
+            # 不追加到之前(如上次运行)生成的文件中
+            index = len(os.listdir(directory))
+            while os.path.exists(os.path.join(
+                    directory, "part-%05d.jsonl%s" % (
+                        index, JsonLinesFile.extensions[self.compress]))):
+                index += 1
+            f = self.files[partition] = JsonLinesFile(os.path.join(
+                directory, "part-%05d.jsonl" % index), self.compress)
+        return f
 
     def process_item(self, item, spider):
-        open("tests.json", "w").write(json.dumps(item, cls=ItemEncoder))
+        partition = self.partition % {
+            "spiderid": item.get("spiderid") or spider.name,
+            "crawlid": item.get("crawlid") or "default"}
+        self.get_file(partition).write(
+            json.dumps(item, cls=ItemEncoder).encode() + b"\n")
         return item
 
+    def sync(self):
+        for f in self.files.values():
+            if f.dirty:
+                f.sync()
+
+    def spider_closed(self):
+        if self.sync_task and self.sync_task.running:
+            self.sync_task.stop()
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
 
 class Mp3DownloadPipeline(BasePipeline):
+    """
+    在大小为MP3_DOWNLOAD_CONCURRENCY的线程池中下载，每个文件只请求一次并流式写入磁盘。
+    先写入name.part临时文件，完成后重命名，临时文件存在时使用Range请求继续下载。
+    响应中的文件名保存在name.part.name中，临时文件已经完整(416)时使用该文件名。
+    同名的文件共用临时文件，依次下载。
+    requests.Session不是线程安全的，每个线程使用自己的Session。
+    """
+    chunk_size = 1024 * 1024
 
     def __init__(self, settings):
         super(Mp3DownloadPipeline, self).__init__(settings)
         import requests
-        self.downloader = requests.Session()
+        self.session_class = requests.Session
+        self.local = threading.local()
+        self.directory = settings.get("MP3_DOWNLOAD_DIR", ".")
+        self.timeout = settings.getint("DOWNLOAD_TIMEOUT", 30)
+        self.pool = ThreadPool(
+            0, settings.getint("MP3_DOWNLOAD_CONCURRENCY", 4), "mp3_download")
+        self.in_flight = 0
+        self.locks = dict()
+        self.downloading = set()
 
-    def download(self, url, name):
-        resp = self.downloader.get(url, stream=True)
-        filename = unquote(re_search(
+    def open_spider(self, spider):
+        self.pool.start()
+
+    @property
+    def session(self):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = self.session_class()
+        return session
+
+    @staticmethod
+    def get_filename(resp, name):
+        return os.path.basename(unquote(re_search(
             r'filename="(.*?)"(?:;|$)',
-            resp.headers.get("Content-Disposition", ""))) or name
-        with open(filename, "wb") as f:
-            for chunk in self.downloader.get(
-                    url, stream=True).iter_content(chunk_size=1024):
-                f.write(chunk)
+            resp.headers.get("Content-Disposition", "")))) or name
+
+    def download(self, url, name):
+        """
+        在线程池中执行，返回下载的字节数及所用时间
+        :param url:
+        :param name: 响应中没有提供文件名时使用的文件名
+        :return:
+        """
+        start = time.time()
+        os.makedirs(self.directory, exist_ok=True)
+        part = os.path.join(self.directory, name + ".part")
+        name_file = part + ".name"
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {"Range": "bytes=%s-" % offset} if offset else {}
+        downloaded = 0
+        with self.session.get(url, stream=True, headers=headers,
+                              timeout=self.timeout) as resp:
+            # 416说明临时文件已经是完整的，响应中没有文件名
+            if resp.status_code == 416:
+                filename = name
+                if os.path.exists(name_file):
+                    with open(name_file, encoding="utf-8") as f:
+                        filename = f.read() or name
+            else:
+                resp.raise_for_status()
+                filename = self.get_filename(resp, name)
+                with open(name_file, "w", encoding="utf-8") as f:
+                    f.write(filename)
+                # 服务器不支持Range时重新下载
+                mode = "ab" if resp.status_code == 206 else "wb"
+                with open(part, mode) as f:
+                    for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                        f.write(chunk)
+                        downloaded += len(chunk)
+        os.replace(part, os.path.join(self.directory, filename))
+        if os.path.exists(name_file):
+            os.remove(name_file)
+        return downloaded, time.time() - start
 
     def process_item(self, item, spider):
-        self.download(item["source_url"], "%s.mp3"%item["name"])
-        return item
+        self.in_flight += 1
+        self.crawler.stats.set_value("mp3/in_flight", self.in_flight)
+        self.crawler.stats.max_value("mp3/max_in_flight", self.in_flight)
+        name = "%s.mp3" % item["name"]
+        lock = self.locks.setdefault(name, defer.DeferredLock())
+        d = lock.run(threads.deferToThreadPool, reactor, self.pool,
+                     self.download, item["source_url"], name)
+        self.downloading.add(d)
+        d.addBoth(self.release, d, name)
+        d.addBoth(self.downloaded)
+        d.addCallback(lambda _: item)
+        return d
 
+    def release(self, result, d, name):
+        self.downloading.discard(d)
+        lock = self.locks.get(name)
+        if lock and not lock.locked and not lock.waiting:
+            del self.locks[name]
+        return result
 
-class MongoPipeline(BasePipeline):
+    def downloaded(self, result):
+        self.in_flight -= 1
+        stats = self.crawler.stats
+        stats.set_value("mp3/in_flight", self.in_flight)
+        if isinstance(result, Failure):
+            stats.inc_value("mp3/failed_count")
+            return result
+        size, cost = result
+        stats.inc_value("mp3/file_count")
+        stats.inc_value("mp3/bytes", size)
+        stats.inc_value("mp3/download_time", cost)
+        stats.set_value("mp3/bytes_per_sec", int(
+            stats.get_value("mp3/bytes") /
+            max(stats.get_value("mp3/download_time"), 0.001)))
 
+    def spider_closed(self):
+        # 等待下载完成后再停止线程池，停止时会join线程，不能阻塞reactor
+        return defer.DeferredList(
+            list(self.downloading)).addCallback(lambda _: self.pool.stop())
+
+
+class MongoPipeline(BasePipeline):
+    """
+    批量写入mongodb，item先缓存起来，每MONGO_BATCH_SIZE个或每MONGO_FLUSH_INTERVAL毫秒
+    在线程池中使用无序的insert_many(设置了MONGO_UPSERT_KEY时使用bulk_write upsert)写入一次，
+    process_item返回的Deferred在其所在的批次写入完成后触发，
+    被拒绝的文档以WriteError失败，计入mongo/failed_count而不是mongo/item_count。
+    """
     def __init__(self, settings):
         super(MongoPipeline, self).__init__(settings)
         import pymongo
@@ -62,7 +280,103 @@ class MongoPipeline(BasePipeline):
             settings.get("MONGO_HOST"),
             settings.get("MONGO_PORT"))[settings.get("MONGO_DB")]
         self.col = self.db[settings.get("MONGO_TABLE")]
+        self.batch_size = settings.getint("MONGO_BATCH_SIZE", 100)
+        self.flush_interval = settings.getint("MONGO_FLUSH_INTERVAL", 1000) / 1000
+        self.upsert_key = settings.get("MONGO_UPSERT_KEY")
+        self.docs = list()
+        self.waiters = list()
+        self.writing = set()
+        self.flush_task = None
+
+    def open_spider(self, spider):
+        self.flush_task = task.LoopingCall(self.flush)
+        self.flush_task.start(self.flush_interval, now=False)
+
+    def write(self, docs):
+        """
+        在线程池中执行，返回写入所用的时间、写入成功的文档数及写入失败的文档
+        :param docs:
+        :return: (time, count, {文档在docs中的序号: writeError})
+        """
+        from pymongo import ReplaceOne
+        from pymongo.errors import BulkWriteError
+        start = time.time()
+        count, errors = len(docs), dict()
+        try:
+            if self.upsert_key:
+                self.col.bulk_write(
+                    [ReplaceOne({self.upsert_key: doc.get(self.upsert_key)},
+                                doc, upsert=True) for doc in docs],
+                    ordered=False)
+            else:
+                self.col.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # 无序写入时其它文档不受影响，比如重复的_id
+            details = e.details
+            count = sum(details.get(key, 0)
+                        for key in ("nInserted", "nUpserted", "nMatched"))
+            errors = {error["index"]: error
+                      for error in details.get("writeErrors", [])}
+            self.logger.error("Mongo bulk write errors: %s",
+                              list(errors.values())[:3])
+        return time.time() - start, count, errors
+
+    def flush(self):
+        if not self.docs:
+            return
+        docs, waiters = self.docs, self.waiters
+        self.docs, self.waiters = list(), list()
+        d = threads.deferToThread(self.write, docs)
+        self.writing.add(d)
+        d.addBoth(self.written, d, waiters)
+        return d
+
+    def written(self, result, d, waiters):
+        from pymongo.errors import WriteError
+        self.writing.discard(d)
+        if isinstance(result, Failure):
+            self.logger.error("Mongo write error: %s", result.getErrorMessage())
+            for waiter, _ in waiters:
+                waiter.errback(result)
+            return
+        cost, count, errors = result
+        stats = self.crawler.stats
+        stats.inc_value("mongo/batch_count")
+        stats.inc_value("mongo/item_count", count)
+        if errors:
+            stats.inc_value("mongo/failed_count", len(errors))
+        stats.inc_value("mongo/write_time", cost)
+        stats.max_value("mongo/max_write_latency", cost)
+        # 被拒绝的文档对应的item以WriteError失败
+        for index, (waiter, item) in enumerate(waiters):
+            if index in errors:
+                error = errors[index]
+                waiter.errback(WriteError(
+                    error.get("errmsg"), error.get("code"), error))
+            else:
+                waiter.callback(item)
 
     def process_item(self, item, spider):
-        self.col.insert(json.loads(json.dumps(item, cls=ItemEncoder)))
-        return item
\ No newline at end of file
+        d = defer.Deferred()
+        self.docs.append(item_to_dict(item))
+        self.waiters.append((d, item))
+        if len(self.docs) >= self.batch_size:
+            self.flush()
+        return d
+
+    def spider_closed(self):
+        if self.flush_task and self.flush_task.running:
+            self.flush_task.stop()
+        self.flush()
+        return defer.DeferredList(
+            list(self.writing)).addCallback(lambda _: self.log_latency())
+
+    def log_latency(self):
+        stats = self.crawler.stats
+        batches = stats.get_value("mongo/batch_count")
+        if batches:
+            self.logger.info(
+                "Mongo wrote %s items in %s batches, avg latency %.3fs, max %.3fs. ",
+                stats.get_value("mongo/item_count"), batches,
+                stats.get_value("mongo/write_time") / batches,
+                stats.get_value("mongo/max_write_latency"))
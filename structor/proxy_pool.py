@@ -0,0 +1,146 @@
+# -*- coding:utf-8 -*-
+"""
+进程内的代理池
+由ProxyMiddleware每PROXY_REFRESH_INTERVAL秒从PROXY_SETS中加载代理，
+记录每个代理的成功率、延迟(指数加权移动平均)及连续失败次数，
+按健康程度加权随机选择代理，连续失败过多的代理会被隔离一段时间。
+各代理的评分会定期发布到redis中，其它爬虫进程加载时以此作为尚未使用过的代理的初始评分，
+隔离状态也会被同步，所以所有进程会逐渐集中使用快速稳定的代理。
+custom_redis不支持pipeline，加载时依次读取
+"""
+import json
+import time
+import random
+
+from .utils import decode
+
+
+class ProxyStat(object):
+    """
+    一个代理的健康状况
+    """
+    # 新观测值的权重
+    alpha = 0.2
+
+    def __init__(self, success_rate=1.0, latency=None, quarantined_until=0):
+        self.success_rate = success_rate
+        self.latency = latency
+        self.failures = 0
+        self.samples = 0
+        self.quarantined_until = quarantined_until
+
+    def update(self, success, latency=None):
+        self.samples += 1
+        self.success_rate += self.alpha * (int(success) - self.success_rate)
+        if latency is not None:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.alpha * (latency - self.latency)
+        self.failures = 0 if success else self.failures + 1
+
+    @property
+    def weight(self):
+        # 没有延迟数据时按1秒计算，成功率接近0的代理仍有极小的概率被选中
+        return max(self.success_rate, 0.01) / max(self.latency or 1, 0.05)
+
+    def to_json(self):
+        return json.dumps({"success_rate": round(self.success_rate, 4),
+                           "latency": self.latency and round(self.latency, 4),
+                           "quarantined_until": self.quarantined_until})
+
+
+class ProxyPool(object):
+
+    def __init__(self, redis_conn, proxy_sets, refresh_interval=60,
+                 max_failures=3, quarantine_time=300, scores_key="proxy_scores",
+                 custom=False):
+        self.redis_conn = redis_conn
+        self.proxy_sets = proxy_sets
+        self.refresh_interval = refresh_interval
+        self.max_failures = max_failures
+        self.quarantine_time = quarantine_time
+        self.scores_key = scores_key
+        self.custom = custom
+        self.stats = dict()
+
+    @classmethod
+    def from_settings(cls, redis_conn, settings):
+        return cls(redis_conn,
+                   [s for s in settings.get("PROXY_SETS", "").split(",") if s],
+                   settings.getint("PROXY_REFRESH_INTERVAL", 60),
+                   settings.getint("PROXY_MAX_FAILURES", 3),
+                   settings.getint("PROXY_QUARANTINE_TIME", 300),
+                   settings.get("PROXY_SCORES_KEY", "proxy_scores"),
+                   settings.getbool("CUSTOM_REDIS"))
+
+    def refresh(self):
+        """
+        发布本进程的评分，重新加载代理及其它进程发布的评分
+        :return:
+        """
+        self.publish()
+        if self.custom:
+            members = [self.redis_conn.smembers(proxy_set)
+                       for proxy_set in self.proxy_sets]
+            scores = self.redis_conn.hgetall(self.scores_key)
+        else:
+            pipe = self.redis_conn.pipeline(transaction=False)
+            for proxy_set in self.proxy_sets:
+                pipe.smembers(proxy_set)
+            pipe.hgetall(self.scores_key)
+            *members, scores = pipe.execute()
+        proxies = set(decode(p) for m in members for p in m or [])
+        scores = {decode(k): json.loads(decode(v))
+                  for k, v in (scores or {}).items()}
+
+        stats = dict()
+        for proxy in proxies:
+            stat = self.stats.get(proxy)
+            score = scores.get(proxy)
+            if not stat:
+                stat = ProxyStat(**score) if score else ProxyStat()
+            elif score:
+                stat.quarantined_until = max(
+                    stat.quarantined_until, score["quarantined_until"])
+            stats[proxy] = stat
+        self.stats = stats
+
+    def publish(self):
+        reported = {proxy: stat.to_json()
+                    for proxy, stat in self.stats.items() if stat.samples}
+        if reported:
+            self.redis_conn.hmset(self.scores_key, reported)
+            self.redis_conn.expire(self.scores_key, self.refresh_interval * 10)
+
+    def choice(self):
+        """
+        按健康程度加权随机选择一个未被隔离的代理，全部被隔离时选择最早解除隔离的
+        :return:
+        """
+        if not self.stats:
+            return None
+        now = time.time()
+        available = [(proxy, stat) for proxy, stat in self.stats.items()
+                     if stat.quarantined_until <= now]
+        if not available:
+            return min(self.stats.items(),
+                       key=lambda x: x[1].quarantined_until)[0]
+        proxies, stats = zip(*available)
+        return random.choices(proxies, [s.weight for s in stats])[0]
+
+    def report(self, proxy, success, latency=None):
+        """
+        记录一次请求的结果，返回该代理是否被隔离
+        :param proxy:
+        :param success:
+        :param latency:
+        :return:
+        """
+        stat = self.stats.setdefault(proxy, ProxyStat())
+        stat.update(success, latency)
+        if stat.failures >= self.max_failures:
+            stat.quarantined_until = time.time() + self.quarantine_time
+            stat.failures = 0
+            return True
+        return False
@@ -0,0 +1,115 @@
+# -*- coding:utf-8 -*-
+"""
+清理一个crawlid在redis中的全部数据。
+failed_download_*:<crawlid>记录在索引集合crawlid:<crawlid>:keys中，
+清理时不需要KEYS/SCAN，只有索引出现之前的任务才会回退到增量SCAN，
+删除使用分批UNLINK，不会长时间阻塞redis。
+"""
+import argparse
+
+from .utils import index_key, fixed_keys
+
+
+def scan_keys(redis_conn, pattern, count=1000):
+    """
+    使用SCAN增量地查找key
+    :param redis_conn:
+    :param pattern:
+    :param count: 每次SCAN检查的key数
+    :return:
+    """
+    cursor = 0
+    while True:
+        cursor, keys = redis_conn.scan(cursor, match=pattern, count=count)
+        for key in keys:
+            yield key
+        # 不同版本的redis-py返回的游标可能是bytes
+        cursor = int(cursor)
+        if not cursor:
+            break
+
+
+def unlink(redis_conn, keys, batch_size=500):
+    """
+    分批UNLINK，redis版本低于4.0时使用DEL
+    :param redis_conn:
+    :param keys:
+    :param batch_size:
+    :return: 删除的key数
+    """
+    from redis import ResponseError
+    keys, deleted, command = list(keys), 0, "UNLINK"
+    for i in range(0, len(keys), batch_size):
+        try:
+            deleted += redis_conn.execute_command(
+                command, *keys[i:i + batch_size])
+        except ResponseError:
+            if command == "DEL":
+                raise
+            command = "DEL"
+            deleted += redis_conn.execute_command(
+                command, *keys[i:i + batch_size])
+    return deleted
+
+
+def task_keys(redis_conn, crawlid):
+    """
+    返回crawlid的全部key
+    :param redis_conn:
+    :param crawlid:
+    :return:
+    """
+    key = "crawlid:%s" % crawlid
+    keys = fixed_keys(crawlid)
+    indexed = redis_conn.smembers(index_key(crawlid))
+    if indexed:
+        keys.extend(indexed)
+    # 有失败记录却没有索引，说明是索引出现之前的任务
+    elif any(field.startswith(b"failed_download_")
+             for field in redis_conn.hkeys(key)):
+        keys.extend(scan_keys(redis_conn, "failed_download_*:%s" % crawlid))
+    return keys
+
+
+def purge(redis_conn, crawlid, custom=False):
+    """
+    删除crawlid的全部key，custom_redis不支持SCAN和UNLINK，使用KEYS和DEL
+    :param redis_conn:
+    :param crawlid:
+    :param custom:
+    :return: 删除的key数
+    """
+    if custom:
+        keys = redis_conn.keys("failed_download_*:%s" % crawlid) + \
+            fixed_keys(crawlid)
+        for key in keys:
+            redis_conn.delete(key)
+        return len(keys)
+    return unlink(redis_conn, task_keys(redis_conn, crawlid))
+
+
+def start(crawlid, host, port, custom):
+    if custom:
+        from custom_redis.client import Redis
+    else:
+        from redis import Redis
+    redis_conn = Redis(host, port)
+    print("%s keys of %s purged. " % (
+        purge(redis_conn, crawlid, custom), crawlid))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="usage: %prog [options]")
+    parser.add_argument("--host", default="127.0.0.1", help="redis host")
+    parser.add_argument("-p", "--port", type=int, default=6379, help="redis port")
+    parser.add_argument(
+        "--custom", action="store_true", help="Use custom redis or not")
+    parser.add_argument("crawlids", nargs="+", help="Crawlids to purge. ")
+    args = parser.parse_args()
+    for crawlid in args.crawlids:
+        start(
+            crawlid=crawlid, host=args.host, port=args.port, custom=args.custom)
+
+
+if __name__ == "__main__":
+    main()
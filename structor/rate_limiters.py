@@ -0,0 +1,70 @@
+# -*- coding:utf-8 -*-
+"""
+令牌桶限速
+每个桶以rate(个/秒)的速度补充令牌，最多积攒burst个。reserve总是预定一个令牌，
+令牌不足时余额为负，返回需要等待的秒数，后来的请求排在前面的请求之后，
+调用者根据返回值延迟发送请求即可，不需要阻塞。
+"""
+import time
+
+
+class TokenBucket(object):
+    """
+    进程内的令牌桶
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+
+    def reserve(self):
+        """
+        预定一个令牌，返回需要等待的秒数
+        :return:
+        """
+        now = time.time()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= 1
+        return max(0, -self.tokens / self.rate)
+
+
+class RedisTokenBucket(TokenBucket):
+    """
+    保存在redis中的令牌桶，多个进程(可以在不同的主机上)共享同一个速度限制。
+    使用redis服务器的时间，各主机之间的时钟偏差不影响计算。
+    目前在custom_redis中不支持
+    """
+    # KEYS: 令牌桶的key
+    # ARGV: rate, burst
+    # 返回需要等待的毫秒数
+    RESERVE_SCRIPT = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'last')
+local tokens = tonumber(bucket[1]) or burst
+local last = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - last) * rate) - 1
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens))
+redis.call('HSET', KEYS[1], 'last', tostring(now))
+-- 令牌补满之后桶的状态与不存在时相同
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+if tokens >= 0 then
+    return 0
+end
+return math.ceil(-tokens / rate * 1000)
+"""
+
+    def __init__(self, redis_conn, key, rate, burst=1):
+        super(RedisTokenBucket, self).__init__(rate, burst)
+        self.key = key
+        self.script = redis_conn.register_script(self.RESERVE_SCRIPT)
+
+    def reserve(self):
+        return self.script(keys=[self.key], args=[self.rate, self.burst]) / 1000
@@ -1,15 +1,43 @@
 # -*- coding:utf-8 -*-
 import time
-import pickle
+
+from collections import deque
+
+from scrapy.utils.conf import build_component_list
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.misc import load_object
+from scrapy.utils.request import request_fingerprint
 
 from .utils import Logger
+from .circuit_breaker import CircuitBreaker
+from .dupefilters import load_dupefilter
 
 
 class Scheduler(object):
     spider = None
+    # 原子地从有序集合头部弹出ARGV[1]个元素及其分数，兼容不支持ZPOPMIN的redis
+    POP_SCRIPT = """
+local items = redis.call('ZRANGE', KEYS[1], 0, ARGV[1] - 1, 'WITHSCORES')
+if #items > 0 then
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, ARGV[1] - 1)
+end
+return items
+"""
+    # 将到期的延迟请求移回请求队列，延迟队列的元素为"分数|序列化的请求"
+    PROMOTE_SCRIPT = """
+local items = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, item in ipairs(items) do
+    local sep = string.find(item, '|', 1, true)
+    redis.call('ZADD', KEYS[2], tonumber(string.sub(item, 1, sep - 1)),
+               string.sub(item, sep + 1))
+    redis.call('ZREM', KEYS[1], item)
+end
+return #items
+"""
 
     def __init__(self, crawler):
         self.settings = crawler.settings
+        self.stats = crawler.stats
         self.logger = Logger.from_crawler(crawler)
         if self.settings.getbool("CUSTOM_REDIS"):
             from custom_redis.client import Redis
@@ -19,6 +47,50 @@ class Scheduler(object):
                                 self.settings.getint("REDIS_PORT"))
         self.queue_name = None
         self.queues = {}
+        self.serializer = load_object(self.settings.get(
+            "QUEUE_SERIALIZER", "structor.serializers.PickleSerializer")
+        ).from_settings(self.settings)
+        self.prefetch = self.settings.getint("SCHEDULER_PREFETCH", 0)
+        self.low_water = self.settings.getint("SCHEDULER_PREFETCH_LOW_WATER", 0)
+        # 本地预取缓冲，元素为(序列化的请求, 分数)
+        self.buffer = deque()
+        self.pop_script = None
+        self.dupefilter = None
+        self.delayed_name = None
+        self.promote_script = None
+        self.promote_interval = self.settings.getfloat(
+            "RETRY_PROMOTE_INTERVAL", 1)
+        self.last_promote = 0
+        # 本进程放入延迟队列的请求中最晚的到期时间
+        self.delayed_until = 0
+
+        if self.settings.getbool("SCHEDULER_DUPLICATE"):
+            self.dupefilter = load_dupefilter(
+                self.redis_conn, self.settings, self.logger)
+
+        if self.prefetch:
+            if self.settings.getbool("CUSTOM_REDIS"):
+                self.logger.warning(
+                    "SCHEDULER_PREFETCH is not supported by custom redis. ")
+                self.prefetch = 0
+            else:
+                self.pop_script = self.redis_conn.register_script(
+                    self.POP_SCRIPT)
+
+        if not self.settings.getbool("CUSTOM_REDIS"):
+            self.promote_script = self.redis_conn.register_script(
+                self.PROMOTE_SCRIPT)
+
+        # 开启了CircuitBreakerMiddleware时，熔断的域名的请求放入延迟队列
+        self.breaker = None
+        self.use_breaker = \
+            "structor.downloadermiddlewares.CircuitBreakerMiddleware" in \
+            build_component_list(
+                self.settings.getwithbase("DOWNLOADER_MIDDLEWARES"))
+        if self.use_breaker and not self.promote_script:
+            self.logger.warning(
+                "CircuitBreakerMiddleware is not supported by custom redis. ")
+            self.use_breaker = False
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -28,6 +100,11 @@ class Scheduler(object):
         self.spider = spider
         self.queue_name = self.settings.get(
             "TASK_QUEUE_TEMPLATE", "%s:request:queue") % spider.name
+        self.delayed_name = "%s:delayed" % self.queue_name
+        if self.use_breaker:
+            self.breaker = CircuitBreaker.from_settings(
+                self.redis_conn, "%s:circuit_breaker" % spider.name,
+                self.settings)
         spider.set_redis(self.redis_conn)
 
     def enqueue_request(self, request):
@@ -35,14 +112,99 @@ class Scheduler(object):
             request.callback, "__name__", request.callback)
         request.errback = getattr(
             request.errback, "__name__", request.errback)
+        if self.request_seen(request):
+            self.logger.debug("Crawlid: %s, url: %s filtered as duplicate. " % (
+                request.meta['crawlid'], request.url))
+            return False
+        delay = request.meta.pop("retry_delay", None)
+        if delay and self.promote_script:
+            return self.enqueue_delayed(request, delay)
         self.redis_conn.zadd(
             self.queue_name,
-            pickle.dumps(request),
+            self.serializer.dumps(request),
             -int(request.meta["priority"]))
         self.logger.debug("Crawlid: %s, url: %s added to queue. " % (
             request.meta['crawlid'], request.url))
+        return True
+
+    def enqueue_delayed(self, request, delay):
+        """
+        放入延迟队列，分数为到期时间，请求在队列中的分数保存在元素中
+        :param request:
+        :param delay:
+        :return:
+        """
+        self.redis_conn.zadd(
+            self.delayed_name,
+            b"%d|" % -int(request.meta["priority"]) +
+            self.serializer.dumps(request),
+            time.time() + delay)
+        self.delayed_until = max(self.delayed_until, time.time() + delay)
+        self.logger.debug("Crawlid: %s, url: %s delayed for %.1fs. " % (
+            request.meta['crawlid'], request.url, delay))
+        return True
+
+    def promote_delayed(self, limit=1000, force=False):
+        """
+        每promote_interval秒最多检查一次延迟队列，将到期的请求移回请求队列
+        :param limit: 每次最多移动的请求数
+        :param force: 不受promote_interval的限制
+        :return:
+        """
+        now = time.time()
+        if not self.promote_script or not force and \
+                now - self.last_promote < self.promote_interval:
+            return
+        self.last_promote = now
+        count = self.promote_script(
+            keys=[self.delayed_name, self.queue_name], args=[now, limit])
+        if count:
+            self.logger.debug("Promote %s delayed requests to %s. " % (
+                count, self.queue_name))
+
+    def request_seen(self, request):
+        """
+        对所有请求去重，item请求树中的子请求不参与去重，
+        否则该item将永远无法完成
+        :param request:
+        :return:
+        """
+        if not self.dupefilter or request.dont_filter \
+                or request.callback == "parse_next":
+            return False
+        return self.dupefilter.exists_or_add(
+            "crawlid:%s:requests" % request.meta["crawlid"],
+            request_fingerprint(request))
 
     def next_request(self):
+        self.promote_delayed()
+        # 熔断的域名的请求被放回延迟队列，每次最多跳过100个
+        for _ in range(100):
+            if self.prefetch:
+                item = self.pop_from_buffer()
+            else:
+                item = self.pop()
+            if not item:
+                return
+
+            request = self.serializer.loads(item)
+            if self.breaker:
+                delay = self.breaker.wait_time(urlparse_cached(request).netloc)
+                if delay:
+                    self.stats.inc_value("circuit_breaker/paused_count")
+                    self.enqueue_delayed(request, delay)
+                    continue
+            request.callback = request.callback and getattr(
+                self.spider, request.callback)
+            request.errback = request.errback and getattr(
+                self.spider, request.errback)
+            return request
+
+    def pop(self):
+        """
+        每次从redis中弹出一个请求
+        :return:
+        """
         self.logger.debug(
             "length of queue %s is %s" % (
                 self.queue_name, self.redis_conn.zcard(self.queue_name)))
@@ -58,20 +220,65 @@ class Scheduler(object):
             result, _ = pipe.execute()
             if result:
                 item = result[0]
+        return item
 
-        if item:
-            request = pickle.loads(item)
-            request.callback = request.callback and getattr(
-                self.spider, request.callback)
-            request.errback = request.errback and getattr(
-                self.spider, request.errback)
-            return request
+    def pop_from_buffer(self):
+        """
+        从本地缓冲中取出一个请求，缓冲中请求数不高于低水位时，
+        一次性从redis中原子地弹出一批请求补充缓冲
+        :return:
+        """
+        if len(self.buffer) <= self.low_water:
+            self.fill_buffer()
+        if self.buffer:
+            return self.buffer.popleft()[0]
+
+    def fill_buffer(self):
+        count = self.prefetch - len(self.buffer)
+        if count <= 0:
+            return
+        result = self.pop_script(keys=[self.queue_name], args=[count])
+        self.buffer.extend(
+            (result[i], float(result[i + 1])) for i in range(0, len(result), 2))
+        self.logger.debug("Prefetch %s requests from %s, %s in buffer. " % (
+            len(result) // 2, self.queue_name, len(self.buffer)))
+
+    def flush_buffer(self):
+        """
+        将缓冲中未被消费的请求按原分数放回redis
+        :return:
+        """
+        if not self.buffer:
+            return
+        args = list()
+        for item, score in self.buffer:
+            args.extend((item, score))
+        self.redis_conn.zadd(self.queue_name, *args)
+        self.logger.info("Push back %s buffered requests to %s. " % (
+            len(self.buffer), self.queue_name))
+        self.buffer.clear()
 
     def close(self, reason):
+        self.flush_buffer()
         self.logger.info("Closing Spider: %s. " % self.spider.name)
 
     def has_pending_requests(self):
-        return False
+        # 本进程等待重试的请求到期之前不能关闭爬虫
+        return self.has_delayed_requests()
+
+    def has_delayed_requests(self):
+        """
+        延迟队列由同一个spider的所有crawlid及进程共用，不能以它的大小判断，
+        只等待本进程放入的请求。全部到期后移回请求队列，再等待一次由next_request取出
+        :return:
+        """
+        if not self.delayed_until:
+            return False
+        if time.time() < self.delayed_until:
+            return True
+        self.promote_delayed(force=True)
+        self.delayed_until = 0
+        return True
 
 
 class SingleTaskScheduler(Scheduler):
@@ -81,4 +288,6 @@ class SingleTaskScheduler(Scheduler):
         self.queue_name = "%s:single:queue"
 
     def has_pending_requests(self):
-        return self.redis_conn.zcard(self.queue_name) > 0
+        return bool(self.buffer) or \
+               self.redis_conn.zcard(self.queue_name) > 0 or \
+               self.has_delayed_requests()
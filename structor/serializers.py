@@ -0,0 +1,149 @@
+# -*- coding:utf-8 -*-
+"""
+请求队列中元素的序列化方案
+每个元素的第一个字节标识其格式版本，反序列化时根据该字节选择解码方式，
+所以不同序列化方案写入的元素可以共存于同一个队列中，旧的pickle元素依然可以被读取。
+"""
+import pickle
+
+from scrapy.http.headers import Headers
+
+from .custom_request import Request
+
+# pickle protocol 2及以上版本的数据总是以该字节开头
+PICKLE_PREFIX = 0x80
+COMPACT_V1 = 0x01
+COMPACT_V1_ZSTD = 0x02
+# msgpack中用来存放无法直接编码的对象(以pickle编码)的扩展类型
+PICKLE_EXT_TYPE = 1
+
+# compact格式中请求各属性的顺序，只能在末尾追加
+FIELDS = ("url", "method", "headers", "body", "callback", "errback",
+          "cookies", "meta", "encoding", "priority", "dont_filter",
+          "flags", "cb_kwargs")
+
+
+def _default(obj):
+    import msgpack
+    return msgpack.ExtType(PICKLE_EXT_TYPE, pickle.dumps(obj))
+
+
+def _ext_hook(code, data):
+    import msgpack
+    if code == PICKLE_EXT_TYPE:
+        return pickle.loads(data)
+    return msgpack.ExtType(code, data)
+
+
+def _request_to_list(request):
+    return [
+        request.url,
+        request.method,
+        {k: v for k, v in request.headers.items()},
+        request.body,
+        request.callback,
+        request.errback,
+        request.cookies,
+        request._meta,
+        request.encoding,
+        request.priority,
+        request.dont_filter,
+        request.flags,
+        request._cb_kwargs,
+    ]
+
+
+def _list_to_request(fields):
+    # 与pickle一样绕过__init__直接还原属性，入队的url和body都已经被规范化过了
+    # 旧版本写入的元素可能缺少末尾追加的属性，使用Request的默认值
+    attrs = dict(zip(FIELDS, fields))
+    encoding = attrs.get("encoding", "utf-8")
+    request = Request.__new__(Request)
+    request._encoding = encoding
+    request.method = attrs.get("method", "GET")
+    request._url = attrs["url"]
+    request._body = attrs.get("body", b"")
+    request.priority = attrs.get("priority", 0)
+    request.callback = attrs.get("callback")
+    request.errback = attrs.get("errback")
+    request.cookies = attrs.get("cookies") or {}
+    request.headers = Headers(attrs.get("headers") or {}, encoding=encoding)
+    request.dont_filter = attrs.get("dont_filter", False)
+    request._meta = attrs.get("meta")
+    request._cb_kwargs = attrs.get("cb_kwargs")
+    request.flags = attrs.get("flags") or []
+    return request
+
+
+def loads(data):
+    """
+    根据版本字节反序列化队列中的元素
+    :param data:
+    :return:
+    """
+    version = data[0]
+    if version == PICKLE_PREFIX:
+        return pickle.loads(data)
+    payload = data[1:]
+    if version == COMPACT_V1_ZSTD:
+        import zstandard
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+    elif version != COMPACT_V1:
+        raise ValueError("Unknown queue entry version: %s. " % version)
+    import msgpack
+    return _list_to_request(
+        msgpack.unpackb(payload, raw=False, ext_hook=_ext_hook))
+
+
+class PickleSerializer(object):
+    """
+    使用pickle序列化整个请求，默认方案，不支持压缩
+    """
+    def __init__(self, compress=None):
+        if compress:
+            raise ValueError(
+                "PickleSerializer does not support compress, "
+                "use CompactSerializer. ")
+        self.compress = compress
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.get("QUEUE_COMPRESS"))
+
+    def dumps(self, request):
+        return pickle.dumps(request)
+
+    def loads(self, data):
+        return loads(data)
+
+
+class CompactSerializer(PickleSerializer):
+    """
+    使用msgpack按固定顺序序列化请求的各个属性，callback和errback只保存其名称，
+    meta中msgpack无法直接编码的对象会以pickle编码后作为扩展类型保存，
+    类型严格匹配，tuple及dict、list等的子类也以pickle保存，反序列化后类型不变。
+    还原时总是构造structor.custom_request.Request，所以其它类型的请求
+    (如FormRequest)整个使用pickle序列化。
+    compress为zstd时对序列化结果进行压缩。
+    依赖msgpack，压缩依赖zstandard
+    """
+    def __init__(self, compress=None):
+        self.compress = compress
+        import msgpack
+        self.packer = msgpack.Packer(
+            use_bin_type=True, strict_types=True, default=_default)
+        if self.compress == "zstd":
+            import zstandard
+            self.compressor = zstandard.ZstdCompressor()
+        elif self.compress:
+            raise ValueError("Unsupported compress: %s. " % self.compress)
+        else:
+            self.compressor = None
+
+    def dumps(self, request):
+        if type(request) is not Request:
+            return pickle.dumps(request)
+        payload = self.packer.pack(_request_to_list(request))
+        if self.compressor:
+            return bytes((COMPACT_V1_ZSTD, )) + self.compressor.compress(payload)
+        return bytes((COMPACT_V1, )) + payload
@@ -25,16 +25,38 @@ DEFAULT_REQUEST_HEADERS = {
     b'Accept': b'text/html,application/xhtml+xml,'
                b'application/xml;q=0.9,*/*;q=0.8',
     b'Accept-Language': b'en',
-    b'Accept-Encoding': b'deflate, gzip'
 }
 
+# 响应解压后的大小上限(bytes)，超过时丢弃响应，为0时不限制
+DECOMPRESSION_MAX_SIZE = int(
+    os.environ.get('DECOMPRESSION_MAX_SIZE', 64*1024*1024))
+
+# 本地http缓存，开发时反复调试enrich_*不需要重新下载，开启HTTPCACHE_ENABLED后生效
+# HTTPCACHE_EXPIRATION_SECS为缓存过期时间(s)，为0时不过期
+# HTTPCACHE_MAX_SIZE为压缩后的响应总大小(bytes)，超过时淘汰最久未访问的响应，为0时不限制
+# HTTPCACHE_REPLAY_ONLY开启后只使用缓存，不在缓存中的请求直接丢弃
+HTTPCACHE_ENABLED = eval(os.environ.get('HTTPCACHE_ENABLED', "False"))
+HTTPCACHE_STORAGE = 'structor.httpcache.SqliteCacheStorage'
+HTTPCACHE_EXPIRATION_SECS = int(os.environ.get('HTTPCACHE_EXPIRATION_SECS', 0))
+HTTPCACHE_MAX_SIZE = int(os.environ.get('HTTPCACHE_MAX_SIZE', 1024*1024*1024))
+HTTPCACHE_REPLAY_ONLY = eval(os.environ.get('HTTPCACHE_REPLAY_ONLY', "False"))
+
 # 测试环境下如果没有安装redis可以使用简单redis
 CUSTOM_REDIS = True
 
 # 在redis中使用多个set存放代理 格式：ip:port
-# 目前在custom_redis中不支持
 PROXY_SETS = "good_proxies"
 
+# 代理池从PROXY_SETS重新加载代理并发布代理评分的间隔(s)
+PROXY_REFRESH_INTERVAL = int(os.environ.get('PROXY_REFRESH_INTERVAL', 60))
+
+# 代理连续失败多少次后被隔离，及隔离时间(s)
+PROXY_MAX_FAILURES = int(os.environ.get('PROXY_MAX_FAILURES', 3))
+PROXY_QUARANTINE_TIME = int(os.environ.get('PROXY_QUARANTINE_TIME', 300))
+
+# 所有爬虫进程共享的代理评分
+PROXY_SCORES_KEY = os.environ.get('PROXY_SCORES_KEY', "proxy_scores")
+
 PROXY_ACCOUNT_PASSWORD = os.environ.get("PROXY_ACCOUNT_PASSWORD", '')
 
 # 每次请求都更换代理
@@ -46,10 +68,62 @@ USER_AGENT_LIST = pkgutil.get_data('structor', 'user_agents.list')
 # 重试次数
 RETRY_TIMES = int(os.environ.get('RETRY_TIMES', 100))
 
+# 重试的退避时间(s)，第n次重试延迟RETRY_BACKOFF_BASE*2^(n-1)(加入随机抖动)，最多RETRY_BACKOFF_MAX，
+# 默认为0，立即重试。等待中的请求保存在redis的有序集合中，到期后由调度器放回请求队列
+# 目前在custom_redis中不支持
+RETRY_BACKOFF_BASE = float(os.environ.get('RETRY_BACKOFF_BASE', 0))
+RETRY_BACKOFF_MAX = float(os.environ.get('RETRY_BACKOFF_MAX', 300))
+
+# 调度器每隔多少秒检查一次延迟队列
+RETRY_PROMOTE_INTERVAL = float(os.environ.get('RETRY_PROMOTE_INTERVAL', 1))
+
+# 重试预算：RETRY_BUDGET_WINDOW秒内每个域名的重试数不超过成功数*RETRY_BUDGET_RATIO+RETRY_BUDGET_MIN，
+# 超出时直接放弃重试，为0时不限制
+RETRY_BUDGET_RATIO = float(os.environ.get('RETRY_BUDGET_RATIO', 0))
+RETRY_BUDGET_MIN = int(os.environ.get('RETRY_BUDGET_MIN', 10))
+RETRY_BUDGET_WINDOW = int(os.environ.get('RETRY_BUDGET_WINDOW', 60))
+
+# 按下载slot(域名)及按代理自适应并发，需要开启structor.downloadermiddlewares.AdaptiveConcurrencyMiddleware
+# 并发数在[ADAPTIVE_CONCURRENCY_MIN, ADAPTIVE_CONCURRENCY_MAX]之间，CONCURRENT_REQUESTS_PER_DOMAIN(或CONCURRENT_REQUESTS_PER_IP)为初始值，
+# CONCURRENT_REQUESTS仍然限制总的并发数，需要相应地调大，在代理上等待许可的请求也占用CONCURRENT_REQUESTS，
+# 所以CONCURRENT_REQUESTS需要大于所有代理的并发数之和，否则等待的请求会饿死其它域名的请求
+# 出现过载信号时并发数减少为原来的ADAPTIVE_CONCURRENCY_BACKOFF倍，
+# 平滑延迟超过基准延迟的ADAPTIVE_CONCURRENCY_TOLERANCE倍时认为过载
+ADAPTIVE_CONCURRENCY_MIN = int(os.environ.get('ADAPTIVE_CONCURRENCY_MIN', 1))
+ADAPTIVE_CONCURRENCY_MAX = int(os.environ.get('ADAPTIVE_CONCURRENCY_MAX', 16))
+ADAPTIVE_CONCURRENCY_BACKOFF = float(
+    os.environ.get('ADAPTIVE_CONCURRENCY_BACKOFF', 0.7))
+ADAPTIVE_CONCURRENCY_TOLERANCE = float(
+    os.environ.get('ADAPTIVE_CONCURRENCY_TOLERANCE', 2))
+
+# 按域名熔断，需要开启structor.downloadermiddlewares.CircuitBreakerMiddleware
+# CIRCUIT_BREAKER_WINDOW秒内请求数不少于CIRCUIT_BREAKER_MIN_REQUESTS且失败率不低于
+# CIRCUIT_BREAKER_THRESHOLD时熔断CIRCUIT_BREAKER_OPEN_TIME秒，期间该域名的请求放入延迟队列，
+# 之后放行CIRCUIT_BREAKER_PROBES个探测请求，成功则恢复，熔断状态由所有爬虫进程共享
+# 目前在custom_redis中不支持
+CIRCUIT_BREAKER_WINDOW = int(os.environ.get('CIRCUIT_BREAKER_WINDOW', 60))
+CIRCUIT_BREAKER_THRESHOLD = float(os.environ.get('CIRCUIT_BREAKER_THRESHOLD', 0.5))
+CIRCUIT_BREAKER_MIN_REQUESTS = int(
+    os.environ.get('CIRCUIT_BREAKER_MIN_REQUESTS', 20))
+CIRCUIT_BREAKER_OPEN_TIME = int(os.environ.get('CIRCUIT_BREAKER_OPEN_TIME', 60))
+CIRCUIT_BREAKER_PROBES = int(os.environ.get('CIRCUIT_BREAKER_PROBES', 3))
+
 # 对于有去重需求的分类链接，去重的超时时间，默认3600s
 # 如果该分类抓取完毕需要很长时间，中间还有可能关闭，那这个时间需要长一点
 DUPLICATE_TIMEOUT = int(os.environ.get('DUPLICATE_TIMEOUT', 60*60))
 
+# 去重过滤器，默认使用集合精确去重，url数量很大时可以使用布隆过滤器
+# structor.dupefilters.BloomFilter，custom_redis不支持，会使用SetFilter
+DUPLICATE_FILTER_CLASS = os.environ.get(
+    'DUPLICATE_FILTER_CLASS', "structor.dupefilters.SetFilter")
+
+# 布隆过滤器初始容量及误判率，存满后会自动扩容
+BLOOM_CAPACITY = int(os.environ.get('BLOOM_CAPACITY', 1000000))
+BLOOM_ERROR_RATE = float(os.environ.get('BLOOM_ERROR_RATE', 0.001))
+
+# 调度器对所有请求去重(item的子请求除外)
+SCHEDULER_DUPLICATE = eval(os.environ.get('SCHEDULER_DUPLICATE', "False"))
+
 # 重定向次数
 REDIRECT_MAX_TIMES = int(os.environ.get('REDIRECT_MAX_TIMES', 20))
 
@@ -59,6 +133,19 @@ REDIRECT_PRIORITY_ADJUST = int(os.environ.get('REDIRECT_PRIORITY_ADJUST', -1))
 # 最大请求速度n/min
 SPEED = 1000
 
+# 以下限速配置需要开启structor.downloadermiddlewares.SpeedLimitedMiddleware
+# 每个域名及每个代理的最大请求速度n/min，为0时不限制
+# 按代理限速时SpeedLimitedMiddleware需要放在ProxyMiddleware后面(如595，
+# HttpCompressionMiddleware使用592)
+SPEED_PER_DOMAIN = int(os.environ.get('SPEED_PER_DOMAIN', 0))
+SPEED_PER_PROXY = int(os.environ.get('SPEED_PER_PROXY', 0))
+
+# 令牌桶最多积攒的令牌数，即空闲之后允许连续发出的请求数
+SPEED_BURST = int(os.environ.get('SPEED_BURST', 1))
+
+# SPEED由所有爬虫进程共享(令牌桶保存在redis中)，目前在custom_redis中不支持
+SPEED_SHARED = eval(os.environ.get('SPEED_SHARED', "False"))
+
 # 日志配置
 SC_LOG_LEVEL = os.environ.get('SC_LOG_LEVEL', 'DEBUG')
 SC_LOG_JSON = eval(os.environ.get('SC_LOG_JSON', "False"))
@@ -70,6 +157,22 @@ SC_LOG_BACKUPS = int(os.environ.get('SC_LOG_BACKUPS', 5))
 # 有些网站可能需要提供一些自定义的Cookie
 COOKIES = "userPrefLanguage=en_US"
 
+# 没有指定meta["cookiejar"]时是否按注册域名使用独立的cookie jar，需要安装tldextract，
+# 关闭时所有这类请求共用一个cookie jar
+COOKIES_PER_DOMAIN = eval(os.environ.get('COOKIES_PER_DOMAIN', "False"))
+
+# 每个meta["cookiejar"](或域名)使用独立的cookie jar，最多保留多少个，超出时淘汰最久未使用的
+COOKIES_MAX_JARS = int(os.environ.get('COOKIES_MAX_JARS', 1000))
+
+# cookie jar保存在redis中由所有爬虫进程共享，一个进程登录后其它进程直接使用该会话
+# 本地缓存COOKIES_SHARED_CACHE_TIME秒，修改每隔COOKIES_SHARED_FLUSH_INTERVAL秒批量写回，
+# COOKIES_SHARED_EXPIRE秒没有修改时过期，目前在custom_redis中不支持
+COOKIES_SHARED = eval(os.environ.get('COOKIES_SHARED', "False"))
+COOKIES_SHARED_CACHE_TIME = float(os.environ.get('COOKIES_SHARED_CACHE_TIME', 5))
+COOKIES_SHARED_FLUSH_INTERVAL = float(
+    os.environ.get('COOKIES_SHARED_FLUSH_INTERVAL', 1))
+COOKIES_SHARED_EXPIRE = int(os.environ.get('COOKIES_SHARED_EXPIRE', 86400))
+
 BOT_NAME = 'structor'
 
 SPIDER_MODULES = ['structor.spiders']
@@ -81,15 +184,65 @@ SCHEDULER = "structor.scheduler.Scheduler"
 
 TASK_QUEUE_TEMPLATE = "%s:request:queue"
 
+# 请求队列元素的序列化方案，可选structor.serializers.CompactSerializer(依赖msgpack)
+# 读取时会根据元素的版本字节自动选择解码方式，所以可以随时切换
+QUEUE_SERIALIZER = os.environ.get(
+    'QUEUE_SERIALIZER', "structor.serializers.PickleSerializer")
+
+# CompactSerializer使用的压缩方式，目前支持zstd(依赖zstandard)，为空时不压缩
+# PickleSerializer不支持压缩，设置后启动时报错
+QUEUE_COMPRESS = os.environ.get('QUEUE_COMPRESS', '')
+
+# 调度器每次从redis中原子地预取的请求数，为0时每次只取一个请求
+# 目前在custom_redis中不支持
+SCHEDULER_PREFETCH = int(os.environ.get('SCHEDULER_PREFETCH', 0))
+
+# 本地缓冲中的请求数不高于该值时重新预取
+SCHEDULER_PREFETCH_LOW_WATER = int(
+    os.environ.get('SCHEDULER_PREFETCH_LOW_WATER', 0))
+
 # 统计抓取信息
 STATS_CLASS = 'structor.stats_collectors.StatsCollector'
 
+# 统计信息先在内存中累积，定期在一个事务中写入redis，目前在custom_redis中不支持
+STATS_BUFFERED = eval(os.environ.get('STATS_BUFFERED', "False"))
+
+# 缓冲模式下每隔多少毫秒或每发生多少次变化写入一次redis
+STATS_FLUSH_INTERVAL = int(os.environ.get('STATS_FLUSH_INTERVAL', 1000))
+STATS_FLUSH_EVENTS = int(os.environ.get('STATS_FLUSH_EVENTS', 100))
+
 
 # Store scraped item in redis for post-processing.
 ITEM_PIPELINES = {
     # 'structor.pipelines.MongoPipeline': 100,
 }
 
+# FilePipeline输出目录及分区方式，可以使用spiderid和crawlid
+FILE_SINK_DIR = os.environ.get('FILE_SINK_DIR', "items")
+FILE_SINK_PARTITION = os.environ.get(
+    'FILE_SINK_PARTITION', "%(spiderid)s/%(crawlid)s")
+
+# FilePipeline压缩方式，可选gzip、zstd(依赖zstandard)，为空时不压缩
+FILE_SINK_COMPRESS = os.environ.get('FILE_SINK_COMPRESS', '')
+
+# 单个文件的最大字节数(压缩后)及item数，超过后切换到新文件，为0时不限制
+FILE_SINK_MAX_BYTES = int(os.environ.get('FILE_SINK_MAX_BYTES', 0))
+FILE_SINK_MAX_ITEMS = int(os.environ.get('FILE_SINK_MAX_ITEMS', 0))
+
+# 每隔多少毫秒将写入的数据fsync到磁盘
+FILE_SINK_FSYNC_INTERVAL = int(os.environ.get('FILE_SINK_FSYNC_INTERVAL', 1000))
+
+# Mp3DownloadPipeline的下载目录及同时下载的文件数
+MP3_DOWNLOAD_DIR = os.environ.get('MP3_DOWNLOAD_DIR', ".")
+MP3_DOWNLOAD_CONCURRENCY = int(os.environ.get('MP3_DOWNLOAD_CONCURRENCY', 4))
+
+# MongoPipeline每批写入的item数及最长等待时间(ms)
+MONGO_BATCH_SIZE = int(os.environ.get('MONGO_BATCH_SIZE', 100))
+MONGO_FLUSH_INTERVAL = int(os.environ.get('MONGO_FLUSH_INTERVAL', 1000))
+
+# 不为空时以该字段为key进行upsert，否则直接插入
+MONGO_UPSERT_KEY = os.environ.get('MONGO_UPSERT_KEY', '')
+
 DOWNLOADER_MIDDLEWARES = {
     'scrapy.downloadermiddlewares.useragent.UserAgentMiddleware': None,
     'scrapy.downloadermiddlewares.retry.RetryMiddleware':None,
@@ -98,13 +251,38 @@ DOWNLOADER_MIDDLEWARES = {
     'structor.downloadermiddlewares.CustomUserAgentMiddleware': 400,
     # Handle timeout retries with the redis scheduler and logger
     'structor.downloadermiddlewares.CustomRetryMiddleware': 510,
+    # 按域名熔断，需要在CustomRetryMiddleware后面
+    # 'structor.downloadermiddlewares.CircuitBreakerMiddleware': 520,
     # custom cookies to not persist across crawl requests
     # cookie中间件需要放在验证码中间件后面，验证码中间件需要放到代理中间件后面
     'structor.downloadermiddlewares.CustomCookiesMiddleware': 585,
     'structor.downloadermiddlewares.ProxyMiddleware': 590,
     'structor.downloadermiddlewares.CustomRedirectMiddleware': 600,
+    # Accept-Encoding根据安装的解压库设置，支持br(brotli)和zstd(zstandard)
+    # 需要在MetaRefreshMiddleware(580)读取响应之前解压，
+    # 避开ProxyMiddleware(590)及SpeedLimitedMiddleware的推荐位置(595)
+    'scrapy.downloadermiddlewares.httpcompression.HttpCompressionMiddleware': None,
+    'structor.downloadermiddlewares.HttpCompressionMiddleware': 592,
+    # 自适应并发，需要放在最后
+    # 'structor.downloadermiddlewares.AdaptiveConcurrencyMiddleware': 610,
 }
 
+# ItemCollector的外部存储，为空时ItemCollector随请求保存在meta中
+# structor.collector_stores.RedisCollectorStore: 多进程共享
+# structor.collector_stores.LocalCollectorStore: 只适用于单进程
+ITEM_COLLECTOR_STORE = os.environ.get('ITEM_COLLECTOR_STORE', '')
+
+# 外部存储中未完成的ItemCollector的超时时间
+ITEM_COLLECTOR_TIMEOUT = int(os.environ.get('ITEM_COLLECTOR_TIMEOUT', 60*60*24))
+
+# 并行收集，一个节点的全部子请求同时发出，item的耗时由各个请求耗时之和
+# 降低为最长分支的耗时，必须配合ITEM_COLLECTOR_STORE使用
+ITEM_COLLECTOR_PARALLEL = eval(os.environ.get('ITEM_COLLECTOR_PARALLEL', "False"))
+
+# 在多少个子进程中执行parse_item/parse_next(enrich函数)，为0时在reactor线程中执行
+# 需要ITEM_COLLECTOR_STORE为RedisCollectorStore，否则在reactor线程中执行
+ENRICH_PROCESSES = int(os.environ.get('ENRICH_PROCESSES', 0))
+
 # 在生产上关闭内建logging
 LOG_ENABLED = eval(os.environ.get('LOG_ENABLED', "True"))
 
@@ -1,16 +1,48 @@
 # -*- coding:utf-8 -*-
+"""
+投放任务
+urls_file逐行流式读取，支持普通文件、gzip文件(.gz)及标准输入(-)，
+请求按batch_size分批写入队列，每批只需要一次往返。
+普通文件可以按字节范围切分给多个进程同时投放。
+每批请求与读取到的位置(检查点)在同一个事务中写入redis，
+中断后使用resume从检查点继续投放，不会重复投放，也不会清除已有的抓取信息。
+"""
+import os
 import sys
-import pickle
-import argparse
+import time
+import gzip
 import traceback
+import multiprocessing
+
+from scrapy.utils.misc import load_object
 
 from .custom_request import Request
+from .purge_task import purge
+
+
+def feed_range(kwargs, start, end, offset, counters):
+    """
+    在子进程中投放urls_file中[start, end)字节范围内开始的行
+    :param kwargs: SpiderFeeder的参数
+    :param start:
+    :param end:
+    :param offset: 该范围的检查点，为None时从start开始
+    :param counters: 所有进程共享的计数
+    :return:
+    """
+    feeder = SpiderFeeder(worker=True, **kwargs)
+    feeder.counters = counters
+    with open(feeder.urls_file, "rb") as f:
+        feeder.feed_urls(feeder.iter_lines(f, start, end, offset),
+                         "parse_item", str(start), offset or start)
 
 
 class SpiderFeeder(object):
 
-    def __init__(self, crawlid, spiderid, url,
-                 urls_file, priority, port, host, custom):
+    def __init__(self, crawlid, spiderid, url, urls_file, priority, port,
+                 host, custom, serializer="structor.serializers.PickleSerializer",
+                 compress=None, batch_size=1000, processes=1, resume=False,
+                 retries=3, worker=False):
         self.crawlid = crawlid
         self.spiderid = spiderid
         self.url = url
@@ -19,8 +51,20 @@ class SpiderFeeder(object):
         self.port = port
         self.host = host
         self.custom = custom
-        self.inc = 0
-        self.failed_count, self.failed_rate, self.sucess_rate = 0, 0, 0
+        self.serializer_path = serializer
+        self.compress = compress
+        self.serializer = load_object(serializer)(compress)
+        self.batch_size = batch_size
+        self.processes = processes
+        self.resume = resume
+        self.retries = retries
+        # 投放数、重试次数、已读取的字节数
+        self.counters = multiprocessing.Array("q", 3)
+        self.start_time = time.time()
+        self.last_show = 0
+        self.total_bytes = None
+        self.worker = worker
+        self.checkpoint_key = "crawlid:%s:feed_checkpoint" % crawlid
 
         if self.custom:
             from custom_redis.client import Redis
@@ -28,100 +72,255 @@ class SpiderFeeder(object):
             from redis import Redis
 
         self.redis_conn = Redis(host=self.host, port=self.port)
-        self.clean_previous_task(self.crawlid)
+        if not self.worker and not self.resume:
+            self.clean_previous_task(self.crawlid)
 
     def clean_previous_task(self, crawlid):
-        failed_keys = self.redis_conn.keys("failed_download_*:%s" % crawlid)
-        for fk in failed_keys:
-            self.redis_conn.delete(fk)
-        self.redis_conn.delete("crawlid:%s" % crawlid)
-        self.redis_conn.delete("crawlid:%s:model" % crawlid)
+        purge(self.redis_conn, crawlid, self.custom)
+
+    @property
+    def splittable(self):
+        return self.processes > 1 and self.urls_file != "-" and \
+               not self.urls_file.endswith(".gz")
+
+    def load_checkpoint(self):
+        """
+        返回各字节范围(以范围起始位置为key)已提交的位置。
+        没有检查点时记录本次投放使用的文件及进程数，
+        resume时文件及进程数必须与检查点一致，否则范围的划分不同
+        :return:
+        """
+        processes = str(self.processes if self.splittable else 1)
+        checkpoint = {k.decode(): v.decode() for k, v in
+                      self.redis_conn.hgetall(self.checkpoint_key).items()}
+        if not checkpoint:
+            if self.resume:
+                print("No checkpoint of %s found, feed from the beginning. " %
+                      self.crawlid)
+            self.redis_conn.hset(self.checkpoint_key, "file", self.urls_file)
+            self.redis_conn.hset(self.checkpoint_key, "processes", processes)
+            return dict()
+        if (checkpoint.get("file"), checkpoint.get("processes")) != \
+                (self.urls_file, processes):
+            raise SystemExit(
+                "Checkpoint of %s was created with --urls-file %s and "
+                "--processes %s, resume with the same arguments. " % (
+                    self.crawlid, checkpoint.get("file"),
+                    checkpoint.get("processes")))
+        return {k: int(v) for k, v in checkpoint.items() if k.isdigit()}
+
+    def open_urls_file(self):
+        if self.urls_file == "-":
+            return sys.stdin.buffer
+        if self.urls_file.endswith(".gz"):
+            return gzip.open(self.urls_file, "rb")
+        # 只有普通文件可以根据读取的字节数计算进度
+        self.total_bytes = os.path.getsize(self.urls_file)
+        return open(self.urls_file, "rb")
+
+    @staticmethod
+    def iter_lines(f, start=0, end=None, offset=None):
+        """
+        逐行读取，返回(url, 读取该行后的位置)。
+        指定了字节范围时只读取在[start, end)中开始的行
+        :param f: 以二进制方式打开的文件
+        :param start:
+        :param end:
+        :param offset: 检查点，总是某一行的开头，gzip文件为解压后的位置
+        :return:
+        """
+        if offset:
+            if f.seekable():
+                f.seek(offset)
+            else:
+                # 标准输入只能读取并丢弃已投放的部分
+                remaining = offset
+                while remaining:
+                    chunk = f.read(min(remaining, 1024 * 1024))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+            position = offset
+        elif start:
+            # start之前不完整的行由上一个范围负责
+            f.seek(start - 1)
+            position = start - 1 + len(f.readline())
+        else:
+            position = 0
+        while end is None or position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.decode("utf-8").strip("\ufeff\r\n\t "), position
+
+    def make_request(self, url, callback):
+        return Request(
+            url=url,
+            callback=callback,
+            meta={"crawlid": self.crawlid,
+                  "spiderid": self.spiderid,
+                  "priority": self.priority}
+        )
+
+    def feed_urls(self, urls, callback, field=None, position=0):
+        """
+        分批投放
+        :param urls: (url, 读取该行后的位置)
+        :param callback:
+        :param field: 检查点中该范围对应的field，为None时不记录检查点
+        :param position: 开始读取的位置
+        :return:
+        """
+        batch, last = list(), position
+        for url, position in urls:
+            if url:
+                batch.append(self.serializer.dumps(
+                    self.make_request(url, callback)))
+            if len(batch) >= self.batch_size:
+                self.commit(batch, field, position, position - last)
+                batch, last = list(), position
+        if batch:
+            self.commit(batch, field, position, position - last)
+
+    def commit(self, batch, field, position, size):
+        self.feed_many(self.get_name(), batch, field, position)
+        with self.counters.get_lock():
+            self.counters[0] += len(batch)
+            self.counters[2] += size
+        if not self.worker:
+            self.show_process_line()
 
     def start(self):
-        success_rate, failed_rate = 0, 0
         # item抓取
         if self.urls_file:
-            with open(self.urls_file) as f:
-                lst = f.readlines()
-                lines_count = len(lst)
-                for index, url in enumerate(lst):
-                    req = Request(
-                        url=url.strip("\357\273\277\r\n"),
-                        callback="parse_item",
-                        meta={"crawlid": self.crawlid,
-                              "spiderid": self.spiderid,
-                              "priority": self.priority}
-                    )
-                    self.failed_count += self.feed(
-                        self.get_name(), pickle.dumps(req))
-                    success_rate, failed_rate = \
-                        self.show_process_line(
-                            lines_count, index + 1, self.failed_count)
-                self.redis_conn.hset(
-                    "crawlid:%s" % self.crawlid, "total_pages", lines_count)
+            checkpoint = self.load_checkpoint()
+            if self.splittable:
+                self.feed_in_processes(checkpoint)
+            else:
+                with self.open_urls_file() as f:
+                    offset = checkpoint.get("0")
+                    self.counters[2] = offset or 0
+                    self.feed_urls(self.iter_lines(f, offset=offset),
+                                   "parse_item", "0", offset or 0)
         # 分类抓取
         else:
-            url_list = self.url.split("     ")
-            lines_count = len(url_list)
-
-            for index, url in enumerate(url_list):
-                req = Request(
-                    url=url.strip(),
-                    callback="parse",
-                    meta={"crawlid": self.crawlid,
-                          "spiderid": self.spiderid,
-                          "priority": self.priority}
-                )
-                self.failed_count += self.feed(
-                    self.get_name(), pickle.dumps(req))
-                sucess_rate, failed_rate = self.show_process_line(
-                    lines_count, index + 1, self.failed_count)
-        print("\ntask feed complete. sucess_rate:%s%%, failed_rate:%s%%" % (
-            success_rate, failed_rate))
+            self.feed_urls(((url.strip(), 0) for url in self.url.split("     ")),
+                           "parse")
+        self.show_process_line(True)
+        count, retries, _ = self.counters
+        cost = time.time() - self.start_time
+        print("\ntask feed complete. %s urls in %.1fs, %.0f urls/s, "
+              "retries: %s" % (count, cost, count / max(cost, 0.001), retries))
+
+    def feed_in_processes(self, checkpoint):
+        """
+        按字节范围将文件切分给多个进程投放
+        :param checkpoint: 各范围已提交的位置
+        :return:
+        """
+        self.total_bytes = os.path.getsize(self.urls_file)
+        bounds = [self.total_bytes * i // self.processes
+                  for i in range(self.processes + 1)]
+        kwargs = dict(
+            crawlid=self.crawlid, spiderid=self.spiderid, url=self.url,
+            urls_file=self.urls_file, priority=self.priority, port=self.port,
+            host=self.host, custom=self.custom,
+            serializer=self.serializer_path, compress=self.compress,
+            batch_size=self.batch_size, retries=self.retries)
+        processes = list()
+        for start, end in zip(bounds, bounds[1:]):
+            offset = checkpoint.get(str(start))
+            if offset:
+                # 进度从检查点继续
+                self.counters[2] += offset - start
+            processes.append(multiprocessing.Process(
+                target=feed_range,
+                args=(kwargs, start, end, offset, self.counters)))
+        for p in processes:
+            p.start()
+        while any(p.is_alive() for p in processes):
+            self.show_process_line()
+            time.sleep(0.2)
+        for p in processes:
+            p.join()
+        if any(p.exitcode for p in processes):
+            raise SystemExit("\nSome feed processes failed, "
+                             "rerun with --resume to continue. ")
 
     def get_name(self):
         return "{sid}:request:queue".format(sid=self.spiderid)
 
-    def feed(self, queue_name, req):
+    def feed_many(self, queue_name, reqs, field=None, position=None):
+        """
+        投放一批请求并提交检查点，失败时指数退避后重试，
+        重试retries次仍然失败时退出，之前提交的批次可以通过resume跳过。
+        请求序列化的结果是确定的，所以重试时重复的ZADD不会产生重复的请求
+        :param queue_name:
+        :param reqs:
+        :param field: 检查点中该范围对应的field
+        :param position: 这批请求之后的位置
+        :return:
+        """
         if self.custom:
             from custom_redis.client.errors import RedisError
         else:
             from redis import RedisError
-        try:
-            self.redis_conn.zadd(queue_name, req, -self.priority)
-            return 0
-        except RedisError:
-            traceback.print_exc()
-            return 1
-
-    def show_process_line(self, count, num, failed):
-        per = count / 100
-        success = num - failed
-        success_rate = success * 100.0 / count
-        failed_rate = failed * 100.0 / count
-        str_success_rate = "%.2f%%  " % success_rate
-        str_failed_rate = "%.2f%%  " % failed_rate
-
-        if num >= self.inc:
-            self.inc += per
-            if sys.platform == "win32":
-                import ctypes
-                std_out_handle = ctypes.windll.kernel32.GetStdHandle(-11)
-                color_ctl = ctypes.windll.kernel32.SetConsoleTextAttribute
-                color_ctl(std_out_handle, 2)
-                print("\r", str_success_rate, "")
-                color_ctl(std_out_handle, 32)
-                print(int(success_rate * 30 / 100) * ' ', "")
-                if int(failed_rate):
-                    color_ctl(std_out_handle, 64)
-                    print(int(failed_rate * 30 / 100) * ' ', "")
-                color_ctl(std_out_handle, 0)
-                color_ctl(std_out_handle, 4)
-                print(str_failed_rate, "")
-                color_ctl(std_out_handle, 7)
-            else:
-                print("\r", str_success_rate, "")
-                print("%s%s" % (int(success_rate * 50 / 100) * '\033[42m \033[0m',
-                                int(failed_rate * 50 / 100) * '\033[41m \033[0m'),
-                      str_failed_rate)
-        return success_rate, failed_rate
+        for retry in range(self.retries + 1):
+            try:
+                return self.write_batch(queue_name, reqs, field, position)
+            except RedisError:
+                traceback.print_exc()
+                if retry == self.retries:
+                    raise SystemExit(
+                        "\nFeed failed after %s retries, "
+                        "rerun with --resume to continue. " % self.retries)
+                with self.counters.get_lock():
+                    self.counters[1] += 1
+                time.sleep(2 ** retry)
+
+    def write_batch(self, queue_name, reqs, field, position):
+        """
+        在一个事务中ZADD请求、增加total_pages并提交检查点，
+        custom_redis不支持事务，只能依次写入
+        :param queue_name:
+        :param reqs:
+        :param field:
+        :param position:
+        :return:
+        """
+        if self.custom:
+            pipe = self.redis_conn
+            for req in reqs:
+                pipe.zadd(queue_name, req, -self.priority)
+        else:
+            pipe = self.redis_conn.pipeline()
+            args = list()
+            for req in reqs:
+                args.extend((req, -self.priority))
+            pipe.zadd(queue_name, *args)
+        if field is not None:
+            pipe.hincrby("crawlid:%s" % self.crawlid, "total_pages", len(reqs))
+            pipe.hset(self.checkpoint_key, field, position)
+            pipe.expire(self.checkpoint_key, 60 * 60 * 24 * 2)
+        if not self.custom:
+            pipe.execute()
+
+    def show_process_line(self, force=False):
+        """
+        在同一行中刷新进度
+        :param force: 为False时每0.2秒最多刷新一次
+        :return:
+        """
+        now = time.time()
+        if not force and now - self.last_show < 0.2:
+            return
+        self.last_show = now
+        count, retries, size = self.counters
+        line = "\rfed: %s  retries: %s  %.0f urls/s" % (
+            count, retries, count / max(now - self.start_time, 0.001))
+        if self.total_bytes:
+            rate = min(size * 100.0 / self.total_bytes, 100)
+            line += "  [%-50s] %.2f%%" % ("#" * int(rate / 2), rate)
+        sys.stdout.write(line)
+        sys.stdout.flush()
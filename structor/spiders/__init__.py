@@ -4,6 +4,7 @@
 # Please refer to the documentation for information on how to create and manage
 # your spiders.
 import time
+import uuid
 import traceback
 
 from functools import reduce
@@ -12,15 +13,18 @@ from urllib.parse import urlparse, urljoin
 from scrapy import signals
 from scrapy.exceptions import DontCloseSpider
 from scrapy.spiders import Spider
+from scrapy.utils.misc import load_object
 from scrapy.utils.response import response_status_message
 
 from toolkit import cache_prop
 from toolkit.tools.managers import ExceptContext
 
 from ..custom_request import Request
-from ..utils import Logger, enrich_wrapper, \
+from ..utils import Logger, enrich_wrapper, release_selector, \
     url_arg_increment, url_item_arg_increment, url_path_arg_increment
-from ..item_collector import ItemCollector, Node
+from ..dupefilters import load_dupefilter
+from ..enrich_pool import EnrichPool
+from ..item_collector import ItemCollector, ParallelItemCollector, Node
 
 
 class StructureSpider(Spider):
@@ -43,6 +47,37 @@ class StructureSpider(Spider):
     def logger(self):
         return Logger.from_crawler(self.crawler)
 
+    @cache_prop
+    def dupefilter(self):
+        return load_dupefilter(self.redis_conn, self.settings, self.logger)
+
+    @cache_prop
+    def collector_store(self):
+        store_cls = self.settings.get("ITEM_COLLECTOR_STORE")
+        return store_cls and load_object(store_cls).from_settings(
+            self.redis_conn, self.settings)
+
+    @cache_prop
+    def parallel_collect(self):
+        if not self.settings.getbool("ITEM_COLLECTOR_PARALLEL"):
+            return False
+        if not self.collector_store:
+            self.logger.warning(
+                "ITEM_COLLECTOR_PARALLEL requires ITEM_COLLECTOR_STORE. ")
+            return False
+        return True
+
+    @cache_prop
+    def enrich_pool(self):
+        processes = self.settings.getint("ENRICH_PROCESSES", 0)
+        if not processes:
+            return None
+        if not self.collector_store or not self.collector_store.shared:
+            self.logger.warning(
+                "ENRICH_PROCESSES requires a shared ITEM_COLLECTOR_STORE. ")
+            return None
+        return EnrichPool(self.crawler, processes)
+
     def log_err(self, func_name, *args):
         self.logger.error(
             "Error in %s: %s. " % (
@@ -53,10 +88,16 @@ class StructureSpider(Spider):
         super(StructureSpider, self)._set_crawler(crawler)
         self.crawler.signals.connect(
             self.spider_idle, signal=signals.spider_idle)
+        self.crawler.signals.connect(
+            self.close_enrich_pool, signal=signals.spider_closed)
 
     def set_redis(self, redis_conn):
         self.redis_conn = redis_conn
 
+    def close_enrich_pool(self):
+        if self.enrich_pool:
+            return self.enrich_pool.close()
+
     def spider_idle(self):
         if self.settings.getbool("IDLE", True):
             print('Don\'t close spider......')
@@ -113,24 +154,32 @@ class StructureSpider(Spider):
         item_loader.add_value('response_url', response.url)
 
     def duplicate_filter(self, response, url, func):
-        crawlid = response.meta["crawlid"]
-        common_part = func(url)
+        return self.dupefilter.exists_or_add(
+            "crawlid:%s:model" % response.meta["crawlid"], func(url))
 
-        if self.redis_conn.sismember("crawlid:%s:model" % crawlid, common_part):
-            return True
-        else:
-            self.redis_conn.sadd("crawlid:%s:model" % crawlid, common_part)
-            self.redis_conn.expire("crawlid:%s:model" % crawlid,
-                                   self.crawler.settings.get("DUPLICATE_TIMEOUT", 60 * 60))
-            return False
+    def duplicate_filter_many(self, response, urls, func):
+        """
+        一次性对当前页的全部item链接去重
+        :param response:
+        :param urls:
+        :param func: 返回url用来标识重复的部分
+        :return: 未重复的url
+        """
+        founds = self.dupefilter.exists_or_add_many(
+            "crawlid:%s:model" % response.meta["crawlid"],
+            [func(url) for url in urls])
+        return [url for url, found in zip(urls, founds) if not found]
 
     def parse(self, response):
         with ExceptContext(errback=self.log_err) as ec:
             self.logger.debug("Start response in parse. ")
             item_urls = self.extract_item_urls(response)
             # 增加这个字段的目的是为了记住去重后的url有多少个，如果为空，对于按参数翻页的网站，有可能已经翻到了最后一页。
-            effective_urls = [i for i in item_urls if not (
-                self.need_duplicate and self.duplicate_filter(response, i, self.need_duplicate))]
+            if self.need_duplicate:
+                effective_urls = self.duplicate_filter_many(
+                    response, item_urls, self.need_duplicate)
+            else:
+                effective_urls = item_urls
             self.crawler.stats.inc_total_pages(
                 response.meta['crawlid'], len(effective_urls))
             yield from self.gen_requests(
@@ -184,22 +233,48 @@ class StructureSpider(Spider):
         pass
 
     def parse_item(self, response):
+        if self.enrich_pool:
+            return self.enrich_pool.run("parse_item", response)
+        return self.do_parse_item(response)
+
+    def do_parse_item(self, response):
         with ExceptContext(errback=self.log_err) as ec:
             response.meta["request_count_per_item"] = 1
             base_loader = self.get_base_loader(response)
             meta = response.request.meta
             self.enrich_base_data(base_loader, response)
-            meta["item_collector"] = \
-                ItemCollector(Node(None, base_loader, None, self.enrich_data))
-            yield self.yield_item_or_req(meta["item_collector"], response)
+            root = Node(None, base_loader, None, self.enrich_data)
+            # 子请求会复制当前请求的meta，使用外部存储时只传递id
+            if self.collector_store:
+                meta["item_collector_id"] = uuid.uuid4().hex
+            if self.parallel_collect:
+                item_collector = ParallelItemCollector(root)
+                results = item_collector.collect(response, self)
+                # 根节点完成后nodes为空，不需要保存
+                if item_collector.nodes:
+                    self.collector_store.save(
+                        meta["item_collector_id"], item_collector)
+                yield from self.yield_items_or_reqs(
+                    results, item_collector.request_count, response)
+            else:
+                item_collector = ItemCollector(root)
+                if not self.collector_store:
+                    meta["item_collector"] = item_collector
+                yield self.yield_item_or_req(item_collector, response)
 
         if ec.got_err:
             self.crawler.stats.set_failed_download(
                 response.meta['crawlid'],
                 response.request.url,
                 "In parse_item: " + "".join(traceback.format_exception(*ec.err_info)))
+        release_selector(response)
 
     def parse_next(self, response):
+        if self.enrich_pool:
+            return self.enrich_pool.run("parse_next", response)
+        return self.do_parse_next(response)
+
+    def do_parse_next(self, response):
         if response.status == 999:
             self.logger.error(
                 "Partial request error: crawlid:%s, url: %s. " % (
@@ -207,21 +282,96 @@ class StructureSpider(Spider):
         with ExceptContext(errback=self.log_err) as ec:
             response.meta["request_count_per_item"] = \
                 response.meta.get("request_count_per_item", 1) + 1
-            yield self.yield_item_or_req(
-                response.request.meta["item_collector"], response)
+            if "item_collector_node" in response.meta:
+                results, request_count = self.collect_parallel(response)
+                yield from self.yield_items_or_reqs(
+                    results, request_count, response)
+            else:
+                yield self.yield_item_or_req(
+                    self.get_item_collector(response), response)
 
-        if ec.got_err:
+        # 并行收集时出错的分支已经在collect_parallel中释放
+        if ec.got_err and "item_collector_node" not in response.meta:
+            self.release_item_collector(response)
             self.crawler.stats.set_failed_download(
                 response.meta['crawlid'],
                 response.request.url,
                 "In parse_next: " + "".join(traceback.format_exception(*ec.err_info)))
+        release_selector(response)
+
+    def collect_parallel(self, response):
+        """
+        enrich方法在update之外只执行一次，update中只合并状态，并发冲突重试时不会重复执行
+        :param response:
+        :return: (新产生的请求列表或只包含item的列表, 该item目前为止发出的请求数)
+        """
+        collector_id = response.meta["item_collector_id"]
+        try:
+            enrichment = self.collector_store.load(
+                collector_id).enrich(response, self)
+        except Exception:
+            self.release_item_collector(response)
+            raise
+        results, request_count, outstanding = self.collector_store.update(
+            collector_id, lambda collector: (collector.merge(enrichment),
+                                             collector.request_count,
+                                             collector.outstanding))
+        # item已经生成，或之前有分支失败且当前是最后一个返回的分支
+        if not outstanding:
+            self.collector_store.delete(collector_id)
+        return results, request_count
+
+    def get_item_collector(self, response):
+        if self.collector_store:
+            return self.collector_store.load(
+                response.request.meta["item_collector_id"])
+        return response.request.meta["item_collector"]
+
+    def release_item_collector(self, response):
+        """
+        item失败，删除其ItemCollector。并行收集时其它分支可能还未返回，
+        只标记失败，最后一个分支返回后才删除
+        :param response:
+        :return:
+        """
+        if not self.collector_store or "item_collector_id" not in response.meta:
+            return
+        collector_id = response.meta["item_collector_id"]
+        if "item_collector_node" in response.meta:
+            try:
+                outstanding = self.collector_store.update(
+                    collector_id, lambda collector: collector.fail())
+            except KeyError:
+                return
+            if outstanding:
+                return
+        self.collector_store.delete(collector_id)
 
     def yield_item_or_req(self, item_collector, response):
         item_or_req = item_collector.collect(response, self)
         if isinstance(item_or_req, Request):
+            if self.collector_store:
+                self.collector_store.save(
+                    response.request.meta["item_collector_id"], item_collector)
             return item_or_req
+        self.release_item_collector(response)
         return self.process_forward(response, item_or_req)
 
+    def yield_items_or_reqs(self, results, request_count, response):
+        """
+        并行收集时每次收集可能返回多个请求，根节点完成时返回item
+        :param results:
+        :param request_count: 该item目前为止发出的请求数
+        :param response:
+        :return:
+        """
+        for item_or_req in results:
+            if isinstance(item_or_req, Request):
+                yield item_or_req
+            else:
+                response.meta["request_count_per_item"] = request_count
+                yield self.process_forward(response, item_or_req)
+
     def process_forward(self, response, item):
         self.logger.info(
             "crawlid:%s, id: %s, %s requests send for successful yield item" % (
@@ -235,9 +385,11 @@ class StructureSpider(Spider):
         if failure and failure.value and hasattr(failure.value, 'response'):
             response = failure.value.response
             if response:
+                self.release_item_collector(response)
                 loader = self.get_base_loader(response)
                 self.enrich_base_data(loader, response)
                 item = loader.load_item()
+                release_selector(response)
                 self.logger.error("Errback: %s" % item)
                 self.crawler.stats.inc_crawled_pages(response.meta['crawlid'])
                 return item
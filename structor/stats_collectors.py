@@ -1,23 +1,147 @@
 # -*- coding:utf-8 -*-
 import time
+import traceback
+
+from collections import Counter, defaultdict
 
 from scrapy.statscollectors import MemoryStatsCollector
+from twisted.internet import task
 
 from toolkit.tools.managers import ExceptContext
 
+from .utils import Logger, index_key
+
+
+class StatsBuffer(object):
+    """
+    一个crawlid在两次写入redis之间的统计信息增量
+    """
+    def __init__(self):
+        self.counters = Counter()
+        self.values = dict()
+        self.failed = defaultdict(dict)
+        self.start_time = None
+        self.update_time = None
+
+    def touch(self):
+        self.update_time = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.start_time = self.start_time or self.update_time
+
+    def merge(self, newer):
+        """
+        合并之后产生的增量
+        :param newer:
+        :return:
+        """
+        self.counters.update(newer.counters)
+        # 之后设置的值覆盖之前的增量
+        for field, value in newer.values.items():
+            self.counters.pop(field, None)
+            self.values[field] = value
+        for _type, failed in newer.failed.items():
+            self.failed[_type].update(failed)
+        self.start_time = self.start_time or newer.start_time
+        self.update_time = newer.update_time or self.update_time
+
 
 class StatsCollector(MemoryStatsCollector):
     """
         use redis to collect stats.
+        STATS_BUFFERED开启后统计信息先在内存中累积，
+        每STATS_FLUSH_INTERVAL毫秒或每STATS_FLUSH_EVENTS次变化在一个pipeline中写入redis，
+        关闭时写入剩余的部分，redis中的数据格式不变。
     """
     def __init__(self, crawler):
         super(StatsCollector, self).__init__(crawler)
         self.crawler = crawler
+        self.logger = Logger.from_crawler(crawler)
+        self.buffered = crawler.settings.getbool("STATS_BUFFERED")
+        if self.buffered and crawler.settings.getbool("CUSTOM_REDIS"):
+            self.logger.warning(
+                "STATS_BUFFERED is not supported by custom redis. ")
+            self.buffered = False
+        self.flush_interval = crawler.settings.getint(
+            "STATS_FLUSH_INTERVAL", 1000) / 1000
+        self.flush_events = crawler.settings.getint("STATS_FLUSH_EVENTS", 100)
+        self.buffers = dict()
+        self.events = 0
+        self.flush_task = None
 
     @property
     def redis_conn(self):
         return self.crawler.spider.redis_conn
 
+    def open_spider(self, spider):
+        super(StatsCollector, self).open_spider(spider)
+        if self.buffered:
+            self.flush_task = task.LoopingCall(self.flush)
+            self.flush_task.start(self.flush_interval, now=False)
+
+    def close_spider(self, spider, reason):
+        if self.flush_task and self.flush_task.running:
+            self.flush_task.stop()
+        self.flush()
+        super(StatsCollector, self).close_spider(spider, reason)
+
+    def record(self, crawlid, touch=True):
+        """
+        返回crawlid的增量缓冲，调用者修改后需要调用commit
+        :param crawlid:
+        :param touch: 是否更新update_time
+        :return:
+        """
+        buffer = self.buffers.get(crawlid)
+        if not buffer:
+            buffer = self.buffers[crawlid] = StatsBuffer()
+        if touch:
+            buffer.touch()
+        return buffer
+
+    def commit(self):
+        self.events += 1
+        if self.events >= self.flush_events:
+            self.flush()
+
+    def flush(self):
+        """
+        在一个事务(MULTI/EXEC)中将所有增量写入redis，失败时全部保留
+        :return:
+        """
+        if not self.buffers:
+            return
+        buffers, self.buffers = self.buffers, dict()
+        self.events = 0
+        pipe = self.redis_conn.pipeline()
+        for crawlid, buffer in buffers.items():
+            key = "crawlid:%s" % crawlid
+            for field, value in buffer.values.items():
+                pipe.hset(key, field, value)
+            for field, num in buffer.counters.items():
+                pipe.hincrby(key, field, num)
+            if buffer.update_time:
+                pipe.hmset(key, {"crawlid": crawlid,
+                                 "update_time": buffer.update_time})
+                pipe.hsetnx(key, "start_time", buffer.start_time)
+                pipe.hsetnx(key, "spiderid", self.crawler.spider.name)
+                pipe.expire(key, 60 * 60 * 24 * 2)
+            for _type, failed in buffer.failed.items():
+                failed_key = "failed_download_%s:%s" % (_type, crawlid)
+                pipe.hmset(failed_key, failed)
+                pipe.expire(failed_key, 60 * 60 * 24 * 2)
+                pipe.sadd(index_key(crawlid), failed_key)
+                pipe.expire(index_key(crawlid), 60 * 60 * 24 * 2)
+        try:
+            pipe.execute()
+        except Exception:
+            self.logger.error("Failed to flush stats: %s. " % traceback.format_exc())
+            # 保留这些增量，下次写入时重试
+            for crawlid, buffer in self.buffers.items():
+                if crawlid in buffers:
+                    buffers[crawlid].merge(buffer)
+                else:
+                    buffers[crawlid] = buffer
+            self.buffers = buffers
+
     def update(self, crawlid):
         key = "crawlid:%s" % crawlid
         self.redis_conn.hmset(key, {
@@ -34,6 +158,9 @@ class StatsCollector(MemoryStatsCollector):
         self.redis_conn.expire("crawlid:%s" % crawlid, 60 * 60 * 24 * 2)
 
     def set_failed_download(self, crawlid, url, reason, _type="pages"):
+        if self.buffered:
+            self.record(crawlid).counters["failed_download_%s" % _type] += 1
+            return self.set_failed(crawlid, reason, url, _type)
         with ExceptContext():
             self.redis_conn.hincrby(
                 "crawlid:%s" % crawlid, "failed_download_%s" % _type, 1)
@@ -41,23 +168,40 @@ class StatsCollector(MemoryStatsCollector):
             self.set_failed(crawlid, reason, url, _type)
 
     def set_failed(self, crawlid, url, reason, _type="pages"):
+        if self.buffered:
+            self.record(crawlid, False).failed[_type][url] = reason
+            return self.commit()
+        failed_key = "failed_download_%s:%s" % (_type, crawlid)
         with ExceptContext():
-            self.redis_conn.hset(
-                "failed_download_%s:%s" % (_type, crawlid), url, reason)
-            self.redis_conn.expire(
-                "failed_download_%s:%s" % (_type, crawlid), 60 * 60 * 24 * 2)
+            self.redis_conn.hset(failed_key, url, reason)
+            self.redis_conn.expire(failed_key, 60 * 60 * 24 * 2)
+            # 清理任务时通过索引找到失败记录，不需要扫描整个redis
+            self.redis_conn.sadd(index_key(crawlid), failed_key)
+            self.redis_conn.expire(index_key(crawlid), 60 * 60 * 24 * 2)
 
     def inc_total_pages(self, crawlid, num=1):
+        if self.buffered:
+            self.record(crawlid).counters["total_pages"] += num
+            return self.commit()
         with ExceptContext():
             self.redis_conn.hincrby("crawlid:%s" % crawlid, "total_pages", num)
             self.update(crawlid)
 
     def set_total_pages(self, crawlid, num=1):
+        if self.buffered:
+            buffer = self.record(crawlid)
+            # 之前的增量被覆盖
+            buffer.counters.pop("total_pages", None)
+            buffer.values["total_pages"] = num
+            return self.commit()
         with ExceptContext():
             self.redis_conn.hset("crawlid:%s" % crawlid, "total_pages", num)
             self.update(crawlid)
 
     def inc_crawled_pages(self, crawlid):
+        if self.buffered:
+            self.record(crawlid).counters["crawled_pages"] += 1
+            return self.commit()
         with ExceptContext():
             self.redis_conn.hincrby("crawlid:%s" % crawlid, "crawled_pages", 1)
             self.update(crawlid)
@@ -19,10 +19,12 @@ from toolkit import strip
 from toolkit.singleton import Singleton
 
 from scrapy import Selector, Item
+from scrapy.http import XmlResponse
 from scrapy.loader import ItemLoader
 from scrapy.utils.misc import arg_to_iter
 from scrapy.loader.processors import Compose
 
+from .dupefilters import filter_keys
 from .custom_request import Request
 
 
@@ -76,6 +78,49 @@ class ItemEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+def decode(v):
+    """
+    redis返回的bytes转换为str，其它类型保持不变
+    :param v:
+    :return:
+    """
+    return v.decode() if isinstance(v, bytes) else v
+
+
+def index_key(crawlid):
+    """
+    记录crawlid动态产生的key的集合
+    :param crawlid:
+    :return:
+    """
+    return "crawlid:%s:keys" % crawlid
+
+
+def fixed_keys(crawlid):
+    """
+    返回crawlid名称固定的key
+    :param crawlid:
+    :return:
+    """
+    key = "crawlid:%s" % crawlid
+    return [key, "%s:feed_checkpoint" % key, index_key(crawlid)] + \
+        filter_keys(crawlid)
+
+
+def item_to_dict(obj):
+    """
+    将Item(及其中嵌套的Item)递归转换成普通的字典和列表，
+    与经过ItemEncoder编码再解码的结构相同，其它类型的值保持不变
+    :param obj:
+    :return:
+    """
+    if isinstance(obj, (Item, dict)):
+        return {k: item_to_dict(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [item_to_dict(v) for v in obj]
+    return obj
+
+
 class CustomLoader(ItemLoader):
     """
     自定义ItemLoader
@@ -127,6 +172,45 @@ class CustomLoader(ItemLoader):
     __repr__ = __str__
 
 
+def get_selector(response, stats=None):
+    """
+    返回response的selector，同一个response只会被解码和解析一次。
+    selector缓存在response上，与response.xpath等共用，
+    xml类型的response为了保持enrich函数中html的解析方式，单独缓存。
+    :param response:
+    :param stats: 不为空时统计解码、解析及复用次数
+    :return:
+    """
+    xml = isinstance(response, XmlResponse)
+    selector = getattr(
+        response, "_enrich_selector" if xml else "_cached_selector", None)
+    if selector is not None:
+        if stats:
+            stats.inc_value("enrich/selector_reused")
+        return selector
+
+    if stats:
+        if getattr(response, "_cached_ubody", None) is None:
+            stats.inc_value("enrich/response_decoded")
+        stats.inc_value("enrich/selector_parsed")
+    if xml:
+        selector = response._enrich_selector = Selector(text=response.text)
+    else:
+        selector = response.selector
+    return selector
+
+
+def release_selector(response):
+    """
+    回调完成后释放response上缓存的selector及解码后的文本
+    :param response:
+    :return:
+    """
+    for attr in ("_enrich_selector", "_cached_selector", "_cached_ubody"):
+        if getattr(response, attr, None) is not None:
+            setattr(response, attr, None)
+
+
 def enrich_wrapper(func):
     """
     item_loader在使用pickle 序列化时，不能包含response对象和selector对象, 使用该装饰器，
@@ -138,8 +222,9 @@ def enrich_wrapper(func):
     def wrapper(*args, **kwargs):
         item_loader = args[1]
         response = args[2]
-        selector = Selector(text=response.text)
-        item_loader.selector = selector
+        crawler = getattr(args[0], "crawler", None)
+        item_loader.selector = get_selector(
+            response, crawler and crawler.stats)
         result = func(*args, **kwargs)
         item_loader.selector = None
         return result
@@ -0,0 +1,334 @@
+"""
+测试共用的内存版redis，行为与redis-py 2.9的Redis类保持一致：
+读取时返回bytes，zadd的参数为member, score交替，pipeline支持WATCH/MULTI。
+只实现了structor中用到的命令。
+"""
+import fnmatch
+
+from redis import ResponseError, WatchError
+
+
+def to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, float):
+        return repr(value).encode()
+    return str(value).encode()
+
+
+def to_key(key):
+    return key.decode() if isinstance(key, bytes) else key
+
+
+class FakeScript(object):
+    """
+    Lua脚本由测试提供等价的python实现：func(redis, keys, args)
+    """
+    def __init__(self, redis, script):
+        self.redis = redis
+        self.script = script
+
+    def __call__(self, keys=[], args=[]):
+        func = self.redis.scripts.get(self.script)
+        if func is None:
+            raise NotImplementedError("Script is not faked. ")
+        self.redis.round_trips += 1
+        return func(self.redis, keys, args)
+
+
+class FakePipeline(object):
+    """
+    WATCH之后MULTI之前的命令立即执行，其它命令在execute时一次性执行，
+    被WATCH的key在此期间被修改时抛出WatchError
+    """
+    def __init__(self, redis, transaction=True):
+        self.redis = redis
+        self.transaction = transaction
+        self.watching = None
+        self.immediate = False
+        self.commands = list()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.reset()
+
+    def reset(self):
+        self.watching = None
+        self.immediate = False
+        self.commands = list()
+
+    def watch(self, *keys):
+        self.watching = {to_key(key): self.redis.versions.get(to_key(key), 0)
+                         for key in keys}
+        self.immediate = True
+
+    def multi(self):
+        self.immediate = False
+
+    def __getattr__(self, name):
+        if self.immediate:
+            return getattr(self.redis, name)
+        getattr(self.redis, name)
+
+        def call(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return call
+
+    def execute(self):
+        commands, watching = self.commands, self.watching
+        self.reset()
+        if self.redis.on_execute:
+            self.redis.on_execute(self)
+        self.redis.round_trips += 1
+        if watching and any(self.redis.versions.get(key, 0) != version
+                            for key, version in watching.items()):
+            raise WatchError("Watched variable changed. ")
+        return [self.redis.run(name, *args, **kwargs)
+                for name, args, kwargs in commands]
+
+
+class FakeRedis(object):
+    """
+    所有直接调用及pipeline中执行的命令按顺序记录在calls中，
+    round_trips为与服务端的往返次数，now模拟当前时间(秒)用于过期，
+    on_execute(pipeline)在每次pipeline执行之前调用，可以用来模拟失败或并发修改
+    """
+    def __init__(self, host=None, port=None):
+        self.data = dict()
+        self.expires = dict()
+        self.versions = dict()
+        self.scripts = dict()
+        self.calls = list()
+        self.transactions = list()
+        self.round_trips = 0
+        self.now = 0
+        self.unlink = True
+        self.on_execute = None
+
+    def pipeline(self, transaction=True):
+        self.transactions.append(transaction)
+        return FakePipeline(self, transaction)
+
+    def register_script(self, script):
+        return FakeScript(self, script)
+
+    def run(self, name, *args, **kwargs):
+        self.calls.append(args[0] if name == "execute_command" else name)
+        return getattr(self, "do_" + name)(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if not hasattr(type(self), "do_" + name):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            self.round_trips += 1
+            return self.run(name, *args, **kwargs)
+        return call
+
+    def lookup(self, key, default=None):
+        key = to_key(key)
+        expire_at = self.expires.get(key)
+        if expire_at is not None and expire_at <= self.now:
+            self.data.pop(key, None)
+            self.expires.pop(key)
+        # 与redis一样，空的hash、set、zset视为不存在
+        if isinstance(self.data.get(key), (dict, set)) and not self.data[key]:
+            self.data.pop(key)
+        if key not in self.data and default is not None:
+            self.data[key] = default
+        return self.data.get(key)
+
+    def touch(self, key):
+        key = to_key(key)
+        self.versions[key] = self.versions.get(key, 0) + 1
+        return key
+
+    # keys
+    def do_delete(self, *keys):
+        count = 0
+        for key in keys:
+            count += self.lookup(key) is not None
+            self.data.pop(self.touch(key), None)
+            self.expires.pop(to_key(key), None)
+        return count
+
+    def do_exists(self, key):
+        return self.lookup(key) is not None
+
+    def do_expire(self, key, seconds):
+        return self.do_pexpire(key, seconds * 1000)
+
+    def do_pexpire(self, key, ms):
+        if self.lookup(key) is None:
+            return False
+        self.expires[to_key(key)] = self.now + ms / 1000
+        return True
+
+    def do_pttl(self, key):
+        if self.lookup(key) is None:
+            return -2
+        expire_at = self.expires.get(to_key(key))
+        return -1 if expire_at is None else int((expire_at - self.now) * 1000)
+
+    def do_ttl(self, key):
+        pttl = self.do_pttl(key)
+        return pttl if pttl < 0 else pttl // 1000
+
+    def do_keys(self, pattern="*"):
+        return [key.encode() for key in sorted(self.data)
+                if self.lookup(key) is not None and
+                fnmatch.fnmatchcase(key, pattern)]
+
+    def do_scan(self, cursor=0, match=None, count=10):
+        keys = sorted(self.data)
+        cursor = int(cursor)
+        found = [key.encode() for key in keys[cursor:cursor + count]
+                 if fnmatch.fnmatchcase(key, match or "*")]
+        cursor += count
+        return (str(cursor).encode() if cursor < len(keys) else b"0"), found
+
+    def do_execute_command(self, command, *args):
+        if command == "UNLINK" and not self.unlink:
+            raise ResponseError("unknown command 'UNLINK'")
+        if command in ("UNLINK", "DEL"):
+            return self.do_delete(*args)
+        raise NotImplementedError(command)
+
+    # strings
+    def do_get(self, key):
+        return self.lookup(key)
+
+    def do_set(self, key, value, ex=None, px=None, nx=False):
+        if nx and self.lookup(key) is not None:
+            return None
+        self.data[self.touch(key)] = to_bytes(value)
+        self.expires.pop(to_key(key), None)
+        if ex is not None:
+            self.do_expire(key, ex)
+        if px is not None:
+            self.do_pexpire(key, px)
+        return True
+
+    def do_psetex(self, key, ms, value):
+        return self.do_set(key, value, px=ms)
+
+    def do_incrby(self, key, num=1):
+        value = int(self.lookup(key) or 0) + num
+        self.data[self.touch(key)] = to_bytes(value)
+        return value
+
+    def do_incr(self, key, num=1):
+        return self.do_incrby(key, num)
+
+    # hashes
+    def do_hget(self, key, field):
+        return (self.lookup(key) or {}).get(to_bytes(field))
+
+    def do_hgetall(self, key):
+        return dict(self.lookup(key) or {})
+
+    def do_hkeys(self, key):
+        return list(self.lookup(key) or {})
+
+    def do_hlen(self, key):
+        return len(self.lookup(key) or {})
+
+    def do_hset(self, key, field, value):
+        hash = self.lookup(key, {})
+        self.touch(key)
+        new = to_bytes(field) not in hash
+        hash[to_bytes(field)] = to_bytes(value)
+        return int(new)
+
+    def do_hsetnx(self, key, field, value):
+        if to_bytes(field) in (self.lookup(key) or {}):
+            return 0
+        return self.do_hset(key, field, value)
+
+    def do_hmset(self, key, mapping):
+        for field, value in mapping.items():
+            self.do_hset(key, field, value)
+        return True
+
+    def do_hincrby(self, key, field, num=1):
+        value = int(self.do_hget(key, field) or 0) + num
+        self.do_hset(key, field, value)
+        return value
+
+    def do_hdel(self, key, *fields):
+        hash = self.lookup(key) or {}
+        self.touch(key)
+        return sum(hash.pop(to_bytes(field), None) is not None
+                   for field in fields)
+
+    # sets
+    def do_sadd(self, key, *values):
+        members = self.lookup(key, set())
+        self.touch(key)
+        count = 0
+        for value in values:
+            count += to_bytes(value) not in members
+            members.add(to_bytes(value))
+        return count
+
+    def do_smembers(self, key):
+        return set(self.lookup(key) or ())
+
+    def do_sismember(self, key, value):
+        return to_bytes(value) in (self.lookup(key) or ())
+
+    def do_scard(self, key):
+        return len(self.lookup(key) or ())
+
+    # sorted sets
+    def do_zadd(self, name, *args):
+        zset = self.lookup(name, {})
+        self.touch(name)
+        count = 0
+        for member, score in zip(args[::2], args[1::2]):
+            count += to_bytes(member) not in zset
+            zset[to_bytes(member)] = float(score)
+        return count
+
+    def do_zcard(self, name):
+        return len(self.lookup(name) or {})
+
+    def do_zscore(self, name, member):
+        return (self.lookup(name) or {}).get(to_bytes(member))
+
+    def sorted_items(self, name):
+        return sorted((self.lookup(name) or {}).items(),
+                      key=lambda x: (x[1], x[0]))
+
+    def do_zrange(self, name, start, end, withscores=False):
+        items = self.sorted_items(name)
+        items = items[start:None if end == -1 else end + 1]
+        return items if withscores else [member for member, _ in items]
+
+    def do_zrangebyscore(self, name, min, max, start=None, num=None,
+                         withscores=False):
+        items = [(member, score) for member, score in self.sorted_items(name)
+                 if float(min) <= score <= float(max)]
+        if start is not None:
+            items = items[start:start + num]
+        return items if withscores else [member for member, _ in items]
+
+    def do_zrem(self, name, *members):
+        zset = self.lookup(name) or {}
+        self.touch(name)
+        return sum(zset.pop(to_bytes(member), None) is not None
+                   for member in members)
+
+    def do_zremrangebyrank(self, name, start, end):
+        return self.do_zrem(name, *self.do_zrange(name, start, end))
+
+
+class CustomRedis(FakeRedis):
+    """
+    custom_redis没有pipeline及Lua脚本
+    """
+    pipeline = None
+    register_script = None
@@ -0,0 +1,36 @@
+import unittest
+
+from structor.check_status import Progress, format_eta
+
+
+class ProgressTest(unittest.TestCase):
+
+    def test_rolling_speed_and_eta(self):
+        progress = Progress(window=3)
+        data = {"total_pages": "1000", "crawled_pages": "100",
+                "failed_download_pages": "10", "failed_download_items": "15"}
+        row = progress.update("c1", data, now=100)
+        self.assertIsNone(row["pages_per_sec"])
+        self.assertEqual(row["failed"], 25)
+        self.assertAlmostEqual(row["failure_rate"], 0.2)
+
+        for now, crawled in ((110, 200), (120, 300), (130, 360)):
+            data["crawled_pages"] = str(crawled)
+            row = progress.update("c1", data, now=now)
+        # 窗口中只保留最近3次采样：(110, 200) ~ (130, 360)
+        self.assertEqual(row["pages_per_sec"], 8)
+        self.assertEqual(row["remaining"], 640)
+        self.assertEqual(row["eta"], 80)
+        self.assertEqual(format_eta(row["eta"]), "0:01:20")
+
+    def test_stalled(self):
+        progress = Progress()
+        data = {"total_pages": "10", "crawled_pages": "5"}
+        progress.update("c1", data, now=1)
+        row = progress.update("c1", data, now=2)
+        self.assertEqual(row["pages_per_sec"], 0)
+        self.assertIsNone(row["eta"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+
+from structor.circuit_breaker import CircuitBreaker, RetryBudget, SlidingWindow
+
+from tests.fake_redis import FakeRedis
+
+
+class RetryBudgetTest(unittest.TestCase):
+
+    def test_window(self):
+        window = SlidingWindow(10)
+        window.add("a", now=100)
+        window.add("a", 2, now=105)
+        self.assertEqual(window.sum("a", now=109), 3)
+        self.assertEqual(window.sum("a", now=110), 2)
+
+    def test_withdraw(self):
+        budget = RetryBudget(0.5, min_retries=2, window=10)
+        for _ in range(4):
+            budget.deposit(now=100)
+        # 2 + 4 * 0.5
+        self.assertEqual([budget.withdraw(now=101) for _ in range(5)],
+                         [True, True, True, True, False])
+        # 窗口滑过之后恢复
+        self.assertTrue(budget.withdraw(now=111))
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis_conn = FakeRedis()
+        self.breaker = CircuitBreaker(
+            self.redis_conn, "s:circuit_breaker", window=60, threshold=0.5,
+            min_requests=4, open_time=10, probes=1, probe_timeout=5,
+            cache_time=0)
+
+    def test_trip_probe_and_close(self):
+        now = self.redis_conn.now = 100
+        self.assertIsNone(self.breaker.record("a.com", True, now))
+        self.assertIsNone(self.breaker.record("a.com", False, now))
+        self.assertIsNone(self.breaker.record("a.com", False, now))
+        self.assertEqual(self.breaker.record("a.com", False, now), "tripped")
+        self.assertGreaterEqual(self.breaker.wait_time("a.com", now), 10)
+        self.assertEqual(self.breaker.wait_time("b.com", now), 0)
+
+        # 半开状态只放行一个探测请求
+        now = self.redis_conn.now = 111
+        self.assertEqual(self.breaker.wait_time("a.com", now), 0)
+        self.assertGreater(self.breaker.wait_time("a.com", now), 0)
+        self.assertEqual(self.breaker.record("a.com", False, now), "tripped")
+
+        now = self.redis_conn.now = 122
+        self.assertEqual(self.breaker.wait_time("a.com", now), 0)
+        self.assertEqual(self.breaker.record("a.com", True, now), "closed")
+        self.assertEqual(self.breaker.wait_time("a.com", now), 0)
+        self.assertEqual(self.breaker.wait_time("a.com", now), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
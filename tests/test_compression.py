@@ -0,0 +1,109 @@
+import gzip
+import zlib
+import unittest
+
+from scrapy import Spider
+from scrapy.exceptions import IgnoreRequest
+from scrapy.http import Request, Response, HtmlResponse
+from scrapy.utils.test import get_crawler
+
+from structor import settings
+from structor.compression import accepted_encodings, decompress, \
+    MaxSizeExceeded
+from structor.downloadermiddlewares import HttpCompressionMiddleware
+
+ENCODINGS = accepted_encodings()
+
+
+def compress(data, encoding):
+    if encoding == b"br":
+        from structor.compression import import_brotli
+        return import_brotli().compress(data)
+    if encoding == b"zstd":
+        import zstandard
+        return zstandard.ZstdCompressor().compress(data)
+    if encoding == b"deflate":
+        return zlib.compress(data)
+    return gzip.compress(data)
+
+
+def make_middleware(**kwargs):
+    values = {k: getattr(settings, k) for k in dir(settings) if k.isupper()}
+    values.update(kwargs)
+    return HttpCompressionMiddleware.from_crawler(get_crawler(Spider, values))
+
+
+class DecompressTest(unittest.TestCase):
+
+    def test_zlib(self):
+        data = b"<html>%s</html>" % (b"a" * 100000)
+        # 多个member
+        self.assertEqual(decompress(
+            gzip.compress(data) + gzip.compress(b"b") + b"\0\0", b"gzip", 0,
+            1024), data + b"b")
+        self.assertEqual(decompress(zlib.compress(data), b"deflate"), data)
+        raw = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        self.assertEqual(decompress(
+            raw.compress(data) + raw.flush(), b"deflate"), data)
+        # 不完整时返回已解压的部分
+        self.assertTrue(data.startswith(
+            decompress(gzip.compress(data)[:-20], b"gzip")))
+
+    def test_max_size(self):
+        bomb = b"\0" * (10 * 1024 * 1024)
+        for encoding in ENCODINGS:
+            with self.subTest(encoding=encoding):
+                body = compress(bomb, encoding)
+                self.assertRaises(MaxSizeExceeded, decompress,
+                                  body, encoding, 1024 * 1024)
+                self.assertEqual(decompress(body, encoding), bomb)
+
+
+class HttpCompressionMiddlewareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mw = make_middleware()
+        self.spider = Spider("test")
+
+    def test_accept_encoding(self):
+        request = Request("http://a.com/")
+        self.mw.process_request(request, self.spider)
+        self.assertEqual(request.headers["Accept-Encoding"],
+                         b", ".join(ENCODINGS))
+
+    @unittest.skipUnless(b"br" in ENCODINGS and b"zstd" in ENCODINGS,
+                         "brotli or zstandard is not installed")
+    def test_process_response(self):
+        data = b"<html><body>%s</body></html>" % (b"text " * 1000)
+        body = compress(compress(data, b"br"), b"zstd")
+        response = Response("http://a.com/", body=body, headers={
+            "Content-Type": "text/html",
+            "Content-Encoding": "br, zstd"})
+        response = self.mw.process_response(
+            Request("http://a.com/"), response, self.spider)
+        self.assertIsInstance(response, HtmlResponse)
+        self.assertEqual(response.body, data)
+        self.assertNotIn(b"Content-Encoding", response.headers)
+        stats = self.mw.crawler.stats
+        self.assertEqual(stats.get_value(
+            "compression/a.com/compressed_bytes"), len(body))
+        self.assertEqual(stats.get_value(
+            "compression/a.com/decompressed_bytes"), len(data))
+
+    def test_unsupported_and_max_size(self):
+        response = Response("http://a.com/", body=gzip.compress(b"abc"),
+                            headers={"Content-Encoding": "unknown, gzip"})
+        response = self.mw.process_response(
+            Request("http://a.com/"), response, self.spider)
+        self.assertEqual(response.body, b"abc")
+        self.assertEqual(response.headers["Content-Encoding"], b"unknown")
+        mw = make_middleware(DECOMPRESSION_MAX_SIZE=2)
+        self.assertRaises(IgnoreRequest, mw.process_response,
+                          Request("http://a.com/"), Response(
+                              "http://a.com/", body=gzip.compress(b"abc"),
+                              headers={"Content-Encoding": "gzip"}),
+                          self.spider)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import unittest
+from unittest import mock
+
+from scrapy import Spider
+from scrapy.core.downloader import Slot
+from scrapy.http import Request, Response
+from scrapy.utils.test import get_crawler
+from twisted.internet.error import TimeoutError
+
+from structor import settings
+from structor.concurrency_limiters import AIMDLimiter, ConcurrencyGate
+from structor.downloadermiddlewares import AdaptiveConcurrencyMiddleware
+
+
+class AIMDLimiterTest(unittest.TestCase):
+
+    def test_additive_increase(self):
+        limiter = AIMDLimiter(1, 4, initial=1)
+        for _ in range(5):
+            limiter.on_success(0.1, now=1)
+        # 1 -> 2 -> 2.5 -> 2.9 -> 3.24 -> 3.55
+        self.assertEqual(limiter.concurrency, 3)
+        for _ in range(20):
+            limiter.on_success(0.1, now=1)
+        self.assertEqual(limiter.concurrency, 4)
+
+    def test_multiplicative_decrease_once_per_latency(self):
+        limiter = AIMDLimiter(1, 16, initial=10, backoff=0.5)
+        limiter.on_overload(now=100)
+        limiter.on_overload(now=100.5)
+        self.assertEqual(limiter.concurrency, 5)
+        limiter.on_overload(now=101)
+        self.assertEqual(limiter.concurrency, 2)
+        limiter.on_overload(now=102)
+        self.assertEqual(limiter.concurrency, 1)
+
+    def test_latency_overload(self):
+        limiter = AIMDLimiter(1, 16, initial=8, backoff=0.5, tolerance=2)
+        limiter.on_success(0.1, now=100)
+        for i in range(10):
+            limiter.on_success(1, now=200 + i * 10)
+        self.assertLess(limiter.concurrency, 8)
+
+
+class ConcurrencyGateTest(unittest.TestCase):
+
+    def test_acquire_release(self):
+        limiter = AIMDLimiter(1, 16, initial=2)
+        gate = ConcurrencyGate(limiter)
+        fired = []
+        for i in range(3):
+            gate.acquire().addCallback(lambda _, i=i: fired.append(i))
+        self.assertEqual(fired, [0, 1])
+        gate.release()
+        self.assertEqual(fired, [0, 1, 2])
+        limiter.limit = 3
+        gate.acquire().addCallback(lambda _: fired.append(3))
+        self.assertEqual(fired, [0, 1, 2, 3])
+
+
+class AdaptiveConcurrencyMiddlewareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("structor.concurrency_limiters.time.time",
+                             lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        values = {k: getattr(settings, k) for k in dir(settings) if k.isupper()}
+        values.update(CONCURRENT_REQUESTS_PER_IP=0,
+                      CONCURRENT_REQUESTS_PER_DOMAIN=4,
+                      ADAPTIVE_CONCURRENCY_BACKOFF=0.5)
+        crawler = get_crawler(Spider, values)
+        crawler.spider = self.spider = Spider("test")
+        crawler.engine = mock.Mock()
+        self.slot = Slot(4, 0, False)
+        crawler.engine.downloader.slots = {"a.com": self.slot}
+        self.mw = AdaptiveConcurrencyMiddleware.from_crawler(crawler)
+
+    def request(self, proxy=None):
+        meta = {"download_slot": "a.com", "download_latency": 0.1}
+        if proxy:
+            meta["proxy"] = proxy
+        request = Request("http://a.com/", meta=meta)
+        return request, self.mw.process_request(request, self.spider)
+
+    def respond(self, request, status=200):
+        self.mw.process_response(
+            request, Response(request.url, status=status), self.spider)
+
+    def test_slot_concurrency(self):
+        self.respond(self.request()[0], 429)
+        self.assertEqual(self.slot.concurrency, 2)
+        for _ in range(3):
+            self.respond(self.request()[0])
+        # 2 -> 2.5 -> 2.9 -> 3.24
+        self.assertEqual(self.slot.concurrency, 3)
+        self.now += 2
+        request = self.request()[0]
+        self.mw.process_exception(request, TimeoutError(), self.spider)
+        self.assertEqual(self.slot.concurrency, 1)
+        stats = self.mw.crawler.stats
+        self.assertEqual(stats.get_value("adaptive_concurrency/slot:a.com"), 1)
+        self.assertEqual(
+            stats.get_value("adaptive_concurrency/decrease_count"), 2)
+        self.assertEqual(
+            stats.get_value("adaptive_concurrency/increase_count"), 1)
+
+    def test_proxy_gate(self):
+        self.mw.get_limiter("proxy:p1").limit = 1
+        first, d1 = self.request("p1")
+        second, d2 = self.request("p1")
+        self.assertTrue(d1.called)
+        self.assertFalse(d2.called)
+        self.assertEqual(self.mw.crawler.stats.get_value(
+            "adaptive_concurrency/max_waiting"), 1)
+        # 其它代理不受影响
+        self.assertTrue(self.request("p2")[1].called)
+        self.respond(first)
+        self.assertTrue(d2.called)
+        self.assertEqual(self.mw.get_gate("p1").in_flight, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+import unittest
+
+from scrapy import Spider
+from scrapy.http import Request, Response
+from scrapy.utils.test import get_crawler
+
+from structor import settings
+from structor.downloadermiddlewares import CustomCookiesMiddleware
+
+from tests.fake_redis import FakeRedis
+
+try:
+    import tldextract
+except ImportError:
+    tldextract = None
+
+
+def make_middleware(redis_conn=None, **kwargs):
+    values = {k: getattr(settings, k) for k in dir(settings) if k.isupper()}
+    values.update(kwargs)
+    crawler = get_crawler(Spider, values)
+    crawler.spider = Spider("test")
+    crawler.spider.redis_conn = redis_conn
+    return CustomCookiesMiddleware.from_crawler(crawler)
+
+
+class CustomCookiesMiddlewareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spider = Spider("test")
+        self.mw = make_middleware(COOKIES="lang=en; a=1", COOKIES_MAX_JARS=2)
+
+    def send(self, url, **meta):
+        request = Request(url, meta=meta)
+        self.mw.process_request(request, self.spider)
+        return request.headers.get("Cookie", b"").decode()
+
+    def login(self, mw, url, cookie):
+        mw.process_response(Request(url), Response(
+            url, headers={"Set-Cookie": cookie}), self.spider)
+
+    def test_one_jar_by_default(self):
+        self.assertEqual(self.send("http://www.a.com/"), "lang=en; a=1")
+        self.login(self.mw, "http://www.a.com/", "sid=1; Domain=.a.com; Path=/")
+        self.assertIn("sid=1", self.send("http://api.a.com/"))
+        self.assertNotIn("sid=1", self.send("http://b.co.uk/"))
+        self.assertEqual(list(self.mw.jars), ["default"])
+
+    @unittest.skipUnless(tldextract, "tldextract is not installed")
+    def test_partition_by_registered_domain(self):
+        mw = make_middleware(COOKIES_PER_DOMAIN=True)
+        for login, other in (("http://login.abc.de/", "http://www.abc.de/"),
+                             ("http://m.ya.ru/", "http://www.ya.ru/"),
+                             ("http://a.b.co.uk/", "http://b.co.uk/")):
+            domain = login.split("/")[2].split(".", 1)[1]
+            self.login(mw, login, "sid=1; Domain=.%s; Path=/" % domain)
+            request = Request(other)
+            mw.process_request(request, self.spider)
+            self.assertIn(b"sid=1", request.headers.get("Cookie"))
+        request = Request("http://c.co.uk/")
+        mw.process_request(request, self.spider)
+        self.assertNotIn(b"sid=1", request.headers.get("Cookie"))
+        self.assertEqual(list(mw.jars),
+                         ["abc.de", "ya.ru", "b.co.uk", "c.co.uk"])
+
+    def test_cookiejar_meta_and_lru(self):
+        request = Request("http://a.com/", cookies={"user": "x"},
+                          meta={"cookiejar": 1})
+        self.mw.process_request(request, self.spider)
+        self.assertIn("user=x", self.send("http://a.com/", cookiejar=1))
+        self.assertNotIn("user=x", self.send("http://a.com/"))
+        self.send("http://b.com/", cookiejar=2)
+        # jar 1最久未使用，被淘汰
+        self.assertEqual(list(self.mw.jars), ["default", 2])
+
+    def test_static_cookies_on_subdomains(self):
+        mw = make_middleware(COOKIES="userPrefLanguage=en_US")
+        for url in ("http://movie.douban.com/", "http://book.douban.com/",
+                    "http://douban.com/"):
+            request = Request(url)
+            mw.process_request(request, self.spider)
+            self.assertEqual(request.headers.get("Cookie"),
+                             b"userPrefLanguage=en_US")
+        request = Request("http://book.douban.com/",
+                          meta={"dont_update_cookies": True})
+        mw.process_request(request, self.spider)
+        self.assertIsNone(request.headers.get("Cookie"))
+
+    def test_jar_cookie_overrides_static(self):
+        self.send("http://a.com/")
+        self.mw.process_response(Request("http://a.com/"), Response(
+            "http://a.com/", headers={"Set-Cookie": "lang=zh; Path=/"}),
+            self.spider)
+        self.assertEqual(self.send("http://a.com/"), "lang=zh; a=1")
+
+    def test_clear_except(self):
+        self.login(self.mw, "http://a.com/", ["sid=1", "uid=2"])
+        jar = self.mw.jars["default"]
+        jar.clear_except("uid")
+        self.assertEqual(self.send("http://a.com/"), "uid=2; lang=en; a=1")
+
+
+class SharedCookiesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis_conn = FakeRedis()
+        self.workers = [make_middleware(
+            self.redis_conn, COOKIES="lang=en", COOKIES_SHARED=True,
+            CUSTOM_REDIS=False, COOKIES_SHARED_CACHE_TIME=0)
+            for _ in range(2)]
+        self.spider = Spider("test")
+
+    def tearDown(self):
+        for mw in self.workers:
+            mw.spider_closed()
+
+    def send(self, mw, url):
+        request = Request(url)
+        mw.process_request(request, self.spider)
+        return sorted(request.headers.get("Cookie", b"").decode().split("; "))
+
+    def test_session_shared_between_workers(self):
+        first, second = self.workers
+        self.send(first, "http://a.com/login")
+        response = Response("http://a.com/login", headers={
+            "Set-Cookie": ["sid=1; Path=/", "lang=zh; Path=/"]})
+        first.process_response(Request("http://a.com/login"),
+                               response, self.spider)
+        # 写回之前其它进程看不到
+        self.assertEqual(self.send(second, "http://a.com/"), ["lang=en"])
+        first.flush()
+        self.assertEqual(self.send(second, "http://a.com/"), ["lang=zh", "sid=1"])
+        # 新建的CookieJar不会用COOKIES覆盖共享的lang
+        third = make_middleware(self.redis_conn, COOKIES="lang=en",
+                                COOKIES_SHARED=True, CUSTOM_REDIS=False)
+        self.workers.append(third)
+        self.assertEqual(self.send(third, "http://a.com/"), ["lang=zh", "sid=1"])
+
+    def test_deleted_cookie_is_removed_from_redis(self):
+        first, second = self.workers
+        self.send(first, "http://a.com/")
+        first.process_response(Request("http://a.com/"), Response(
+            "http://a.com/", headers={"Set-Cookie": "sid=1; Path=/"}),
+            self.spider)
+        first.flush()
+        self.assertEqual(self.send(second, "http://a.com/"), ["lang=en", "sid=1"])
+        first.process_response(Request("http://a.com/"), Response(
+            "http://a.com/", headers={"Set-Cookie": "sid=; Max-Age=0; Path=/"}),
+            self.spider)
+        first.flush()
+        self.assertEqual(self.send(second, "http://a.com/"), ["lang=en"])
+        self.assertNotIn("test:cookies:default", self.redis_conn.data)
+
+
+if __name__ == "__main__":
+    unittest.main()
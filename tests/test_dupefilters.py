@@ -0,0 +1,172 @@
+import os
+import time
+import shutil
+import socket
+import unittest
+import subprocess
+
+from unittest import mock
+
+from redis import Redis
+from scrapy.exceptions import NotConfigured
+from scrapy.http import HtmlResponse
+from scrapy.settings import Settings
+from scrapy.utils.test import get_crawler
+
+from structor import settings as default_settings
+from structor.custom_request import Request
+from structor.dupefilters import BloomFilter, SetFilter, load_dupefilter
+from structor.spiders import StructureSpider
+
+from tests.fake_redis import FakeRedis, CustomRedis
+
+# 布隆过滤器的集成测试需要redis-server，可以通过环境变量指定路径
+REDIS_SERVER_PATH = os.environ.get("REDIS_SERVER_PATH") or \
+    shutil.which("redis-server")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class LoadDupefilterTest(unittest.TestCase):
+
+    def test_custom_redis(self):
+        settings = Settings({
+            "CUSTOM_REDIS": True,
+            "DUPLICATE_FILTER_CLASS": "structor.dupefilters.BloomFilter"})
+        self.assertRaises(NotConfigured, BloomFilter.from_settings,
+                          None, settings)
+        logger = mock.Mock()
+        self.assertIsInstance(load_dupefilter(None, settings, logger),
+                              SetFilter)
+        self.assertTrue(logger.warning.called)
+
+
+class SetFilterTest(unittest.TestCase):
+
+    def test_exists_or_add_many(self):
+        redis_conn = FakeRedis()
+        dupefilter = SetFilter(redis_conn, 60)
+        self.assertEqual(dupefilter.exists_or_add_many("test", ["a", "b", "a"]),
+                         [False, False, True])
+        # 一批只需要一次往返
+        self.assertEqual(redis_conn.round_trips, 1)
+        self.assertEqual(redis_conn.transactions, [False])
+        self.assertEqual(redis_conn.calls, ["sadd", "sadd", "sadd", "expire"])
+        self.assertEqual(dupefilter.exists_or_add_many("test", ["c", "b"]),
+                         [False, True])
+        self.assertEqual(redis_conn.round_trips, 2)
+        self.assertEqual(dupefilter.exists_or_add_many("test", []), [])
+        self.assertEqual(redis_conn.round_trips, 2)
+        self.assertGreater(redis_conn.ttl("test"), 0)
+
+    def test_custom_redis(self):
+        redis_conn = CustomRedis()
+        dupefilter = SetFilter(redis_conn, 60, custom=True)
+        self.assertEqual(dupefilter.exists_or_add_many("test", ["a", "b", "a"]),
+                         [False, False, True])
+        self.assertEqual(redis_conn.smembers("test"), {b"a", b"b"})
+
+
+class ListSpider(StructureSpider):
+    name = "list"
+    item_pattern = ('//a[@class="item"]/@href',)
+
+    def need_duplicate(self, url):
+        return url.split("?")[0]
+
+
+class DuplicateFilterManyTest(unittest.TestCase):
+
+    def setUp(self):
+        values = {k: getattr(default_settings, k)
+                  for k in dir(default_settings) if k.isupper()}
+        values.update(CUSTOM_REDIS=False,
+                      DUPLICATE_FILTER_CLASS="structor.dupefilters.SetFilter")
+        crawler = get_crawler(ListSpider, values)
+        crawler.spider = self.spider = crawler._create_spider()
+        crawler.stats = mock.Mock()
+        self.redis_conn = FakeRedis()
+        self.spider.set_redis(self.redis_conn)
+
+    def parse(self, *hrefs):
+        body = "".join('<a class="item" href="%s">item</a>' % href
+                       for href in hrefs)
+        request = Request("http://www.a.com/list", callback="parse",
+                          meta={"crawlid": "c1", "priority": 100})
+        response = HtmlResponse(request.url, body=body.encode(),
+                                encoding="utf-8", request=request)
+        return sorted(r.url for r in self.spider.parse(response))
+
+    def test_parse(self):
+        self.assertEqual(self.parse("/a?x=1", "/b"),
+                         ["http://www.a.com/a?x=1", "http://www.a.com/b"])
+        self.spider.crawler.stats.inc_total_pages.assert_called_with("c1", 2)
+        # 按need_duplicate的返回值去重，整页的去重只需要一次往返
+        self.redis_conn.round_trips = 0
+        self.assertEqual(self.parse("/a?x=2", "/b", "/c"),
+                         ["http://www.a.com/c"])
+        self.assertEqual(self.redis_conn.round_trips, 1)
+        self.spider.crawler.stats.inc_total_pages.assert_called_with("c1", 1)
+        self.assertEqual(self.redis_conn.smembers("crawlid:c1:model"), {
+            b"http://www.a.com/a", b"http://www.a.com/b", b"http://www.a.com/c"})
+
+
+@unittest.skipUnless(REDIS_SERVER_PATH, "redis-server is not installed")
+class BloomFilterTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        port = free_port()
+        cls.server = subprocess.Popen(
+            [REDIS_SERVER_PATH, "--port", str(port), "--save", "",
+             "--appendonly", "no"], stdout=subprocess.DEVNULL)
+        cls.redis_conn = Redis(port=port)
+        for _ in range(50):
+            try:
+                cls.redis_conn.ping()
+                break
+            except Exception:
+                time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.terminate()
+        cls.server.wait()
+
+    def setUp(self):
+        self.redis_conn.flushdb()
+
+    def add(self, bloom, values, batch=1000):
+        return [found for i in range(0, len(values), batch)
+                for found in bloom.exists_or_add_many(
+                    "test", values[i:i + batch])]
+
+    def test_error_rate(self):
+        bloom = BloomFilter(self.redis_conn, 0, capacity=1000, error_rate=0.01)
+        values = ["http://www.a.com/item/%s" % i for i in range(30000)]
+        # 扩容到多层之后整体误判率仍然不超过error_rate
+        found = self.add(bloom, values)
+        self.assertGreaterEqual(self.redis_conn.hlen("test:bloom:count"), 5)
+        self.assertLessEqual(sum(found) / len(found), 0.01)
+        probes = self.add(
+            bloom, ["http://www.b.com/p/%s" % i for i in range(10000)])
+        self.assertLessEqual(sum(probes) / len(probes), 0.01)
+        # 没有漏判
+        self.assertTrue(all(self.add(bloom, values)))
+
+    def test_exists_or_add(self):
+        bloom = BloomFilter(self.redis_conn, 60)
+        self.assertFalse(bloom.exists_or_add("test", "http://www.a.com/"))
+        self.assertTrue(bloom.exists_or_add("test", "http://www.a.com/"))
+        self.assertEqual(bloom.exists_or_add_many(
+            "test", ["http://www.b.com/", "http://www.b.com/",
+                     "http://www.a.com/"]), [False, True, True])
+        self.assertGreater(self.redis_conn.ttl("test:bloom"), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
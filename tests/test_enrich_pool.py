@@ -0,0 +1,79 @@
+import threading
+import unittest
+
+from concurrent.futures import Future
+from unittest import mock
+
+from scrapy.http import HtmlResponse, Request
+from scrapy.utils.test import get_crawler
+
+from structor import settings, enrich_pool
+from structor.spiders import StructureSpider
+from structor.enrich_pool import EnrichPool
+
+
+class TitleSpider(StructureSpider):
+    name = "title"
+
+    def parse_title(self, response):
+        # 子进程中不应使用缓冲的统计信息
+        yield {"title": response.xpath("//title/text()").extract_first(),
+               "buffered": self.crawler.stats.buffered}
+
+
+def make_spider(**kwargs):
+    values = {k: getattr(settings, k) for k in dir(settings) if k.isupper()}
+    values.update(CUSTOM_REDIS=False, **kwargs)
+    crawler = get_crawler(TitleSpider, values)
+    crawler.spider = crawler._create_spider()
+    return crawler.spider
+
+
+class EnrichPoolTest(unittest.TestCase):
+
+    def test_fallback(self):
+        self.assertIsNone(make_spider(ENRICH_PROCESSES=0).enrich_pool)
+        # 没有外部存储或外部存储不能共享时在reactor线程中执行
+        self.assertIsNone(make_spider(ENRICH_PROCESSES=1).enrich_pool)
+        self.assertIsNone(make_spider(
+            ENRICH_PROCESSES=1,
+            ITEM_COLLECTOR_STORE="structor.collector_stores.LocalCollectorStore"
+        ).enrich_pool)
+        self.assertIsInstance(make_spider(
+            ENRICH_PROCESSES=1,
+            ITEM_COLLECTOR_STORE="structor.collector_stores.RedisCollectorStore"
+        ).enrich_pool, EnrichPool)
+
+    def test_run(self):
+        spider = make_spider(STATS_BUFFERED=True)
+        pool = EnrichPool(spider.crawler, 1)
+        response = HtmlResponse(
+            "http://a.com/", body=b"<html><title>abc</title></html>",
+            request=Request("http://a.com/"))
+        results, done = list(), threading.Event()
+        with mock.patch.object(enrich_pool, "reactor") as reactor:
+            # 没有运行reactor，直接在回调线程中触发
+            reactor.callFromThread.side_effect = lambda f, *args: f(*args)
+            d = pool.run("parse_title", response)
+            d.addBoth(results.append)
+            d.addBoth(lambda _: done.set())
+            self.assertTrue(done.wait(60))
+            self.assertEqual(results, [[{"title": "abc", "buffered": False}]])
+            self.assertFalse(pool.futures)
+            stats = spider.crawler.stats
+            self.assertEqual(
+                stats.get_value("enrich_pool/parse_title/count"), 1)
+        # 关闭时取消未开始的回调，在线程中等待子进程退出
+        pending = Future()
+        pool.futures.add(pending)
+        executor = pool.executor
+        with mock.patch.object(enrich_pool, "threads") as threads:
+            pool.close()
+            threads.deferToThread.assert_called_once_with(executor.shutdown)
+        self.assertTrue(pending.cancelled())
+        self.assertIsNone(pool.executor)
+        executor.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import gzip
+import json
+import shutil
+import tempfile
+import unittest
+
+from scrapy import Item, Field, Spider
+from scrapy.utils.test import get_crawler
+
+from structor import settings
+from structor.pipelines import FilePipeline
+
+
+class Book(Item):
+    crawlid = Field()
+    spiderid = Field()
+    title = Field()
+
+
+def make_pipeline(**kwargs):
+    values = {k: getattr(settings, k) for k in dir(settings) if k.isupper()}
+    values.update(kwargs)
+    return FilePipeline.from_crawler(get_crawler(Spider, values))
+
+
+class FilePipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write(self, pipeline, count, crawlid="c1"):
+        for i in range(count):
+            pipeline.process_item(
+                Book(crawlid=crawlid, spiderid="douban", title="book%s" % i),
+                Spider("douban"))
+
+    def test_rotate_and_partition(self):
+        pipeline = make_pipeline(FILE_SINK_DIR=self.directory,
+                                 FILE_SINK_MAX_ITEMS=2)
+        self.write(pipeline, 5)
+        self.write(pipeline, 1, "c2")
+        pipeline.spider_closed()
+
+        directory = os.path.join(self.directory, "douban", "c1")
+        self.assertEqual(sorted(os.listdir(directory)), [
+            "part-00000.jsonl", "part-00001.jsonl", "part-00002.jsonl"])
+        with open(os.path.join(directory, "part-00002.jsonl")) as f:
+            self.assertEqual([json.loads(line)["title"] for line in f],
+                             ["book4"])
+        self.assertTrue(os.path.exists(os.path.join(
+            self.directory, "douban", "c2", "part-00000.jsonl")))
+
+        # 再次运行时不覆盖之前的文件
+        pipeline = make_pipeline(FILE_SINK_DIR=self.directory)
+        self.write(pipeline, 1)
+        pipeline.spider_closed()
+        self.assertEqual(len(os.listdir(directory)), 4)
+
+    def test_gzip(self):
+        pipeline = make_pipeline(FILE_SINK_DIR=self.directory,
+                                 FILE_SINK_COMPRESS="gzip")
+        self.write(pipeline, 3)
+        pipeline.sync()
+        self.write(pipeline, 2)
+        pipeline.spider_closed()
+        with gzip.open(os.path.join(
+                self.directory, "douban", "c1", "part-00000.jsonl.gz")) as f:
+            self.assertEqual(len(f.read().splitlines()), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
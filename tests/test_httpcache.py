@@ -0,0 +1,87 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from scrapy import Spider
+from scrapy.exceptions import IgnoreRequest
+from scrapy.http import Request, HtmlResponse
+from scrapy.utils.test import get_crawler
+
+from structor import settings
+from structor.httpcache import SqliteCacheStorage
+
+
+class SqliteCacheStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def open(self, **kwargs):
+        values = {k: getattr(settings, k) for k in dir(settings) if k.isupper()}
+        values.update(HTTPCACHE_DIR=self.cachedir, **kwargs)
+        crawler = get_crawler(Spider, values)
+        spider = Spider.from_crawler(crawler, "test")
+        storage = SqliteCacheStorage(crawler.settings)
+        storage.open_spider(spider)
+        return storage, spider
+
+    def store(self, storage, spider, url, body):
+        response = HtmlResponse(url, body=body, headers={"X-Test": "1"})
+        storage.store_response(spider, Request(url), response)
+
+    def test_store_and_retrieve(self):
+        storage, spider = self.open()
+        body = b"<html>%s</html>" % (b"a" * 10000)
+        self.store(storage, spider, "http://a.com/1", body)
+        self.store(storage, spider, "http://a.com/2", body)
+        storage.close_spider(spider)
+        storage, spider = self.open(HTTPCACHE_REPLAY_ONLY=True)
+        response = storage.retrieve_response(spider, Request("http://a.com/2"))
+        self.assertIsInstance(response, HtmlResponse)
+        self.assertEqual(response.body, body)
+        self.assertEqual(response.headers["X-Test"], b"1")
+        # 相同的响应体只保存一份
+        self.assertEqual(storage.db.execute(
+            "SELECT COUNT(*) FROM bodies").fetchone()[0], 1)
+        self.assertLess(storage.size, 1000)
+        self.assertRaises(IgnoreRequest, storage.retrieve_response,
+                          spider, Request("http://a.com/3"))
+        storage.close_spider(spider)
+        self.assertTrue(os.path.exists(os.path.join(self.cachedir, "test.db")))
+
+    def test_expiration(self):
+        storage, spider = self.open(HTTPCACHE_EXPIRATION_SECS=10)
+        self.store(storage, spider, "http://a.com/1", b"1")
+        storage.db.execute("UPDATE responses SET stored = ?",
+                           (time.time() - 20,))
+        self.assertIsNone(
+            storage.retrieve_response(spider, Request("http://a.com/1")))
+        self.assertEqual(storage.evict(), 1)
+        storage.close_spider(spider)
+
+    def test_lru_eviction(self):
+        storage, spider = self.open(HTTPCACHE_MAX_SIZE=0)
+        for i in range(5):
+            self.store(storage, spider, "http://a.com/%s" % i, os.urandom(30))
+        storage.commit()
+        size = storage.size // 5
+        storage.db.execute("UPDATE responses SET accessed = 0")
+        # 访问过的响应最后淘汰
+        storage.retrieve_response(spider, Request("http://a.com/0"))
+        storage.commit()
+        storage.max_size = size * 3
+        self.assertEqual(storage.evict(), 3)
+        urls = [row[0] for row in storage.db.execute(
+            "SELECT url FROM responses ORDER BY accessed")]
+        self.assertEqual(len(urls), 2)
+        self.assertEqual(urls[-1], "http://a.com/0")
+        self.assertLessEqual(storage.size, size * 3 * 0.9)
+        storage.close_spider(spider)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+from unittest import mock
+
+from scrapy import Item, Field, Spider
+from scrapy.utils.test import get_crawler
+from twisted.internet import defer
+
+from structor import settings
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+class Sub(Item):
+    name = Field()
+
+
+class Book(Item):
+    url = Field()
+    title = Field()
+    subs = Field()
+
+
+def make_pipeline(**kwargs):
+    from structor.pipelines import MongoPipeline
+    values = {k: getattr(settings, k) for k in dir(settings) if k.isupper()}
+    values.update(MONGO_DB="test", MONGO_TABLE="books", **kwargs)
+    with mock.patch("pymongo.MongoClient", mongomock.MongoClient):
+        return MongoPipeline.from_crawler(get_crawler(Spider, values))
+
+
+@unittest.skipUnless(mongomock, "mongomock is not installed")
+@mock.patch("structor.pipelines.threads.deferToThread", defer.maybeDeferred)
+class MongoPipelineTest(unittest.TestCase):
+
+    def make_item(self, i):
+        return Book(url="http://www.douban.com/%s" % i, title="book%s" % i,
+                    subs=[Sub(name="s1"), Sub(name="s2")])
+
+    def test_batch(self):
+        pipeline = make_pipeline(MONGO_BATCH_SIZE=2)
+        results = []
+        for i in range(3):
+            pipeline.process_item(
+                self.make_item(i), None).addCallback(results.append)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(pipeline.col.count_documents({}), 2)
+
+        pipeline.spider_closed()
+        self.assertEqual(len(results), 3)
+        self.assertIsInstance(results[0], Book)
+        doc = pipeline.col.find_one({"title": "book0"}, {"_id": 0})
+        self.assertEqual(doc["subs"], [{"name": "s1"}, {"name": "s2"}])
+        self.assertEqual(
+            pipeline.crawler.stats.get_value("mongo/batch_count"), 2)
+
+    def test_upsert(self):
+        pipeline = make_pipeline(MONGO_UPSERT_KEY="url")
+        for title in ("old", "new"):
+            item = self.make_item(0)
+            item["title"] = title
+            pipeline.process_item(item, None)
+            pipeline.flush()
+        self.assertEqual(pipeline.col.count_documents({}), 1)
+        self.assertEqual(pipeline.col.find_one()["title"], "new")
+
+    def test_rejected_documents(self):
+        from pymongo.errors import WriteError
+        pipeline = make_pipeline(MONGO_BATCH_SIZE=3)
+        pipeline.col.create_index("url", unique=True)
+        results = []
+        for i in (0, 0, 1):
+            pipeline.process_item(
+                self.make_item(i), None).addBoth(results.append)
+        # 重复的url被拒绝，其余文档正常写入
+        self.assertIsInstance(results[0], Book)
+        self.assertIsInstance(results[1].value, WriteError)
+        self.assertIsInstance(results[2], Book)
+        results[1].trap(WriteError)
+        stats = pipeline.crawler.stats
+        self.assertEqual(stats.get_value("mongo/item_count"), 2)
+        self.assertEqual(stats.get_value("mongo/failed_count"), 1)
+        self.assertEqual(pipeline.col.count_documents({}), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
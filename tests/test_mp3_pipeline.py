@@ -0,0 +1,159 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from unittest import mock
+
+from scrapy import Spider
+from scrapy.utils.test import get_crawler
+
+from structor import settings
+from twisted.internet import defer
+
+from structor.pipelines import Mp3DownloadPipeline
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, chunks=(), headers=None, error=None):
+        self.status_code = status_code
+        self.chunks = chunks
+        self.headers = headers or {}
+        self.error = error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise IOError(self.status_code)
+
+    def iter_content(self, chunk_size):
+        yield from self.chunks
+        if self.error:
+            raise self.error
+
+
+class FakeSession(object):
+    responses = list()
+    requests = list()
+
+    def get(self, url, stream, headers, timeout):
+        self.requests.append(headers)
+        return self.responses.pop(0)
+
+
+class Mp3DownloadPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        values = {k: getattr(settings, k) for k in dir(settings) if k.isupper()}
+        values.update(MP3_DOWNLOAD_DIR=self.directory)
+        self.pipeline = Mp3DownloadPipeline.from_crawler(
+            get_crawler(Spider, values))
+        self.pipeline.session_class = FakeSession
+        FakeSession.responses, FakeSession.requests = list(), list()
+
+    def read(self, filename):
+        with open(os.path.join(self.directory, filename), "rb") as f:
+            return f.read()
+
+    def test_resume(self):
+        disposition = {"Content-Disposition": 'attachment; filename="%E6%AD%8C.mp3"'}
+        FakeSession.responses = [
+            FakeResponse(200, [b"abc"], disposition, IOError("reset")),
+            FakeResponse(206, [b"def"], disposition)]
+        self.assertRaises(IOError, self.pipeline.download, "http://a.com/1", "1.mp3")
+        self.assertEqual(self.pipeline.download("http://a.com/1", "1.mp3")[0], 3)
+        self.assertEqual(FakeSession.requests[1], {"Range": "bytes=3-"})
+        self.assertEqual(self.read("歌.mp3"), b"abcdef")
+        self.assertEqual(os.listdir(self.directory), ["歌.mp3"])
+
+    def test_416_uses_saved_filename(self):
+        # 临时文件已经完整，但重命名之前被中断
+        with open(os.path.join(self.directory, "1.mp3.part"), "wb") as f:
+            f.write(b"abc")
+        with open(os.path.join(self.directory, "1.mp3.part.name"), "w",
+                  encoding="utf-8") as f:
+            f.write("song.mp3")
+        FakeSession.responses = [FakeResponse(416)]
+        self.assertEqual(self.pipeline.download("http://a.com/1", "1.mp3")[0], 0)
+        self.assertEqual(FakeSession.requests, [{"Range": "bytes=3-"}])
+        self.assertEqual(os.listdir(self.directory), ["song.mp3"])
+        self.assertEqual(self.read("song.mp3"), b"abc")
+
+    def test_session_per_thread(self):
+        sessions = [self.pipeline.session]
+        thread = threading.Thread(
+            target=lambda: sessions.append(self.pipeline.session))
+        thread.start()
+        thread.join()
+        self.assertIs(self.pipeline.session, sessions[0])
+        self.assertIsNot(sessions[0], sessions[1])
+
+
+class ProcessItemTest(unittest.TestCase):
+
+    def setUp(self):
+        values = {k: getattr(settings, k) for k in dir(settings) if k.isupper()}
+        self.pipeline = Mp3DownloadPipeline.from_crawler(
+            get_crawler(Spider, values))
+        self.pipeline.pool = mock.Mock()
+        self.downloads = list()
+        patcher = mock.patch("structor.pipelines.threads.deferToThreadPool",
+                             self.defer_to_thread_pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def defer_to_thread_pool(self, reactor, pool, func, url, name):
+        d = defer.Deferred()
+        self.downloads.append((url, name, d))
+        return d
+
+    def process(self, url, name):
+        results = list()
+        self.pipeline.process_item(
+            {"source_url": url, "name": name}, None).addBoth(results.append)
+        return results
+
+    def test_same_name_serialized(self):
+        first = self.process("http://a.com/1", "song")
+        second = self.process("http://a.com/2", "song")
+        other = self.process("http://a.com/3", "other")
+        # 同名的文件共用song.mp3.part，等待第一个下载完成
+        self.assertEqual([x[:2] for x in self.downloads], [
+            ("http://a.com/1", "song.mp3"), ("http://a.com/3", "other.mp3")])
+        self.downloads[0][2].callback((3, 0.1))
+        self.assertEqual(first[0]["source_url"], "http://a.com/1")
+        self.assertEqual(self.downloads[2][:2], ("http://a.com/2", "song.mp3"))
+        self.assertFalse(second)
+        self.downloads[2][2].callback((3, 0.1))
+        self.downloads[1][2].errback(IOError("reset"))
+        self.assertEqual(second[0]["source_url"], "http://a.com/2")
+        self.assertIsInstance(other[0].value, IOError)
+        other[0].trap(IOError)
+        self.assertEqual(self.pipeline.locks, {})
+        stats = self.pipeline.crawler.stats
+        self.assertEqual(stats.get_value("mp3/file_count"), 2)
+        self.assertEqual(stats.get_value("mp3/failed_count"), 1)
+
+    def test_close_waits_for_downloads(self):
+        self.process("http://a.com/1", "song")
+        closed = list()
+        self.pipeline.spider_closed().addCallback(closed.append)
+        # 下载完成之前不停止线程池
+        self.assertFalse(closed)
+        self.pipeline.pool.stop.assert_not_called()
+        self.downloads[0][2].callback((3, 0.1))
+        self.assertTrue(closed)
+        self.pipeline.pool.stop.assert_called_once_with()
+
+
+if __name__ == "__main__":
+    unittest.main()
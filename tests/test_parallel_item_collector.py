@@ -0,0 +1,249 @@
+import pickle
+import unittest
+
+from unittest import mock
+
+from scrapy import Item, Field
+from scrapy.loader import ItemLoader
+from scrapy.http import HtmlResponse
+from scrapy.utils.test import get_crawler
+
+from structor import settings
+from structor.custom_request import Request
+from structor.item_collector import ParallelItemCollector, Node
+from structor.spiders import StructureSpider
+from structor.utils import TakeAll
+
+from tests.fake_redis import FakeRedis
+
+
+class BaseItem(Item):
+    name = Field()
+    baidu = Field(output_processor=TakeAll())
+    amazon = Field(output_processor=TakeAll())
+
+
+class AmazonItem(Item):
+    name = Field()
+
+
+class Spider(object):
+
+    def enrich_data(self, item_loader, response):
+        return [("baidu", item_loader, {"url": "http://www.baidu.com/"}),
+                ("amazon", ItemLoader(item=AmazonItem()),
+                 {"url": "http://www.amazon.com/"}),
+                ("amazon", ItemLoader(item=AmazonItem()),
+                 {"url": "https://www.amazon.com/"})]
+
+    def enrich_baidu(self, item_loader, response):
+        item_loader.add_value("baidu", response.url)
+        if response.url == "http://www.baidu.com/":
+            return [("baidu", item_loader, {"url": "http://www.baidu.com/2"})]
+
+    def enrich_amazon(self, item_loader, response):
+        item_loader.add_value("name", response.url)
+
+
+def make_response(request):
+    return HtmlResponse(request.url, body=b"<html></html>", request=request)
+
+
+class ParallelItemCollectorTest(unittest.TestCase):
+
+    def test_collect(self):
+        spider = Spider()
+        collector = ParallelItemCollector(
+            Node(None, ItemLoader(item=BaseItem()), None, "enrich_data"))
+        request = Request("http://www.mashichao.com/", meta={"priority": 1})
+        requests = collector.collect(make_response(request), spider)
+        # 全部兄弟节点的请求同时发出
+        self.assertEqual(
+            sorted(r.url for r in requests),
+            ["http://www.amazon.com/", "http://www.baidu.com/",
+             "https://www.amazon.com/"])
+
+        rounds = 1
+        results = list()
+        while requests:
+            rounds += 1
+            pending = list()
+            for request in reversed(requests):
+                pending.extend(collector.collect(make_response(request), spider))
+            requests = [r for r in pending if isinstance(r, Request)]
+            results.extend(r for r in pending if not isinstance(r, Request))
+
+        self.assertEqual(rounds, 3)
+        self.assertEqual(len(results), 1)
+        item = results[0]
+        self.assertEqual(
+            item["baidu"], ["http://www.baidu.com/", "http://www.baidu.com/2"])
+        self.assertEqual(
+            sorted(i["name"][0] for i in item["amazon"]),
+            ["http://www.amazon.com/", "https://www.amazon.com/"])
+        self.assertFalse(collector.nodes)
+        self.assertEqual(collector.request_count, 5)
+
+    def test_no_children(self):
+        collector = ParallelItemCollector(
+            Node(None, ItemLoader(item=AmazonItem()), None, "enrich_amazon"))
+        request = Request("http://www.mashichao.com/", meta={"priority": 1})
+        results = collector.collect(make_response(request), Spider())
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]["name"], ["http://www.mashichao.com/"])
+
+    def test_merge_into_other_copy(self):
+        spider = Spider()
+        collector = ParallelItemCollector(
+            Node(None, ItemLoader(item=BaseItem()), None, "enrich_data"))
+        request = Request("http://www.mashichao.com/", meta={"priority": 1})
+        requests = collector.collect(make_response(request), spider)
+        baidu = [r for r in requests if "baidu" in r.url][0]
+        # 两个分支基于同一个副本enrich，合并到最新的副本中
+        enrichments = [
+            pickle.loads(pickle.dumps(collector)).enrich(
+                make_response(r), spider) for r in requests]
+        for enrichment in enrichments:
+            pickle.loads(pickle.dumps(collector)).merge(enrichment)
+            results = collector.merge(enrichment)
+        self.assertEqual(results, [])
+        self.assertEqual(collector.outstanding, 1)
+        results = collector.collect(make_response(Request(
+            "http://www.baidu.com/2", meta=dict(
+                baidu.meta, item_collector_node=max(collector.nodes)))), spider)
+        self.assertEqual(results[0]["baidu"], [
+            "http://www.baidu.com/", "http://www.baidu.com/2"])
+        self.assertEqual(collector.outstanding, 0)
+
+    def test_fail(self):
+        spider = Spider()
+        collector = ParallelItemCollector(
+            Node(None, ItemLoader(item=BaseItem()), None, "enrich_data"))
+        request = Request("http://www.mashichao.com/", meta={"priority": 1})
+        requests = collector.collect(make_response(request), spider)
+        self.assertEqual(collector.outstanding, 3)
+        self.assertEqual(collector.fail(), 2)
+        # 失败后其余分支只减少计数，不再调用enrich方法
+        with mock.patch.object(spider, "enrich_baidu") as enrich_baidu:
+            for request in requests[1:]:
+                self.assertEqual(
+                    collector.collect(make_response(request), spider), [])
+            enrich_baidu.assert_not_called()
+        self.assertEqual(collector.outstanding, 0)
+
+
+class BookItem(Item):
+    name = Field()
+    price = Field(output_processor=TakeAll())
+    author = Field(output_processor=TakeAll())
+    spiderid = Field()
+    url = Field()
+    seed = Field()
+    timestamp = Field()
+    status_code = Field()
+    status_msg = Field()
+    domain = Field()
+    crawlid = Field()
+    response_url = Field()
+
+
+class BookSpider(StructureSpider):
+    name = "book"
+
+    def __init__(self, *args, **kwargs):
+        super(BookSpider, self).__init__(*args, **kwargs)
+        self.enriched = list()
+
+    def get_base_loader(self, response):
+        return ItemLoader(item=BookItem())
+
+    def enrich_data(self, item_loader, response):
+        item_loader.add_value("name", "book")
+        return [("price", ItemLoader(item=AmazonItem()),
+                 {"url": "http://www.a.com/price"}),
+                ("author", ItemLoader(item=AmazonItem()),
+                 {"url": "http://www.a.com/author"})]
+
+    def enrich_price(self, item_loader, response):
+        self.enriched.append(response.url)
+        if response.meta.get("error"):
+            raise ValueError("price")
+        item_loader.add_value("name", "price")
+
+    def enrich_author(self, item_loader, response):
+        self.enriched.append(response.url)
+        item_loader.add_value("name", "author")
+
+
+class CollectorStoreTest(unittest.TestCase):
+    store = "structor.collector_stores.LocalCollectorStore"
+
+    def setUp(self):
+        values = {k: getattr(settings, k) for k in dir(settings) if k.isupper()}
+        values.update(CUSTOM_REDIS=False, ITEM_COLLECTOR_PARALLEL=True,
+                      ITEM_COLLECTOR_STORE=self.store)
+        crawler = get_crawler(BookSpider, values)
+        crawler.spider = self.spider = crawler._create_spider()
+        crawler.stats = mock.Mock()
+        self.redis = FakeRedis()
+        self.spider.set_redis(self.redis)
+
+    def stored(self):
+        return self.spider.collector_store.collectors
+
+    def start(self):
+        request = Request("http://www.a.com/book", callback="parse_item",
+                          meta={"priority": 1, "crawlid": "c1"})
+        return sorted(list(self.spider.do_parse_item(make_response(request))),
+                      key=lambda r: r.url)
+
+    def parse_next(self, request, **meta):
+        request.meta.update(meta)
+        return list(self.spider.do_parse_next(make_response(request)))
+
+    def test_collect(self):
+        author, price = self.start()
+        self.assertEqual(self.parse_next(price), [])
+        self.assertTrue(self.stored())
+        item, = self.parse_next(author)
+        self.assertEqual(item["name"], ["book"])
+        self.assertEqual(sorted(i["name"] for i in item["author"] + item["price"]),
+                         [["author"], ["price"]])
+        self.assertFalse(self.stored())
+
+    def test_fail(self):
+        author, price = self.start()
+        self.assertEqual(self.parse_next(price, error=True), [])
+        # 另一个分支还未返回，不能删除
+        self.assertTrue(self.stored())
+        self.assertEqual(self.parse_next(author), [])
+        self.assertEqual(self.spider.enriched, [price.url])
+        self.assertFalse(self.stored())
+
+
+class RedisCollectorStoreTest(CollectorStoreTest):
+    store = "structor.collector_stores.RedisCollectorStore"
+
+    def stored(self):
+        return self.redis.data
+
+    def test_concurrent_update(self):
+        author, price = self.start()
+        results = list()
+
+        def concurrent(pipeline):
+            self.redis.on_execute = None
+            results.extend(self.parse_next(author))
+
+        # price合并时author已经被另一个进程收集，重试时不再调用enrich方法
+        self.redis.on_execute = concurrent
+        item, = self.parse_next(price)
+        self.assertEqual(results, [])
+        self.assertEqual(self.spider.enriched, [price.url, author.url])
+        self.assertEqual(sorted(i["name"] for i in item["author"] + item["price"]),
+                         [["author"], ["price"]])
+        self.assertFalse(self.stored())
+
+
+if __name__ == "__main__":
+    unittest.main()
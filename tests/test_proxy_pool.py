@@ -0,0 +1,126 @@
+import json
+import unittest
+from collections import Counter
+
+from scrapy.http import Request, Response
+from scrapy.utils.test import get_crawler
+from twisted.internet.error import TimeoutError
+
+from structor import settings
+from structor.downloadermiddlewares import ProxyMiddleware
+from structor.proxy_pool import ProxyPool, ProxyStat
+from structor.spiders import StructureSpider
+
+from tests.fake_redis import FakeRedis, CustomRedis
+
+
+class ProxyPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis_conn = FakeRedis()
+        self.redis_conn.sadd("good_proxies", "1.1.1.1:80", "2.2.2.2:80")
+        self.pool = ProxyPool(self.redis_conn, ["good_proxies"], max_failures=2)
+        self.pool.refresh()
+
+    def test_choice_weighted_by_health(self):
+        for _ in range(20):
+            self.pool.report("1.1.1.1:80", True, 0.1)
+            self.pool.report("2.2.2.2:80", True, 2)
+        counter = Counter(self.pool.choice() for _ in range(1000))
+        self.assertGreater(counter["1.1.1.1:80"], counter["2.2.2.2:80"] * 5)
+
+    def test_quarantine(self):
+        self.assertFalse(self.pool.report("2.2.2.2:80", False))
+        self.assertTrue(self.pool.report("2.2.2.2:80", False))
+        self.assertEqual(
+            set(self.pool.choice() for _ in range(50)), {"1.1.1.1:80"})
+
+    def test_scores_shared_by_workers(self):
+        self.pool.report("1.1.1.1:80", True, 0.5)
+        self.pool.report("2.2.2.2:80", False)
+        self.pool.report("2.2.2.2:80", False)
+        self.pool.refresh()
+        score = json.loads(
+            self.redis_conn.data["proxy_scores"][b"1.1.1.1:80"])
+        self.assertEqual(score["latency"], 0.5)
+
+        other = ProxyPool(self.redis_conn, ["good_proxies"])
+        other.refresh()
+        self.assertEqual(other.stats["1.1.1.1:80"].latency, 0.5)
+        self.assertGreater(other.stats["2.2.2.2:80"].quarantined_until, 0)
+        self.assertEqual(other.choice(), "1.1.1.1:80")
+
+    def test_custom_redis(self):
+        self.pool.report("1.1.1.1:80", True, 0.5)
+        self.pool.refresh()
+        redis_conn = CustomRedis()
+        redis_conn.data = self.redis_conn.data
+        pool = ProxyPool(redis_conn, ["good_proxies"], custom=True)
+        pool.refresh()
+        self.assertEqual(set(pool.stats), {"1.1.1.1:80", "2.2.2.2:80"})
+        self.assertEqual(pool.stats["1.1.1.1:80"].latency, 0.5)
+
+    def test_stat_ewma(self):
+        stat = ProxyStat()
+        stat.update(False, 1)
+        stat.update(True, 2)
+        self.assertAlmostEqual(stat.success_rate, 0.84)
+        self.assertAlmostEqual(stat.latency, 1.2)
+        self.assertEqual(stat.failures, 0)
+
+
+class ProxyMiddlewareTest(unittest.TestCase):
+
+    def setUp(self):
+        values = {k: getattr(settings, k) for k in dir(settings) if k.isupper()}
+        values.update(CUSTOM_REDIS=False, PROXY_SETS="good_proxies",
+                      PROXY_MAX_FAILURES=2)
+        crawler = get_crawler(StructureSpider, values)
+        crawler.spider = self.spider = crawler._create_spider()
+        self.redis_conn = FakeRedis()
+        self.redis_conn.sadd("good_proxies", "1.1.1.1:80")
+        self.spider.set_redis(self.redis_conn)
+        self.mw = ProxyMiddleware.from_crawler(crawler)
+        self.mw.spider_opened()
+        self.addCleanup(self.mw.spider_closed)
+
+    def send(self, status=200, latency=0.5, exception=None):
+        request = Request("http://www.a.com/")
+        self.mw.process_request(request, self.spider)
+        request.meta["download_latency"] = latency
+        if exception:
+            self.mw.process_exception(request, exception, self.spider)
+        else:
+            self.mw.process_response(
+                request, Response(request.url, status=status), self.spider)
+        return request
+
+    def test_report(self):
+        # 启动时立即加载代理池
+        self.assertTrue(self.mw.refresh_task.running)
+        request = self.send()
+        self.assertEqual(request.meta["proxy"], "http://1.1.1.1:80")
+        stat = self.mw.pool.stats["1.1.1.1:80"]
+        self.assertEqual((stat.samples, stat.latency), (1, 0.5))
+        self.send(status=503)
+        self.assertFalse(self.spider.change_proxy)
+        self.send(exception=TimeoutError())
+        # 连续失败达到PROXY_MAX_FAILURES时隔离并更换代理
+        self.assertGreater(stat.quarantined_until, 0)
+        self.assertEqual(stat.samples, 3)
+        self.assertTrue(self.spider.change_proxy)
+        self.assertEqual(self.mw.crawler.stats.get_value(
+            "proxy/quarantined_count"), 1)
+
+    def test_publish_on_refresh_and_close(self):
+        self.send()
+        self.mw.refresh()
+        self.assertIn(b"1.1.1.1:80", self.redis_conn.hgetall("proxy_scores"))
+        self.redis_conn.delete("proxy_scores")
+        self.mw.spider_closed()
+        self.assertFalse(self.mw.refresh_task.running)
+        self.assertIn(b"1.1.1.1:80", self.redis_conn.hgetall("proxy_scores"))
+
+
+if __name__ == "__main__":
+    unittest.main()
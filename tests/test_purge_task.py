@@ -0,0 +1,45 @@
+import unittest
+
+from structor.purge_task import purge, scan_keys
+
+from tests.fake_redis import FakeRedis
+
+
+def make_redis(keys, unlink=True):
+    redis_conn = FakeRedis()
+    redis_conn.unlink = unlink
+    for key in keys:
+        redis_conn.hset(key, "http://www.a.com/", "404")
+    return redis_conn
+
+
+class PurgeTaskTest(unittest.TestCase):
+
+    def test_scan_keys(self):
+        redis_conn = make_redis(["failed_download_pages:c%s" % i
+                                 for i in range(25)])
+        self.assertEqual(len(list(scan_keys(
+            redis_conn, "failed_download_*:c1*", 10))), 11)
+
+    def test_purge_by_index(self):
+        redis_conn = make_redis(["crawlid:c1", "failed_download_pages:c1",
+                                 "failed_download_pages:c2"])
+        redis_conn.sadd("crawlid:c1:keys", "failed_download_pages:c1")
+        redis_conn.scan = None
+        self.assertEqual(purge(redis_conn, "c1"), 3)
+        self.assertEqual(list(redis_conn.data), ["failed_download_pages:c2"])
+
+    def test_purge_without_index(self):
+        redis_conn = make_redis(["crawlid:c1", "failed_download_pages:c1",
+                                 "failed_download_items:c1",
+                                 "failed_download_pages:c2"], unlink=False)
+        redis_conn.hset("crawlid:c1", "failed_download_pages", 1)
+        self.assertEqual(purge(redis_conn, "c1"), 3)
+        self.assertEqual(list(redis_conn.data), ["failed_download_pages:c2"])
+        self.assertEqual(
+            [c for c in redis_conn.calls if c in ("UNLINK", "DEL")],
+            ["UNLINK", "DEL"])
+
+
+if __name__ == "__main__":
+    unittest.main()
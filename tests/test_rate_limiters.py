@@ -0,0 +1,131 @@
+import unittest
+from unittest import mock
+
+from scrapy import Spider
+from scrapy.http import Request
+from scrapy.utils.test import get_crawler
+from twisted.internet import defer, task
+
+from structor import settings
+from structor.downloadermiddlewares import SpeedLimitedMiddleware
+from structor.rate_limiters import TokenBucket, RedisTokenBucket
+
+from tests.fake_redis import FakeRedis
+
+
+def reserve_script(redis, keys, args):
+    """
+    RedisTokenBucket.RESERVE_SCRIPT的python实现，使用redis.now作为服务器时间
+    """
+    rate, burst = float(args[0]), float(args[1])
+    bucket = redis.do_hgetall(keys[0])
+    tokens = float(bucket.get(b"tokens", burst))
+    last = float(bucket.get(b"last", redis.now))
+    tokens = min(burst, tokens + max(0, redis.now - last) * rate) - 1
+    redis.do_hmset(keys[0], {"tokens": tokens, "last": redis.now})
+    return 0 if tokens >= 0 else int(-tokens / rate * 1000 + 0.999)
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("structor.rate_limiters.time.time",
+                             lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reserve_queues_requests(self):
+        bucket = TokenBucket(rate=2, burst=1)
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0, 0.5, 1.0])
+
+    def test_refill_up_to_burst(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        for _ in range(3):
+            self.assertEqual(bucket.reserve(), 0)
+        self.now += 10
+        self.assertEqual([bucket.reserve() for _ in range(4)], [0, 0, 0, 0.5])
+
+
+class SpeedLimitedMiddlewareTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch("structor.rate_limiters.time.time",
+                             lambda: 1000.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.clock = task.Clock()
+        patcher = mock.patch("structor.downloadermiddlewares.reactor",
+                             self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.redis_conn = FakeRedis()
+        self.redis_conn.scripts[RedisTokenBucket.RESERVE_SCRIPT] = \
+            reserve_script
+
+    def make_middleware(self, **kwargs):
+        values = {k: getattr(settings, k) for k in dir(settings) if k.isupper()}
+        values.update(SPEED=0, SPEED_PER_DOMAIN=0, SPEED_PER_PROXY=0,
+                      SPEED_BURST=1, CUSTOM_REDIS=False)
+        values.update(kwargs)
+        crawler = get_crawler(Spider, values)
+        crawler.spider = Spider("test")
+        crawler.spider.redis_conn = self.redis_conn
+        return SpeedLimitedMiddleware.from_crawler(crawler)
+
+    def send(self, mw, url, proxy=None):
+        request = Request(url, meta={"proxy": proxy} if proxy else {})
+        return mw.process_request(request, mw.crawler.spider)
+
+    def assertDelayed(self, d, delay):
+        self.assertIsInstance(d, defer.Deferred)
+        self.clock.advance(delay - 0.01)
+        self.assertFalse(d.called)
+        self.clock.advance(0.01)
+        self.assertTrue(d.called)
+
+    def test_global(self):
+        mw = self.make_middleware(SPEED=60)
+        self.assertIsNone(self.send(mw, "http://a.com/"))
+        self.assertDelayed(self.send(mw, "http://b.com/"), 1)
+        self.assertEqual(mw.crawler.stats.get_value(
+            "speed_limited/delayed_count"), 1)
+
+    def test_per_domain(self):
+        mw = self.make_middleware(SPEED_PER_DOMAIN=60)
+        self.assertIsNone(self.send(mw, "http://a.com/1"))
+        self.assertIsNone(self.send(mw, "http://b.com/1"))
+        self.assertDelayed(self.send(mw, "http://a.com/2"), 1)
+
+    def test_per_proxy(self):
+        mw = self.make_middleware(SPEED_PER_PROXY=30)
+        self.assertIsNone(self.send(mw, "http://a.com/", "http://1.1.1.1:80"))
+        self.assertIsNone(self.send(mw, "http://a.com/", "http://2.2.2.2:80"))
+        # 没有代理的请求不按代理限速
+        self.assertIsNone(self.send(mw, "http://a.com/"))
+        self.assertDelayed(
+            self.send(mw, "http://b.com/", "http://1.1.1.1:80"), 2)
+
+    def test_shared_global_bucket_only(self):
+        workers = [self.make_middleware(
+            SPEED=60, SPEED_PER_DOMAIN=60, SPEED_SHARED=True)
+            for _ in range(2)]
+        self.assertIsNone(self.send(workers[0], "http://a.com/"))
+        # 整体速度由两个进程共享
+        self.assertDelayed(self.send(workers[1], "http://b.com/"), 1)
+        self.assertEqual(self.redis_conn.round_trips, 2)
+        for mw in workers:
+            self.assertIsInstance(mw.buckets.pop("global"), RedisTokenBucket)
+            self.assertTrue(all(type(bucket) is TokenBucket
+                                for bucket in mw.buckets.values()))
+
+    def test_shared_not_supported_by_custom_redis(self):
+        mw = self.make_middleware(SPEED=60, SPEED_SHARED=True,
+                                  CUSTOM_REDIS=True)
+        self.assertIsNone(self.send(mw, "http://a.com/"))
+        self.assertIs(type(mw.buckets["global"]), TokenBucket)
+        self.assertEqual(self.redis_conn.round_trips, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+import random
+import unittest
+
+from scrapy import Spider
+from scrapy.utils.test import get_crawler
+
+from structor import settings
+from structor.downloadermiddlewares import CustomRetryMiddleware
+
+
+def make_middleware(**kwargs):
+    values = {k: getattr(settings, k) for k in dir(settings) if k.isupper()}
+    values.update(kwargs)
+    return CustomRetryMiddleware.from_crawler(get_crawler(Spider, values))
+
+
+class RetryBackoffTest(unittest.TestCase):
+
+    def test_bucket(self):
+        self.assertEqual(
+            [CustomRetryMiddleware.bucket(n) for n in (1, 2, 3, 4, 5, 8, 9, 100)],
+            ["1", "2", "3-4", "3-4", "5-8", "5-8", "9-16", "65-128"])
+
+    def test_delay(self):
+        random.seed(0)
+        mw = make_middleware(CUSTOM_REDIS=False, RETRY_BACKOFF_BASE=2,
+                             RETRY_BACKOFF_MAX=60)
+        for retries, upper in ((1, 2), (2, 4), (3, 8), (10, 60)):
+            for _ in range(20):
+                delay = mw.get_delay(retries)
+                self.assertTrue(upper / 2 <= delay <= upper)
+
+    def test_custom_redis_retries_immediately(self):
+        mw = make_middleware(CUSTOM_REDIS=True, RETRY_BACKOFF_BASE=2)
+        self.assertEqual(mw.backoff_base, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
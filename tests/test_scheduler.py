@@ -0,0 +1,167 @@
+import unittest
+
+from unittest import mock
+
+from scrapy.utils.test import get_crawler
+
+from structor import settings
+from structor.custom_request import Request
+from structor.scheduler import Scheduler
+from structor.spiders import StructureSpider
+
+from tests.fake_redis import FakeRedis, to_bytes
+
+
+def pop_script(redis, keys, args):
+    items = redis.do_zrange(keys[0], 0, int(args[0]) - 1, withscores=True)
+    redis.do_zremrangebyrank(keys[0], 0, int(args[0]) - 1)
+    return [x for member, score in items for x in (member, to_bytes(score))]
+
+
+def promote_script(redis, keys, args):
+    items = redis.do_zrangebyscore(keys[0], "-inf", args[0], 0, int(args[1]))
+    for item in items:
+        score, _, member = item.partition(b"|")
+        redis.do_zadd(keys[1], member, float(score))
+        redis.do_zrem(keys[0], item)
+    return len(items)
+
+
+def make_scheduler(redis_conn=None, **kwargs):
+    values = {k: getattr(settings, k) for k in dir(settings) if k.isupper()}
+    values.update(CUSTOM_REDIS=False, **kwargs)
+    crawler = get_crawler(StructureSpider, values)
+    crawler.spider = crawler._create_spider()
+    redis_conn = redis_conn or FakeRedis()
+    with mock.patch("redis.Redis", lambda host, port: redis_conn):
+        scheduler = Scheduler.from_crawler(crawler)
+    scheduler.redis_conn.scripts.update({
+        Scheduler.POP_SCRIPT: pop_script,
+        Scheduler.PROMOTE_SCRIPT: promote_script})
+    scheduler.open(crawler.spider)
+    return scheduler
+
+
+def make_request(url, priority=1, **kwargs):
+    return Request(url, meta={"crawlid": "c1", "priority": priority}, **kwargs)
+
+
+class PrefetchBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = make_scheduler(
+            SCHEDULER_PREFETCH=3, SCHEDULER_PREFETCH_LOW_WATER=1)
+        for priority in range(5, 0, -1):
+            self.scheduler.enqueue_request(
+                make_request("http://www.a.com/%s" % priority, priority))
+
+    def queue(self):
+        return self.scheduler.redis_conn.data.get(
+            self.scheduler.queue_name, {})
+
+    def test_pop_from_buffer(self):
+        scheduler = self.scheduler
+        self.assertEqual(scheduler.next_request().url, "http://www.a.com/5")
+        self.assertEqual(len(scheduler.buffer), 2)
+        self.assertEqual(len(self.queue()), 2)
+        # 高于低水位时不访问redis
+        self.assertEqual(scheduler.next_request().url, "http://www.a.com/4")
+        self.assertEqual(len(self.queue()), 2)
+        # 达到低水位时补满缓冲
+        self.assertEqual(scheduler.next_request().url, "http://www.a.com/3")
+        self.assertEqual(len(scheduler.buffer), 2)
+        self.assertEqual(len(self.queue()), 0)
+        self.assertEqual(scheduler.next_request().url, "http://www.a.com/2")
+        self.assertEqual(scheduler.next_request().url, "http://www.a.com/1")
+        self.assertIsNone(scheduler.next_request())
+
+    def test_close_pushes_back(self):
+        scheduler = self.scheduler
+        scheduler.next_request()
+        self.assertEqual(len(self.queue()), 2)
+        scheduler.close("finished")
+        self.assertFalse(scheduler.buffer)
+        # 按原分数放回，优先级顺序不变
+        self.assertEqual(
+            sorted(self.queue().values()), [-4.0, -3.0, -2.0, -1.0])
+        self.assertEqual(
+            [scheduler.serializer.loads(item).url for item, _ in
+             sorted(self.queue().items(), key=lambda x: x[1])],
+            ["http://www.a.com/%s" % i for i in range(4, 0, -1)])
+        # 缓冲为空时不再写入redis
+        scheduler.flush_buffer()
+        self.assertEqual(scheduler.redis_conn.calls.count("zadd"), 6)
+
+
+class RequestSeenTest(unittest.TestCase):
+
+    def test_parse_next_not_filtered(self):
+        scheduler = make_scheduler(
+            SCHEDULER_DUPLICATE=True,
+            DUPLICATE_FILTER_CLASS="structor.dupefilters.SetFilter")
+        self.assertTrue(scheduler.enqueue_request(
+            make_request("http://www.a.com/", callback="parse")))
+        self.assertFalse(scheduler.enqueue_request(
+            make_request("http://www.a.com/", callback="parse")))
+        # item请求树中的子请求即使重复也要放入队列
+        for _ in range(2):
+            self.assertTrue(scheduler.enqueue_request(
+                make_request("http://www.a.com/", callback="parse_next")))
+        self.assertEqual(scheduler.redis_conn.calls.count("zadd"), 3)
+        self.assertEqual(
+            len(scheduler.redis_conn.data["crawlid:c1:requests"]), 1)
+
+
+class DelayedRequestsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000
+        patcher = mock.patch("time.time", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def delay(self, scheduler, url, priority, delay):
+        request = make_request(url, priority, callback="parse")
+        request.meta["retry_delay"] = delay
+        self.assertTrue(scheduler.enqueue_request(request))
+
+    def test_promote(self):
+        scheduler = make_scheduler()
+        redis_conn = scheduler.redis_conn
+        self.delay(scheduler, "http://www.a.com/1", 5, 10)
+        self.delay(scheduler, "http://www.a.com/2", 1, 100)
+        self.assertEqual(redis_conn.zcard(scheduler.delayed_name), 2)
+        self.assertIsNone(scheduler.next_request())
+        # 只移动到期的请求，分数恢复为原来的优先级
+        self.now += 11
+        request = scheduler.next_request()
+        self.assertEqual(request.url, "http://www.a.com/1")
+        self.assertEqual(request.callback, scheduler.spider.parse)
+        self.assertNotIn("retry_delay", request.meta)
+        self.assertEqual(redis_conn.zcard(scheduler.delayed_name), 1)
+        # 未到期时不移动
+        scheduler.promote_delayed(force=True)
+        self.assertEqual(redis_conn.zcard(scheduler.queue_name), 0)
+        self.now += 90
+        scheduler.promote_delayed()
+        self.assertEqual(redis_conn.zrange(
+            scheduler.queue_name, 0, -1, withscores=True)[0][1], -1)
+
+    def test_pending_only_own_requests(self):
+        worker = make_scheduler()
+        other = make_scheduler(worker.redis_conn)
+        self.delay(worker, "http://www.a.com/1", 5, 10)
+        # 其它crawlid或其它进程的延迟请求不影响本进程关闭
+        self.assertTrue(worker.has_pending_requests())
+        self.assertFalse(other.has_pending_requests())
+        self.assertNotIn("zcard", worker.redis_conn.calls)
+        # 到期后移回请求队列，由next_request取出
+        self.now += 11
+        self.assertTrue(worker.has_pending_requests())
+        self.assertEqual(worker.redis_conn.zcard(worker.delayed_name), 0)
+        self.assertFalse(worker.has_pending_requests())
+        self.assertEqual(other.next_request().url, "http://www.a.com/1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+
+from collections import Counter
+from unittest import mock
+
+from scrapy import Item, Field
+from scrapy.http import HtmlResponse, XmlResponse
+from scrapy.loader import ItemLoader
+from scrapy.spidermiddlewares.httperror import HttpError
+from scrapy.utils.test import get_crawler
+from twisted.python.failure import Failure
+
+from structor import settings
+from structor.custom_request import Request
+from structor.spiders import StructureSpider
+from structor.utils import enrich_wrapper, get_selector, release_selector
+
+
+class PageItem(Item):
+    title = Field()
+    header = Field()
+    spiderid = Field()
+    url = Field()
+    seed = Field()
+    timestamp = Field()
+    status_code = Field()
+    status_msg = Field()
+    domain = Field()
+    crawlid = Field()
+    response_url = Field()
+
+
+class PageSpider(StructureSpider):
+    name = "page"
+
+    def get_base_loader(self, response):
+        return ItemLoader(item=PageItem())
+
+    @enrich_wrapper
+    def enrich_data(self, item_loader, response):
+        item_loader.add_value(
+            "title", item_loader.selector.xpath("//title/text()").get())
+        self.enrich_header(item_loader, response)
+
+    @enrich_wrapper
+    def enrich_header(self, item_loader, response):
+        item_loader.add_value(
+            "header", item_loader.selector.xpath("//h1/text()").get())
+
+
+def make_response(cls=HtmlResponse, status=200):
+    request = Request("http://www.a.com/page", callback="parse_item",
+                      meta={"crawlid": "c1", "priority": 1})
+    return cls(request.url, status=status, request=request, encoding="utf-8",
+               body=b"<html><title>t</title><h1>h</h1></html>")
+
+
+class SelectorCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        values = {k: getattr(settings, k) for k in dir(settings) if k.isupper()}
+        values.update(CUSTOM_REDIS=False, ITEM_COLLECTOR_STORE=None)
+        crawler = get_crawler(PageSpider, values)
+        crawler.spider = self.spider = crawler._create_spider()
+        crawler.stats = self.stats = mock.Mock()
+
+    def counters(self):
+        return Counter(args[0] for args, _ in self.stats.inc_value.call_args_list)
+
+    def test_parse_once(self):
+        response = make_response()
+        item, = self.spider.do_parse_item(response)
+        self.assertEqual((item["title"], item["header"]), (["t"], ["h"]))
+        # enrich_base_data、enrich_data、enrich_header共用一个selector
+        self.assertEqual(self.counters(), {"enrich/response_decoded": 1,
+                                           "enrich/selector_parsed": 1,
+                                           "enrich/selector_reused": 2})
+        # 回调完成后释放
+        self.assertIsNone(response._cached_selector)
+        self.assertIsNone(response._cached_ubody)
+
+    def test_xml_response(self):
+        response = make_response(XmlResponse)
+        selector = get_selector(response, self.stats)
+        # enrich中保持html的解析方式，与response.selector分开缓存
+        self.assertIs(response._enrich_selector, selector)
+        self.assertEqual(selector.type, "html")
+        self.assertEqual(response.selector.type, "xml")
+        self.assertIs(get_selector(response, self.stats), selector)
+        self.assertEqual(self.counters()["enrich/selector_reused"], 1)
+        release_selector(response)
+        for attr in ("_enrich_selector", "_cached_selector", "_cached_ubody"):
+            self.assertIsNone(getattr(response, attr))
+
+    def test_errback_releases_selector(self):
+        response = make_response(status=500)
+        item = self.spider.errback(Failure(HttpError(response)))
+        self.assertEqual(item["status_code"], [500])
+        self.assertIsNone(response._cached_selector)
+        self.assertIsNone(response._cached_ubody)
+
+
+if __name__ == "__main__":
+    unittest.main()
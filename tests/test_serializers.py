@@ -0,0 +1,111 @@
+import pickle
+import unittest
+from collections import OrderedDict
+
+from scrapy.http import FormRequest
+
+from structor.custom_request import Request
+from structor.serializers import PickleSerializer, CompactSerializer, loads
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class Collector(object):
+
+    def __init__(self, value):
+        self.value = value
+
+
+def make_request():
+    return Request(
+        "http://www.douban.com/subject/1/", callback="parse_next",
+        errback="errback", headers={"Referer": "http://www.douban.com/"},
+        meta={"crawlid": "douban", "priority": 80,
+              "item_collector": Collector([1, 2])})
+
+
+class SerializerTest(unittest.TestCase):
+
+    def assert_same(self, req, other):
+        self.assertEqual(req.url, other.url)
+        self.assertEqual(req.callback, other.callback)
+        self.assertEqual(req.errback, other.errback)
+        self.assertEqual(req.headers.getlist("Referer"),
+                         other.headers.getlist("Referer"))
+        self.assertEqual(req.meta["priority"], other.meta["priority"])
+        self.assertEqual(req.meta["item_collector"].value,
+                         other.meta["item_collector"].value)
+
+    def test_pickle(self):
+        req = make_request()
+        self.assert_same(req, loads(PickleSerializer().dumps(req)))
+
+    def test_pickle_compress(self):
+        self.assertRaises(ValueError, PickleSerializer, "zstd")
+
+    @unittest.skipUnless(msgpack, "msgpack is not installed. ")
+    def test_legacy_entry(self):
+        req = make_request()
+        self.assert_same(req, CompactSerializer().loads(pickle.dumps(req)))
+
+    @unittest.skipUnless(msgpack, "msgpack is not installed. ")
+    def test_missing_fields(self):
+        # 只有前几个属性的元素，其余使用默认值
+        req = loads(b"\x01" + msgpack.packb(
+            ["http://www.douban.com/", "GET", {}, b"", "parse"],
+            use_bin_type=True))
+        self.assertEqual(req.url, "http://www.douban.com/")
+        self.assertEqual(req.callback, "parse")
+        self.assertEqual(req.priority, 0)
+        self.assertEqual(req.meta, {})
+        self.assertEqual(req.flags, [])
+        self.assertFalse(req.dont_filter)
+
+    @unittest.skipUnless(msgpack, "msgpack is not installed. ")
+    def test_compact(self):
+        req = make_request()
+        data = CompactSerializer().dumps(req)
+        self.assertEqual(data[0], 0x01)
+        self.assert_same(req, loads(data))
+
+    @unittest.skipUnless(msgpack, "msgpack is not installed. ")
+    def test_compact_keeps_types(self):
+        req = make_request()
+        req.meta.update(pair=(1, 2), ordered=OrderedDict(a=1), tags=["a"])
+        other = loads(CompactSerializer().dumps(req))
+        self.assertEqual(other.meta["pair"], (1, 2))
+        self.assertIs(type(other.meta["ordered"]), OrderedDict)
+        self.assertEqual(other.meta["tags"], ["a"])
+
+    @unittest.skipUnless(msgpack, "msgpack is not installed. ")
+    def test_compact_request_subclass(self):
+        req = FormRequest("http://www.douban.com/login",
+                          formdata={"user": "a"}, meta={"crawlid": "douban"})
+        data = CompactSerializer().dumps(req)
+        # 其它类型的请求回退到pickle
+        self.assertEqual(data[0], 0x80)
+        other = loads(data)
+        self.assertIs(type(other), FormRequest)
+        self.assertEqual((other.method, other.body), ("POST", b"user=a"))
+
+    @unittest.skipUnless(msgpack and zstandard, "zstandard is not installed. ")
+    def test_compact_zstd(self):
+        req = make_request()
+        data = CompactSerializer("zstd").dumps(req)
+        self.assertEqual(data[0], 0x02)
+        self.assert_same(req, loads(data))
+
+    def test_unknown_version(self):
+        self.assertRaises(ValueError, loads, b"\x7fabc")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+from unittest import mock
+
+from redis import RedisError
+
+from structor.spider_feeder import SpiderFeeder
+
+from tests.fake_redis import FakeRedis
+
+
+def fail_after(redis, count):
+    """
+    前count次pipeline执行成功，之后全部失败
+    """
+    def on_execute(pipeline):
+        nonlocal count
+        if not count:
+            raise RedisError("redis is down")
+        count -= 1
+    redis.on_execute = on_execute
+
+
+def make_feeder(urls_file, redis, **kwargs):
+    kwargs.setdefault("worker", True)
+    feeder = SpiderFeeder("c1", "test", None, urls_file, 100, 6379,
+                          "127.0.0.1", False, **kwargs)
+    feeder.redis_conn = redis
+    return feeder
+
+
+class SpiderFeederTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.urls_file = tempfile.mkstemp(suffix=".txt")
+        self.urls = ["http://www.a.com/%s" % ("x" * (i % 7) + str(i))
+                     for i in range(50)]
+        with os.fdopen(fd, "wb") as f:
+            # 带BOM及\r\n的行
+            f.write(("\ufeff" + "\r\n".join(self.urls) + "\n").encode("utf-8"))
+        self.size = os.path.getsize(self.urls_file)
+
+    def tearDown(self):
+        os.remove(self.urls_file)
+
+    def test_iter_lines_ranges(self):
+        # 任意的切分位置，每一行恰好属于一个范围
+        with open(self.urls_file, "rb") as f:
+            for middle in range(1, self.size):
+                urls = list()
+                for start, end in ((0, middle), (middle, self.size)):
+                    f.seek(0)
+                    urls.extend(url for url, _ in
+                                SpiderFeeder.iter_lines(f, start, end))
+                self.assertEqual(urls, self.urls, middle)
+
+    def test_iter_lines_offset(self):
+        with open(self.urls_file, "rb") as f:
+            lines = list(SpiderFeeder.iter_lines(f))
+            self.assertEqual(lines[-1][1], self.size)
+            # 从某一行之后的位置继续
+            _, offset = lines[9]
+            self.assertEqual(
+                [url for url, _ in SpiderFeeder.iter_lines(f, 0, None, offset)],
+                self.urls[10:])
+
+    def queued_urls(self, redis):
+        return sorted(pickle.loads(req).url
+                      for req in redis.zrange("test:request:queue", 0, -1))
+
+    def test_resume(self):
+        redis = FakeRedis()
+        # 第3批写入时失败
+        fail_after(redis, 2)
+        feeder = make_feeder(self.urls_file, redis, batch_size=7, retries=0)
+        with mock.patch("time.sleep"), mock.patch("traceback.print_exc"):
+            self.assertRaises(SystemExit, feeder.start)
+        self.assertEqual(redis.zcard("test:request:queue"), 14)
+        self.assertEqual(redis.hget("crawlid:c1:feed_checkpoint", "file"),
+                         self.urls_file.encode())
+        redis.on_execute = None
+        make_feeder(self.urls_file, redis, batch_size=7, resume=True).start()
+        self.assertEqual(self.queued_urls(redis), sorted(self.urls))
+        self.assertEqual(redis.hget("crawlid:c1", "total_pages"), b"50")
+        self.assertEqual(
+            int(redis.hget("crawlid:c1:feed_checkpoint", "0")), self.size)
+
+    def test_load_checkpoint_mismatch(self):
+        redis = FakeRedis()
+        self.assertEqual(make_feeder(self.urls_file, redis).load_checkpoint(),
+                         {})
+        redis.hset("crawlid:c1:feed_checkpoint", "0", 10)
+        self.assertEqual(make_feeder(
+            self.urls_file, redis, resume=True).load_checkpoint(), {"0": 10})
+        # 进程数不同时范围的划分不同，不能继续
+        self.assertRaises(SystemExit, make_feeder(
+            self.urls_file, redis, resume=True, processes=2).load_checkpoint)
+        self.assertRaises(SystemExit, make_feeder(
+            self.urls_file + ".bak", redis, resume=True).load_checkpoint)
+
+
+if __name__ == "__main__":
+    unittest.main()
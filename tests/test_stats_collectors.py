@@ -0,0 +1,82 @@
+import unittest
+
+from unittest import mock
+
+from redis import RedisError
+from scrapy.utils.test import get_crawler
+
+from structor import settings
+from structor.spiders import StructureSpider
+from structor.utils import index_key
+from structor.stats_collectors import StatsBuffer
+
+from tests.fake_redis import FakeRedis
+
+
+def fail_once(pipeline):
+    pipeline.redis.on_execute = None
+    raise RedisError("redis is down")
+
+
+class BufferedStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        values = {k: getattr(settings, k) for k in dir(settings) if k.isupper()}
+        values.update(CUSTOM_REDIS=False, STATS_BUFFERED=True,
+                      STATS_FLUSH_EVENTS=3)
+        crawler = get_crawler(StructureSpider, values)
+        crawler.spider = crawler._create_spider()
+        self.redis = FakeRedis()
+        crawler.spider.set_redis(self.redis)
+        self.stats = crawler.stats
+
+    def test_flush_events(self):
+        self.stats.inc_total_pages("c1", 5)
+        self.stats.inc_crawled_pages("c1")
+        self.assertFalse(self.redis.data)
+        self.stats.set_failed_download("c1", "http://a.com/", "timeout")
+        self.assertEqual(self.redis.transactions, [True])
+        self.assertEqual(self.redis.round_trips, 1)
+        stats = self.redis.hgetall("crawlid:c1")
+        self.assertEqual(stats[b"total_pages"], b"5")
+        self.assertEqual(stats[b"crawled_pages"], b"1")
+        self.assertEqual(stats[b"failed_download_pages"], b"1")
+        self.assertEqual(stats[b"spiderid"], b"structure")
+        self.assertEqual(self.redis.hlen("failed_download_pages:c1"), 1)
+        self.assertEqual(self.redis.smembers(index_key("c1")),
+                         {b"failed_download_pages:c1"})
+        self.assertFalse(self.stats.buffers)
+
+    def test_flush_failed(self):
+        self.redis.on_execute = fail_once
+        self.stats.inc_total_pages("c1", 5)
+        with mock.patch.object(self.stats, "logger") as logger:
+            self.stats.flush()
+            self.assertTrue(logger.error.called)
+        self.assertFalse(self.redis.data)
+        # 保留的增量与之后的增量合并
+        self.stats.inc_total_pages("c1", 2)
+        self.stats.inc_crawled_pages("c2")
+        self.stats.flush()
+        self.assertEqual(self.redis.hget("crawlid:c1", "total_pages"), b"7")
+        self.assertEqual(self.redis.hget("crawlid:c2", "crawled_pages"), b"1")
+
+    def test_merge(self):
+        older, newer = StatsBuffer(), StatsBuffer()
+        older.counters.update(total_pages=5, crawled_pages=1)
+        older.failed["pages"]["http://a.com/"] = "timeout"
+        older.touch()
+        newer.values["total_pages"] = 3
+        newer.counters["crawled_pages"] = 1
+        newer.failed["pages"]["http://b.com/"] = "404"
+        older.merge(newer)
+        # 之后设置的值覆盖之前的增量
+        self.assertEqual(older.values, {"total_pages": 3})
+        self.assertEqual(older.counters, {"crawled_pages": 2})
+        self.assertEqual(sorted(older.failed["pages"]),
+                         ["http://a.com/", "http://b.com/"])
+        self.assertTrue(older.start_time)
+
+
+if __name__ == "__main__":
+    unittest.main()